@@ -0,0 +1,340 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Read sort order from sam/bam headers, statistics from bam index (.bai)
+files, and shard planning based on read density. Bam files are
+indexed in-process with pysam, if installed.
+
+The bam index holds, for every contig, the number of mapped and
+unmapped reads (in the pseudo-bin 37450) and a linear index of the
+file offsets of the first read in every 16kb window. The compressed
+file offset differences between consecutive windows are used as a
+proxy for the number of reads in a window, and the mapped reads of a
+contig are distributed over its windows accordingly. No reads are
+read from the bam file itself.
+
+"""
+import os
+import gzip
+import struct
+import bisect
+from multiprocessing.pool import ThreadPool
+from ratatosk.utils import rreplace, relative_symlink
+from ratatosk.interval import region_intervals
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+WINDOW_SIZE = 16384
+"""Size of the linear index windows"""
+
+PSEUDO_BIN = 37450
+"""Bin holding mapped and unmapped read counts"""
+
+def find_index(bamfile):
+    """Find the index of a bam file, as generated by
+    :class:`ratatosk.lib.tools.samtools.Index` (file.bai) or by
+    samtools index (file.bam.bai).
+
+    :param bamfile: bam file name
+
+    :returns: index file name, or None if there is no index
+    """
+    for fn in [rreplace(bamfile, ".bam", ".bai", 1), bamfile + ".bai"]:
+        if os.path.exists(fn):
+            return fn
+    return None
+
+def read_header(fn):
+    """Read the header text of a sam or bam file. Bam files are
+    recognized by the gzip magic number; only the header block is
+    decompressed.
+
+    :param fn: sam or bam file name
+
+    :returns: header text
+    """
+    with open(fn, "rb") as fh:
+        magic = fh.read(2)
+    if magic != "\x1f\x8b":
+        lines = []
+        with open(fn) as fh:
+            for line in fh:
+                if not line.startswith("@"):
+                    break
+                lines.append(line)
+        return "".join(lines)
+    fh = gzip.open(fn, "rb")
+    try:
+        if fh.read(4) != "BAM\1":
+            raise Exception("{} is not a bam file".format(fn))
+        (l_text,) = struct.unpack("<i", fh.read(4))
+        return fh.read(l_text)
+    finally:
+        fh.close()
+
+def sort_order(fn):
+    """Get the sort order of a sam or bam file, as given by the SO tag
+    of the @HD header line.
+
+    :param fn: sam or bam file name
+
+    :returns: sort order, or None if the header has no SO tag
+    """
+    for line in read_header(fn).splitlines():
+        if not line.startswith("@HD"):
+            continue
+        for field in line.rstrip("\0").split("\t")[1:]:
+            if field.startswith("SO:"):
+                return field[3:]
+    return None
+
+def is_coordinate_sorted(bamfile, check_index=False):
+    """Check whether a sam or bam file is sorted by coordinate.
+
+    :param bamfile: sam or bam file name
+    :param check_index: also require an index that is not older than the bam file. Indexing fails on unsorted files, so an up-to-date index confirms the header.
+
+    :returns: True if the file is sorted by coordinate
+    """
+    if sort_order(bamfile) != "coordinate":
+        return False
+    if check_index:
+        return has_current_index(bamfile)
+    return True
+
+def has_current_index(bamfile, baifile=None):
+    """Check whether a bam file has an index that is not older than
+    the bam file itself.
+
+    :param bamfile: bam file name
+    :param baifile: index file name; if None, look for the index with :func:`find_index`
+
+    :returns: True if the index exists and is up to date
+    """
+    baifile = baifile or find_index(bamfile)
+    if baifile is None or not os.path.exists(baifile):
+        return False
+    return os.path.getmtime(baifile) >= os.path.getmtime(bamfile)
+
+def link_bam(bamfile, linkname):
+    """Symlink a bam file and, if it exists, its index.
+
+    :param bamfile: bam file name
+    :param linkname: link name. The index is linked as linkname with the .bam extension replaced by .bai.
+    """
+    relative_symlink(bamfile, linkname)
+    baifile = find_index(bamfile)
+    if baifile and linkname.endswith(".bam"):
+        relative_symlink(baifile, rreplace(linkname, ".bam", ".bai", 1))
+
+def read_bai(baifile):
+    """Read read counts and linear indices from a bam index.
+
+    :param baifile: bam index file name
+
+    :returns: tuple (list of dictionaries with keys mapped, unmapped and linear, one per contig, number of unplaced unmapped reads)
+    """
+    with open(baifile, "rb") as fh:
+        data = fh.read()
+    if data[0:4] != "BAI\1":
+        raise Exception("{} is not a bam index".format(baifile))
+    (n_ref,) = struct.unpack_from("<i", data, 4)
+    pos = 8
+    refs = []
+    for i in range(n_ref):
+        ref = {"mapped" : 0, "unmapped" : 0, "linear" : []}
+        (n_bin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        for j in range(n_bin):
+            (bin, n_chunk) = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            if bin == PSEUDO_BIN and n_chunk == 2:
+                (ref["mapped"], ref["unmapped"]) = struct.unpack_from("<QQ", data, pos + 16)
+            pos += 16 * n_chunk
+        (n_intv,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        ref["linear"] = list(struct.unpack_from("<{}Q".format(n_intv), data, pos))
+        pos += 8 * n_intv
+        refs.append(ref)
+    n_no_coor = 0
+    if len(data) >= pos + 8:
+        (n_no_coor,) = struct.unpack_from("<Q", data, pos)
+    return (refs, n_no_coor)
+
+def index_stats(bamfile):
+    """Get the numbers of mapped and unmapped reads of an indexed bam
+    file, as reported by samtools idxstats, without reading the bam
+    file.
+
+    :param bamfile: bam file name
+
+    :returns: tuple (mapped, unmapped), where unmapped includes unplaced reads
+    """
+    baifile = find_index(bamfile)
+    if baifile is None:
+        raise Exception("no index for {}".format(bamfile))
+    (refs, n_no_coor) = read_bai(baifile)
+    return (sum(x["mapped"] for x in refs), sum(x["unmapped"] for x in refs) + n_no_coor)
+
+def index_bam(bamfile, baifile=None):
+    """Index a bam file in-process with pysam.
+
+    :param bamfile: bam file name
+    :param baifile: index file name; defaults to bamfile.bai
+
+    :returns: index file name
+    """
+    if pysam is None:
+        raise Exception("native indexing requires pysam")
+    baifile = baifile or bamfile + ".bai"
+    logger.info("indexing {0} to {1}".format(bamfile, baifile))
+    pysam.index(bamfile, baifile)
+    return baifile
+
+def _index_bam(args):
+    return index_bam(*args)
+
+def index_bams(bamfiles, threads=1):
+    """Index bam files concurrently in a thread pool. pysam releases
+    the GIL while indexing, so that threads run in parallel.
+
+    :param bamfiles: list of bam file names or (bam file name, index file name) tuples
+    :param threads: number of threads
+
+    :returns: list of index file names
+    """
+    bamfiles = [(x, None) if isinstance(x, basestring) else tuple(x) for x in bamfiles]
+    if int(threads) <= 1 or len(bamfiles) <= 1:
+        return [index_bam(*x) for x in bamfiles]
+    pool = ThreadPool(min(int(threads), len(bamfiles)))
+    try:
+        return pool.map(_index_bam, bamfiles)
+    finally:
+        pool.close()
+        pool.join()
+
+def window_loads(baifile, contigs):
+    """Estimate the number of mapped reads in each linear index window.
+
+    :param baifile: bam index file name
+    :param contigs: list of (contig, length) tuples, in bam header order
+
+    :returns: list of (contig, start, end, reads) tuples
+    """
+    (refs, n_no_coor) = read_bai(baifile)
+    if len(refs) != len(contigs):
+        raise Exception("bam index {} has {} contigs; expected {}".format(baifile, len(refs), len(contigs)))
+    windows = []
+    for (contig, length), ref in zip(contigs, refs):
+        # Compressed file offsets. Leading empty windows have offset
+        # 0, other empty windows repeat the offset of the previous
+        # window.
+        offsets = [x >> 16 for x in ref["linear"]]
+        first = ([x for x in offsets if x > 0] or [0])[0]
+        offsets = [x if x > 0 else first for x in offsets]
+        nwin = (length + WINDOW_SIZE - 1) // WINDOW_SIZE
+        sizes = [0] * nwin
+        for k in range(min(nwin, len(offsets)) - 1):
+            sizes[k] = max(0, offsets[k + 1] - offsets[k])
+        if 0 < len(offsets) <= nwin:
+            # Size of last window is unknown; use mean of the others
+            sizes[len(offsets) - 1] = sum(sizes) / float(max(1, len(offsets) - 1)) if len(offsets) > 1 else 1
+        total = float(sum(sizes))
+        for k in range(nwin):
+            reads = ref["mapped"] * sizes[k] / total if total > 0 else 0.0
+            windows.append((contig, k * WINDOW_SIZE + 1, min(length, (k + 1) * WINDOW_SIZE), reads))
+    return windows
+
+def _index_intervals(intervals):
+    """Index intervals for :func:`_overlapping`.
+
+    :param intervals: list of (contig, start, end) tuples
+
+    :returns: dictionary mapping contig to a tuple (sorted starts, running maximum of ends, intervals)
+    """
+    index = {}
+    for (contig, start, end) in sorted(intervals):
+        (s, e, iv) = index.setdefault(contig, ([], [], []))
+        s.append(start)
+        e.append(max(end, e[-1]) if e else end)
+        iv.append((contig, start, end))
+    return index
+
+def _overlapping(index, contig, start, end):
+    """Get the indexed intervals that overlap contig:start-end"""
+    if contig not in index:
+        return []
+    (s, e, iv) = index[contig]
+    # Intervals before i end before start; intervals from j on start after end
+    (i, j) = (bisect.bisect_left(e, start), bisect.bisect_right(s, end))
+    return [x for x in iv[i:j] if x[2] >= start]
+
+def _overlap(window, index):
+    """Fraction of window covered by indexed intervals"""
+    (contig, start, end, _) = window
+    covered = 0
+    for (c, s, e) in _overlapping(index, contig, start, end):
+        covered += min(e, end) - max(s, start) + 1
+    return min(1.0, covered / float(end - start + 1))
+
+def plan_shards(baifile, contigs, n, region=None, split=True):
+    """Partition a reference, or a region of it, into at most n groups
+    of intervals with roughly equal numbers of mapped reads.
+
+    :param baifile: bam index file name
+    :param contigs: list of (contig, length) tuples, in bam header order
+    :param n: number of groups
+    :param region: interval file name or interval string to partition; if None, partition the whole reference
+    :param split: allow contigs to be split between groups. If False, groups consist of whole contigs.
+
+    :returns: list of interval lists, or an empty list if there are no mapped reads
+    """
+    windows = window_loads(baifile, contigs)
+    if region:
+        index = _index_intervals(region_intervals(region, contigs))
+        windows = [(c, s, e, r * _overlap((c, s, e, r), index)) for (c, s, e, r) in windows]
+    if not split:
+        loads = {}
+        for (c, s, e, r) in windows:
+            loads[c] = loads.get(c, 0.0) + r
+        windows = [(c, 1, l, loads.get(c, 0.0)) for c, l in contigs]
+    total = sum(w[3] for w in windows)
+    if total == 0:
+        logger.warn("No mapped reads in bam index {}".format(baifile))
+        return []
+    n = max(1, int(n))
+    groups = [[] for i in range(n)]
+    offset = 0.0
+    i = 0
+    for (c, s, e, r) in windows:
+        # Assign window by the midpoint of its cumulative load. Empty
+        # windows stay with the preceding window.
+        while r > 0 and offset + r / 2.0 >= total * (i + 1) / n and i < n - 1:
+            i += 1
+        offset += r
+        if groups[i] and groups[i][-1][0] == c and groups[i][-1][2] == s - 1:
+            groups[i][-1] = (c, groups[i][-1][1], e)
+        else:
+            groups[i].append((c, s, e))
+    groups = [g for g in groups if g]
+    if region:
+        # Restrict groups to the region
+        groups = [[(c, max(s, rs), min(e, rend)) for (c, s, e) in g for (_, rs, rend) in _overlapping(index, c, s, e)] for g in groups]
+    return [g for g in groups if g]
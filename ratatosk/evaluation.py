@@ -0,0 +1,358 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Native variant evaluation, as done by GATK VariantEval with the
+CompOverlap, CountVariants and TiTvVariantEvaluator modules.
+
+Variants are stratified as by GATK with the Filter stratification:
+by novelty (all, known, novel), where a variant is known if the comp
+resource (dbsnp) has a record at the same position, and by filter
+status (called, filtered, raw). Records of the eval vcf are counted
+in chunks with numpy. Comp records are read with tabix if
+pysam is installed and the resource is indexed, and streamed
+otherwise.
+
+Results are written as a GATKReport (v1.1), as by VariantEval, and
+as a tab-separated table with one row per statistic, see
+:func:`write_table`. Genotype concordance and validation reports
+are not computed.
+
+"""
+import os
+import re
+from ratatosk.interval import interval_index, overlaps
+from ratatosk.vcf import open_vcf, variant_type
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+CHUNK_SIZE = 100000
+"""Number of records counted at a time"""
+
+NOVELTY = ["all", "known", "novel"]
+FILTER = ["called", "filtered", "raw"]
+
+# Per-record counts. Each record contributes to the counts of the
+# strata it belongs to.
+_COUNTS = ["eval", "atComp", "concordant", "called", "ref", "variant",
+           "snp", "mnp", "insertion", "deletion", "complex", "symbolic", "mixed",
+           "nocall", "het", "homRef", "homVar", "singleton", "ti", "tv"]
+
+_TRANSITIONS = set([("A", "G"), ("G", "A"), ("C", "T"), ("T", "C")])
+
+def _is_transition(ref, alt):
+    return (ref.upper(), alt.upper()) in _TRANSITIONS
+
+def _genotype_counts(fields):
+    """Count genotypes of the samples of a record.
+
+    :returns: tuple (no calls, hets, hom refs, hom vars, alternate allele count)
+    """
+    (nocall, het, homref, homvar, ac) = (0, 0, 0, 0, 0)
+    if len(fields) < 10:
+        return (nocall, het, homref, homvar, ac)
+    for sample in fields[9:]:
+        alleles = re.split("[/|]", sample.split(":", 1)[0].strip())
+        if "." in alleles:
+            nocall += 1
+        elif len(set(alleles)) > 1:
+            het += 1
+        elif alleles[0] == "0":
+            homref += 1
+        else:
+            homvar += 1
+        ac += sum(1 for a in alleles if a not in [".", "0"])
+    return (nocall, het, homref, homvar, ac)
+
+def _record_counts(fields, comp):
+    """Get the per-record counts of an eval record.
+
+    :param fields: vcf record fields
+    :param comp: (ref, alternate alleles) of the comp record at the same position, or None
+
+    :returns: list of counts, in the order of _COUNTS
+    """
+    (ref, alt) = (fields[3], fields[4])
+    alts = [x for x in alt.split(",") if x != "."]
+    (nocall, het, homref, homvar, ac) = _genotype_counts(fields)
+    has_samples = len(fields) > 9
+    variant = bool(alts) and (ac > 0 if has_samples else True)
+    vtype = variant_type(ref, alt) if variant else "NO_VARIATION"
+    counts = dict((k, 0) for k in _COUNTS)
+    counts.update({"eval" : int(variant), "called" : 1, "ref" : int(not variant), "variant" : int(variant),
+                   "nocall" : nocall, "het" : het, "homRef" : homref, "homVar" : homvar})
+    if variant:
+        if comp is not None:
+            counts["atComp"] = 1
+            counts["concordant"] = int(comp[0] == ref and set(alts) <= comp[1])
+        if vtype == "SNP":
+            counts["snp"] = 1
+            if len(alts) == 1:
+                counts["ti" if _is_transition(ref, alts[0]) else "tv"] = 1
+        elif vtype == "MNP":
+            counts["mnp"] = 1
+        elif vtype == "INDEL":
+            ins = [len(x) > len(ref) for x in alts]
+            if all(ins):
+                counts["insertion"] = 1
+            elif not any(ins):
+                counts["deletion"] = 1
+            else:
+                counts["complex"] = 1
+        elif vtype == "SYMBOLIC":
+            counts["symbolic"] = 1
+        elif vtype == "MIXED":
+            counts["mixed"] = 1
+        counts["singleton"] = int(has_samples and ac == 1)
+    return [counts[k] for k in _COUNTS]
+
+def _read_comp(compfile, keys, intervals=None):
+    """Read the comp records at eval positions, and count the
+    transitions and transversions of comp snps.
+
+    :param compfile: comp vcf file name
+    :param keys: set of (contig, position) tuples of eval records
+    :param intervals: list of (contig, start, end) tuples; if given, only comp records in the intervals are counted
+
+    :returns: tuple (dictionary mapping keys to (ref, set of alternate alleles), transitions, transversions)
+    """
+    comp = {}
+    (ti, tv) = (0, 0)
+    index = interval_index(intervals) if intervals is not None else None
+
+    def add(fields):
+        alts = [x for x in fields[4].split(",") if x != "."]
+        key = (fields[0], int(fields[1]))
+        if key in keys:
+            comp[key] = (fields[3], set(alts))
+        if len(alts) == 1 and variant_type(fields[3], fields[4]) == "SNP":
+            return (1, 0) if _is_transition(fields[3], alts[0]) else (0, 1)
+        return (0, 0)
+
+    if pysam and intervals is not None and compfile.endswith(".gz") and os.path.exists(compfile + ".tbi"):
+        tbx = pysam.Tabixfile(compfile)
+        for (contig, start, end) in intervals:
+            if contig in tbx.contigs:
+                for line in tbx.fetch(contig, start - 1, end):
+                    (a, b) = add(line.split("\t", 5))
+                    (ti, tv) = (ti + a, tv + b)
+        return (comp, ti, tv)
+    with open_vcf(compfile) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t", 5)
+            if index is not None and not overlaps(index, fields[0], int(fields[1]), int(fields[1]) + len(fields[3]) - 1):
+                continue
+            (a, b) = add(fields)
+            (ti, tv) = (ti + a, tv + b)
+    return (comp, ti, tv)
+
+def _ratio(num, denom):
+    return float(num) / denom if denom > 0 else 0.0
+
+def _stratum_tables(counts, processed_loci, comp_ti, comp_tv):
+    """Compute evaluation module tables from the summed counts of a
+    stratum.
+
+    :returns: list of (table name, list of (column, value) tuples)
+    """
+    c = dict(zip(_COUNTS, counts))
+    indels = c["insertion"] + c["deletion"]
+    return [("CompOverlap", [("nEvalVariants", c["eval"]),
+                             ("novelSites", c["eval"] - c["atComp"]),
+                             ("nVariantsAtComp", c["atComp"]),
+                             ("compRate", 100.0 * _ratio(c["atComp"], c["eval"])),
+                             ("nConcordant", c["concordant"]),
+                             ("concordantRate", 100.0 * _ratio(c["concordant"], c["atComp"]))]),
+            ("CountVariants", [("nProcessedLoci", processed_loci),
+                               ("nCalledLoci", c["called"]),
+                               ("nRefLoci", c["ref"]),
+                               ("nVariantLoci", c["variant"]),
+                               ("variantRate", _ratio(c["variant"], processed_loci)),
+                               ("variantRatePerBp", _ratio(processed_loci, c["variant"])),
+                               ("nSNPs", c["snp"]),
+                               ("nMNPs", c["mnp"]),
+                               ("nInsertions", c["insertion"]),
+                               ("nDeletions", c["deletion"]),
+                               ("nComplex", c["complex"]),
+                               ("nSymbolic", c["symbolic"]),
+                               ("nMixed", c["mixed"]),
+                               ("nNoCalls", c["nocall"]),
+                               ("nHets", c["het"]),
+                               ("nHomRef", c["homRef"]),
+                               ("nHomVar", c["homVar"]),
+                               ("nSingletons", c["singleton"]),
+                               ("heterozygosity", _ratio(c["het"], processed_loci)),
+                               ("heterozygosityPerBp", _ratio(processed_loci, c["het"])),
+                               ("hetHomRatio", _ratio(c["het"], c["homVar"])),
+                               ("indelRate", _ratio(indels, processed_loci)),
+                               ("indelRatePerBp", _ratio(processed_loci, indels)),
+                               ("insertionDeletionRatio", _ratio(c["insertion"], c["deletion"]))]),
+            ("TiTvVariantEvaluator", [("nTi", c["ti"]),
+                                      ("nTv", c["tv"]),
+                                      ("tiTvRatio", _ratio(c["ti"], c["tv"])),
+                                      ("nTiInComp", comp_ti),
+                                      ("nTvInComp", comp_tv),
+                                      ("TiTvRatioStandard", _ratio(comp_ti, comp_tv))])]
+
+def evaluate_variants(evalfile, compfile=None, intervals=None, processed_loci=0, chunk_size=CHUNK_SIZE):
+    """Evaluate variants.
+
+    :param evalfile: vcf file to evaluate, plain or gzipped
+    :param compfile: comp (dbsnp) vcf file name
+    :param intervals: list of (contig, start, end) tuples; if given, only records overlapping the intervals are evaluated, as with the GATK -L option
+    :param processed_loci: number of processed loci, i.e. the length of the intervals or of the reference
+    :param chunk_size: number of records counted at a time
+
+    :returns: dictionary mapping table names to lists of rows, where a row is a dictionary with stratification and metrics values
+    """
+    if np is None:
+        raise Exception("need numpy for native variant evaluation")
+    index = interval_index(intervals) if intervals is not None else None
+    records = []
+    with open_vcf(evalfile) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if index is not None and not overlaps(index, fields[0], int(fields[1]), int(fields[1]) + len(fields[3]) - 1):
+                continue
+            records.append(fields)
+    (comp, comp_ti, comp_tv) = ({}, 0, 0)
+    if compfile:
+        (comp, comp_ti, comp_tv) = _read_comp(compfile, set((r[0], int(r[1])) for r in records), intervals)
+    # Summed counts, by novelty and filter stratum
+    sums = np.zeros((len(NOVELTY), len(FILTER), len(_COUNTS)), dtype=np.int64)
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        counts = np.array([_record_counts(r, comp.get((r[0], int(r[1])))) for r in chunk], dtype=np.int64).reshape(len(chunk), len(_COUNTS))
+        known = np.array([(r[0], int(r[1])) in comp for r in chunk], dtype=bool)
+        filtered = np.array([r[6] not in [".", "PASS"] for r in chunk], dtype=bool)
+        for n, nmask in enumerate([np.ones(len(chunk), dtype=bool), known, ~known]):
+            for f, fmask in enumerate([~filtered, filtered, np.ones(len(chunk), dtype=bool)]):
+                sums[n, f] += counts[nmask & fmask].sum(axis=0)
+    tables = {}
+    for f, filt in enumerate(FILTER):
+        for n, novelty in enumerate(NOVELTY):
+            strat = [("CompRod", "dbsnp" if compfile else "none"), ("EvalRod", "eval"), ("Filter", filt),
+                     ("JexlExpression", "none"), ("Novelty", novelty)]
+            for (name, values) in _stratum_tables(sums[n, f], processed_loci, comp_ti, comp_tv):
+                tables.setdefault(name, []).append(strat + values)
+    logger.info("Evaluated {} records of {}".format(len(records), evalfile))
+    return tables
+
+_DESCRIPTIONS = {"CompOverlap" : "The overlap between eval and comp sites",
+                 "CountVariants" : "Counts different classes of variants in the sample",
+                 "TiTvVariantEvaluator" : "Ti/Tv Variant Evaluator"}
+
+# Columns formatted with %.8f; other floats are formatted with %.2f
+_RATES = ["variantRate", "heterozygosity", "indelRate"]
+
+def _format_code(column, value):
+    if isinstance(value, float):
+        return "%.8f" if column in _RATES else "%.2f"
+    if isinstance(value, basestring):
+        return "%s"
+    return "%d"
+
+def _format_value(column, value):
+    return _format_code(column, value) % value
+
+def write_report(tables, outfile):
+    """Write evaluation tables as a GATKReport (v1.1).
+
+    :param tables: evaluation tables, as returned by :func:`evaluate_variants`
+    :param outfile: output file name
+    """
+    with open(outfile, "w") as fh:
+        fh.write("#:GATKReport.v1.1:{}\n".format(len(tables)))
+        for name in sorted(tables.keys()):
+            rows = tables[name]
+            header = [name] + [k for (k, _) in rows[0]]
+            values = [[name] + [_format_value(k, v) for (k, v) in row] for row in rows]
+            fh.write("#:GATKTable:{}:{}:{}:;\n".format(len(header), len(rows), ":".join(["%s"] + [_format_code(k, v) for (k, v) in rows[0]])))
+            fh.write("#:GATKTable:{}:{}\n".format(name, _DESCRIPTIONS.get(name, name)))
+            widths = [max(len(x) for x in col) for col in zip(header, *values)]
+            numeric = [False] + [not isinstance(v, basestring) for (_, v) in rows[0]]
+            for row in [header] + values:
+                fh.write("  ".join(x.rjust(w) if num and row is not header else x.ljust(w) for x, w, num in zip(row, widths, numeric)).rstrip() + "\n")
+            fh.write("\n")
+
+def read_report(fn):
+    """Read the tables of a GATKReport, as written by VariantEval or
+    :func:`write_report`.
+
+    :param fn: report file name
+
+    :returns: dictionary mapping table names to lists of rows, where a row is a list of (column, value) tuples
+    """
+    tables = {}
+    (name, header) = (None, None)
+    with open(fn) as fh:
+        for line in fh:
+            if line.startswith("#:GATKTable:"):
+                fields = line.rstrip("\n").split(":")
+                if not fields[-1] == ";":
+                    (name, header) = (fields[2], None)
+                    tables[name] = []
+                continue
+            if line.startswith("#") or not line.strip() or name is None:
+                continue
+            fields = line.split()
+            if header is None:
+                header = fields
+                continue
+            tables[name].append(zip(header[1:], fields[1:]))
+    return tables
+
+_STRATIFICATIONS = ["CompRod", "EvalRod", "Filter", "JexlExpression", "Novelty"]
+
+def table_rows(tables):
+    """Convert evaluation tables to rows of a long-format table, with
+    one row per statistic and stratum.
+
+    :param tables: tables, as returned by :func:`evaluate_variants` or :func:`read_report`
+
+    :returns: list of rows, the first row being the header
+    """
+    rows = [["Table", "Filter", "Novelty", "Metric", "Value"]]
+    for name in sorted(tables.keys()):
+        for row in tables[name]:
+            strat = dict((k, v) for (k, v) in row if k in _STRATIFICATIONS)
+            for (k, v) in row:
+                if k not in _STRATIFICATIONS:
+                    rows.append([name, strat.get("Filter", "raw"), strat.get("Novelty", "all"), k, v if isinstance(v, basestring) else _format_value(k, v)])
+    return rows
+
+def write_table(tables, outfile):
+    """Write evaluation tables as a tab-separated long-format table,
+    see :func:`table_rows`.
+
+    :param tables: evaluation tables
+    :param outfile: output file name
+    """
+    with open(outfile, "w") as fh:
+        for row in table_rows(tables):
+            fh.write("\t".join(str(x) for x in row) + "\n")
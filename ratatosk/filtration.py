@@ -0,0 +1,381 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Native hard filtering of vcf files, as done by GATK VariantFiltration.
+
+Filter expressions are parsed from the subset of JEXL used for hard
+filtering: numbers, INFO keys, QUAL and POS, arithmetic (+, -, *,
+/), comparisons (<, <=, >, >=, ==, !=), !, && and ||. Records are
+read in chunks and expressions are evaluated column-wise with numpy.
+
+JEXL semantics are followed where they matter for filtering.
+Division of two integers is integer division. An expression that
+references a missing or non-numeric value, or divides by zero, fails
+to evaluate and does not filter the record, unless missing values
+should fail, but && and || short-circuit as in JEXL. A missing QUAL
+is -10.0.
+
+As in GATK, failed filters are added to the filters already set,
+FILTER values are sorted and joined with ;, and records that pass are
+set to PASS. If cluster_size is set, records in a window of
+cluster_window bp containing at least cluster_size records are
+filtered as SnpCluster.
+
+"""
+import os
+import re
+import shlex
+from ratatosk.interval import interval_index, overlaps
+from ratatosk.vcf import open_vcf, strip_sfx, move_output
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CLUSTER_FILTER = "SnpCluster"
+"""Name of the snp cluster filter"""
+
+CHUNK_SIZE = 100000
+"""Number of records evaluated at a time"""
+
+_TOKEN = re.compile(r'\s*(?:(?P<num>[0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?|\.[0-9]+(?:[eE][-+]?[0-9]+)?)|(?P<name>[A-Za-z_][A-Za-z0-9_]*)|(?P<op>&&|\|\||<=|>=|==|!=|[-+*/()<>!]))')
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = _TOKEN.match(expression, pos)
+        if not m:
+            raise Exception("unsupported filter expression '{}' at '{}'".format(expression, expression[pos:]))
+        tokens.append((m.lastgroup, m.group(m.lastgroup)))
+        pos = m.end()
+    return tokens
+
+class _Parser(object):
+    """Recursive descent parser for filter expressions. Nodes are
+    tuples (type, ...)."""
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def parse(self):
+        node = self._or()
+        if self.pos < len(self.tokens):
+            self._error()
+        return node
+
+    def _error(self):
+        raise Exception("unsupported filter expression '{}'".format(self.expression))
+
+    def _peek(self):
+        return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        if self.pos >= len(self.tokens):
+            self._error()
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def _binary(self, ops, operand, node_type):
+        node = operand()
+        while self._peek() in ops:
+            op = self._next()[1]
+            node = (node_type, op, node, operand())
+        return node
+
+    def _or(self):
+        return self._binary(["||"], self._and, "logic")
+
+    def _and(self):
+        return self._binary(["&&"], self._cmp, "logic")
+
+    def _cmp(self):
+        return self._binary(["<", "<=", ">", ">=", "==", "!="], self._sum, "cmp")
+
+    def _sum(self):
+        return self._binary(["+", "-"], self._product, "arith")
+
+    def _product(self):
+        return self._binary(["*", "/"], self._unary, "arith")
+
+    def _unary(self):
+        if self._peek() in ["-", "!"]:
+            op = self._next()[1]
+            return ("neg" if op == "-" else "not", self._unary())
+        (kind, value) = self._next()
+        if kind == "num":
+            return ("num", float(value), not re.search("[.eE]", value))
+        if kind == "name":
+            return ("var", value)
+        if value == "(":
+            node = self._or()
+            if self._next()[1] != ")":
+                self._error()
+            return node
+        self._error()
+
+def parse_expression(expression):
+    """Parse a JEXL filter expression.
+
+    :param expression: filter expression, e.g. "QD < 2.0"
+
+    :returns: expression tree
+    """
+    return _Parser(expression).parse()
+
+def expression_names(node):
+    """Get the variable names used in an expression tree"""
+    if node[0] == "var":
+        return set([node[1]])
+    return set().union(*[expression_names(x) for x in node[1:] if isinstance(x, tuple)])
+
+def _column(values):
+    """Convert strings to a numeric column.
+
+    :returns: tuple (values, integer mask, error mask)
+    """
+    x = np.empty(len(values))
+    integer = np.zeros(len(values), dtype=bool)
+    error = np.zeros(len(values), dtype=bool)
+    for i, v in enumerate(values):
+        try:
+            x[i] = float(v)
+            integer[i] = not re.search("[.eEnN]", v)
+        except (TypeError, ValueError):
+            x[i] = 0.0
+            error[i] = True
+    return (x, integer, error)
+
+def evaluate(node, columns, n):
+    """Evaluate an expression tree column-wise.
+
+    :param node: expression tree, as returned by :func:`parse_expression`
+    :param columns: dictionary mapping variable names to (values, integer mask, error mask) tuples, as returned by :func:`_column`
+    :param n: number of records
+
+    :returns: tuple (values, integer mask, error mask)
+    """
+    if node[0] == "num":
+        return (np.repeat(node[1], n), np.repeat(node[2], n), np.zeros(n, dtype=bool))
+    if node[0] == "var":
+        return columns[node[1]]
+    if node[0] == "neg":
+        (x, integer, error) = evaluate(node[1], columns, n)
+        return (-x, integer, error)
+    if node[0] == "not":
+        (x, integer, error) = evaluate(node[1], columns, n)
+        return (x == 0, np.zeros(n, dtype=bool), error)
+    (op, left, right) = node[1:]
+    (x, xint, xerr) = evaluate(left, columns, n)
+    (y, yint, yerr) = evaluate(right, columns, n)
+    if node[0] == "logic":
+        (x, y) = (x != 0, y != 0)
+        if op == "&&":
+            # Right operand is only evaluated if left is true
+            return (x & y, np.zeros(n, dtype=bool), xerr | (x & yerr))
+        return (x | y, np.zeros(n, dtype=bool), xerr | (~x & yerr))
+    error = xerr | yerr
+    if node[0] == "cmp":
+        with np.errstate(invalid="ignore"):
+            values = {"<" : np.less, "<=" : np.less_equal, ">" : np.greater,
+                      ">=" : np.greater_equal, "==" : np.equal, "!=" : np.not_equal}[op](x, y)
+        return (values, np.zeros(n, dtype=bool), error)
+    integer = xint & yint
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if op == "/":
+            error = error | (y == 0)
+            values = np.where(integer, np.trunc(x / np.where(y == 0, 1, y)), x / np.where(y == 0, 1, y))
+        else:
+            values = {"+" : np.add, "-" : np.subtract, "*" : np.multiply}[op](x, y)
+    return (values, integer, error)
+
+def filter_options(args):
+    """Get native filtering settings from VariantFiltration
+    command line options.
+
+    :param args: list of options, e.g. as given by the opts of a task
+
+    :returns: dictionary with keys filters, cluster_size, cluster_window and missing_fail, as used by :func:`filter_variants`
+    """
+    tokens = shlex.split(" ".join(str(x) for x in args))
+    (names, expressions) = ([], [])
+    retval = {"cluster_size" : 3, "cluster_window" : 0, "missing_fail" : False}
+    for x, y in zip(tokens, tokens[1:] + [None]):
+        if x in ["--filterExpression", "-filter"]:
+            expressions.append(y)
+        elif x in ["--filterName", "-filterName"]:
+            names.append(y)
+        elif x in ["--clusterSize", "-cluster"]:
+            retval["cluster_size"] = int(y)
+        elif x in ["--clusterWindowSize", "-window"]:
+            retval["cluster_window"] = int(y)
+        elif x in ["--missingValuesInExpressionsShouldEvaluateAsFailing"]:
+            retval["missing_fail"] = True
+    if len(names) != len(expressions):
+        raise Exception("filter names and expressions differ in number: {} and {}".format(names, expressions))
+    retval["filters"] = zip(names, expressions)
+    if retval["cluster_window"] <= 0:
+        retval["cluster_size"] = None
+    return retval
+
+def _info_values(info, names):
+    """Get the values of INFO keys of a record"""
+    values = dict((k, None) for k in names)
+    for item in info.split(";"):
+        (key, _, value) = item.partition("=")
+        if key in values:
+            values[key] = value
+    return values
+
+def _cluster_runs(contigs, positions, cluster_size, cluster_window):
+    """Find runs of cluster_size consecutive records that span at most
+    cluster_window bp.
+
+    :returns: boolean array, where element i is True if records i to i + cluster_size - 1 form a cluster
+    """
+    k = cluster_size - 1
+    if len(positions) <= k:
+        return np.zeros(0, dtype=bool)
+    positions = np.asarray(positions)
+    contigs = np.asarray(contigs)
+    return (contigs[k:] == contigs[:-k]) & (np.abs(positions[k:] - positions[:-k]) <= cluster_window)
+
+def _clustered(runs, n, cluster_size):
+    """Records that belong to a cluster run. Record j is clustered if
+    any of runs j - cluster_size + 1 to j is True."""
+    counts = np.concatenate([[0], np.cumsum(runs)])
+    j = np.arange(n)
+    lo = np.clip(j - cluster_size + 1, 0, len(runs))
+    hi = np.clip(j + 1, 0, len(runs))
+    return counts[hi] - counts[lo] > 0
+
+def _filter_chunk(records, filters, missing_fail):
+    """Evaluate filters for a chunk of split records.
+
+    :returns: list of sets of failed filter names, one per record
+    """
+    n = len(records)
+    names = set().union(*[expression_names(tree) for (_, _, tree) in filters])
+    info = [_info_values(r[7].rstrip("\n"), names - set(["QUAL", "POS"])) for r in records]
+    columns = {}
+    for name in names:
+        if name == "QUAL":
+            columns[name] = _column(["-10.0" if r[5] == "." else r[5] for r in records])
+        elif name == "POS":
+            columns[name] = _column([r[1] for r in records])
+        else:
+            columns[name] = _column([x[name] for x in info])
+    failed = [set() for i in range(n)]
+    for (name, _, tree) in filters:
+        (values, _, error) = evaluate(tree, columns, n)
+        fail = (values != 0) | error if missing_fail else (values != 0) & ~error
+        for i in np.flatnonzero(fail):
+            failed[i].add(name)
+    return failed
+
+def _filter_value(current, failed):
+    """Get the FILTER value of a record"""
+    filters = set(failed)
+    if current not in [".", "PASS"]:
+        filters.update(current.split(";"))
+    return ";".join(sorted(filters)) if filters else "PASS"
+
+def _header_lines(filters, cluster_size):
+    retval = ['##FILTER=<ID={},Description="{}">\n'.format(name, exp.replace('"', '\\"')) for (name, exp, _) in filters]
+    if cluster_size:
+        retval.append('##FILTER=<ID={},Description="SNPs found in clusters">\n'.format(CLUSTER_FILTER))
+    return retval
+
+def filter_variants(vcffile, outfile, filters, cluster_size=None, cluster_window=0, intervals=None, missing_fail=False, chunk_size=CHUNK_SIZE):
+    """Hard filter the records of a vcf file.
+
+    :param vcffile: input vcf file, plain or gzipped
+    :param outfile: output vcf file
+    :param filters: list of (filter name, filter expression) tuples
+    :param cluster_size: number of records that make up a cluster; if None, no cluster filtering is done
+    :param cluster_window: window size (in bp) in which to look for clusters
+    :param intervals: list of (contig, start, end) tuples; if given, only records overlapping the intervals are kept, as with the GATK -L option
+    :param missing_fail: expressions with missing values fail, i.e. filter the record
+    :param chunk_size: number of records evaluated at a time
+
+    :returns: number of records written
+    """
+    if np is None:
+        raise Exception("need numpy for native filtering")
+    filters = [(name, exp, parse_expression(exp)) for (name, exp) in filters]
+    cluster_size = int(cluster_size) if cluster_size else None
+    if cluster_size is not None and cluster_size < 2:
+        raise Exception("cluster size must be at least 2")
+    index = interval_index(intervals) if intervals is not None else None
+    tmpfile = "{}.{}.tmp.vcf".format(strip_sfx(outfile), os.getpid())
+    # Records whose cluster filter depends on records not yet read
+    # are kept in pending, together with the cluster_size - 1 written
+    # records that precede them.
+    context = ([], [])
+    pending = []
+    nrec = [0]
+
+    def write(out, final=False):
+        if not pending:
+            return
+        contigs = context[0] + [r[0][0] for r in pending]
+        positions = context[1] + [int(r[0][1]) for r in pending]
+        offset = len(context[0])
+        ndone = len(pending)
+        if cluster_size:
+            clustered = _clustered(_cluster_runs(contigs, positions, cluster_size, cluster_window), len(contigs), cluster_size)[offset:]
+            if not final:
+                ndone = max(0, len(pending) - (cluster_size - 1))
+        for i in range(ndone):
+            (fields, failed) = pending[i]
+            if cluster_size and clustered[i]:
+                failed.add(CLUSTER_FILTER)
+            fields[6] = _filter_value(fields[6], failed)
+            out.write("\t".join(fields))
+        nrec[0] += ndone
+        keep = cluster_size - 1 if cluster_size else 0
+        context[0][:] = contigs[:offset + ndone][-keep:] if keep else []
+        context[1][:] = positions[:offset + ndone][-keep:] if keep else []
+        del pending[:ndone]
+
+    with open_vcf(vcffile) as fh, open(tmpfile, "w") as out:
+        chunk = []
+        for line in fh:
+            if line.startswith("##"):
+                out.write(line)
+                continue
+            if line.startswith("#"):
+                out.writelines(_header_lines(filters, cluster_size))
+                out.write(line)
+                continue
+            fields = line.split("\t")
+            if index is not None and not overlaps(index, fields[0], int(fields[1]), int(fields[1]) + len(fields[3]) - 1):
+                continue
+            chunk.append(fields)
+            if len(chunk) >= chunk_size:
+                pending.extend(zip(chunk, _filter_chunk(chunk, filters, missing_fail)))
+                write(out)
+                chunk = []
+        if chunk:
+            pending.extend(zip(chunk, _filter_chunk(chunk, filters, missing_fail)))
+        write(out, final=True)
+    move_output(tmpfile, outfile)
+    logger.info("Filtered {} records of {} to {}".format(nrec[0], vcffile, outfile))
+    return nrec[0]
@@ -0,0 +1,230 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Functions for reading, writing and partitioning genomic intervals.
+
+Intervals are represented as tuples (contig, start, end) with 1-based,
+closed coordinates, as in GATK and picard.
+
+"""
+import os
+import re
+import bisect
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+UNMAPPED = "unmapped"
+"""GATK interval name for unmapped reads"""
+
+def parse_interval(region):
+    """Parse a GATK interval string, e.g. chr1:100-200 or chr1.
+
+    :param region: interval string
+
+    :returns: (contig, start, end) tuple, where end is None if the interval spans the whole contig
+    """
+    m = re.match(r'^(.+):([0-9]+)(-([0-9]+))?$', region.strip())
+    if m:
+        end = int(m.group(4)) if m.group(4) else int(m.group(2))
+        return (m.group(1), int(m.group(2)), end)
+    return (region.strip(), 1, None)
+
+def read_intervals(fn):
+    """Read intervals from a picard interval list (.interval_list), a
+    bed file (.bed) or a GATK interval file (.intervals, .list).
+
+    :param fn: interval file name
+
+    :returns: list of (contig, start, end) tuples
+    """
+    intervals = []
+    is_bed = fn.endswith(".bed")
+    with open(os.path.expanduser(fn)) as fh:
+        for line in fh:
+            if line.startswith("@") or line.startswith("#") or line.startswith("track") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 3:
+                start = int(fields[1]) + 1 if is_bed else int(fields[1])
+                intervals.append((fields[0], start, int(fields[2])))
+            else:
+                intervals.append(parse_interval(fields[0]))
+    return intervals
+
+def region_intervals(region, contigs):
+    """Get the intervals of a region, as given by the GATK -L option,
+    i.e. an interval file or an interval string. Intervals spanning
+    whole contigs are resolved with contig lengths.
+
+    :param region: interval file name or interval string
+    :param contigs: list of (contig, length) tuples
+
+    :returns: list of (contig, start, end) tuples
+    """
+    if os.path.exists(os.path.expanduser(region)):
+        intervals = read_intervals(region)
+    else:
+        intervals = [parse_interval(region)]
+    lengths = dict(contigs)
+    return [(c, s, e if e is not None else lengths[c]) for (c, s, e) in intervals]
+
+def interval_index(intervals):
+    """Index intervals for overlap queries with :func:`overlaps`.
+
+    :param intervals: list of (contig, start, end) tuples
+
+    :returns: dictionary mapping contig to a tuple (sorted starts, running maximum of ends)
+    """
+    index = {}
+    for (contig, start, end) in sorted(intervals):
+        (s, e) = index.setdefault(contig, ([], []))
+        s.append(start)
+        e.append(max(end, e[-1]) if e else end)
+    return index
+
+def overlaps(index, contig, start, end):
+    """Check whether a position range overlaps indexed intervals.
+
+    :param index: interval index, as returned by :func:`interval_index`
+    :param contig: contig name
+    :param start: 1-based start
+    :param end: 1-based end (inclusive)
+
+    :returns: True if range overlaps an interval
+    """
+    if contig not in index:
+        return False
+    (s, e) = index[contig]
+    i = bisect.bisect_right(s, end)
+    return i > 0 and e[i - 1] >= start
+
+def interval_length(intervals):
+    """Get the number of bases covered by intervals, counting
+    overlapping intervals once.
+
+    :param intervals: list of (contig, start, end) tuples
+
+    :returns: number of bases
+    """
+    length = 0
+    (contig, end) = (None, 0)
+    for (c, s, e) in sorted(intervals):
+        if c != contig:
+            (contig, end) = (c, 0)
+        if e > end:
+            length += e - max(s, end + 1) + 1
+            end = e
+    return length
+
+def format_interval(interval):
+    """Format an interval as a GATK interval string.
+
+    :param interval: (contig, start, end) tuple
+
+    :returns: interval string
+    """
+    (contig, start, end) = interval
+    if end is None:
+        return contig
+    return "{}:{}-{}".format(contig, start, end)
+
+def write_intervals(intervals, fn):
+    """Write intervals to a GATK interval file.
+
+    :param intervals: list of (contig, start, end) tuples
+    :param fn: output file name
+    """
+    with open(fn, "w") as fh:
+        for iv in intervals:
+            fh.write(format_interval(iv) + "\n")
+
+def write_interval_list(intervals, fn, dictfile):
+    """Write intervals to a picard interval list, with the header of
+    a sequence dictionary.
+
+    :param intervals: list of (contig, start, end) tuples
+    :param fn: output file name
+    :param dictfile: sequence dictionary (.dict) file name
+    """
+    with open(fn, "w") as fh:
+        with open(os.path.expanduser(dictfile)) as dh:
+            for line in dh:
+                if line.startswith("@HD") or line.startswith("@SQ"):
+                    fh.write(line)
+        for iv in intervals:
+            fh.write("{}\t{}\t{}\t+\t{}\n".format(iv[0], iv[1], iv[2], format_interval(iv)))
+
+def sort_intervals(intervals, contigs):
+    """Sort intervals in reference order.
+
+    :param intervals: list of (contig, start, end) tuples
+    :param contigs: list of contig names in reference order
+
+    :returns: sorted list of intervals
+    """
+    order = dict((c, i) for i, c in enumerate(contigs))
+    return sorted(intervals, key=lambda x: (order.get(x[0], len(order)), x[1]))
+
+def partition_intervals(intervals, n, split=True):
+    """Partition a sorted list of intervals into at most n groups of
+    contiguous intervals with roughly equal total length.
+
+    :param intervals: list of (contig, start, end) tuples, in reference order
+    :param n: number of groups
+    :param split: allow intervals to be split between groups
+
+    :returns: list of interval lists
+    """
+    intervals = [x for x in intervals if x[2] is not None and x[2] >= x[1]]
+    total = sum(end - start + 1 for (_, start, end) in intervals)
+    n = max(1, min(int(n), total))
+    # Offset (exclusive) at which each group ends
+    bounds = [(k + 1) * total // n for k in range(n)]
+    groups = [[] for i in range(n)]
+    offset = 0
+    i = 0
+    for (contig, start, end) in intervals:
+        if not split:
+            mid = offset + (end - start + 1) // 2
+            while mid >= bounds[i] and i < n - 1:
+                i += 1
+            groups[i].append((contig, start, end))
+            offset += end - start + 1
+            continue
+        while start <= end:
+            while offset >= bounds[i]:
+                i += 1
+            length = min(end - start + 1, bounds[i] - offset)
+            groups[i].append((contig, start, start + length - 1))
+            offset += length
+            start += length
+    return [g for g in groups if g]
+
+def scatter_intervals(contigs, n, region=None, split=True):
+    """Scatter a reference, or a region of it, into at most n groups
+    of intervals of roughly equal total length.
+
+    :param contigs: list of (contig, length) tuples, in reference order
+    :param n: number of groups
+    :param region: interval file name or interval string to scatter; if None, scatter the whole reference
+    :param split: allow intervals to be split between groups. If False, and no region is given, groups consist of whole contigs.
+
+    :returns: list of interval lists
+    """
+    if region:
+        intervals = sort_intervals(region_intervals(region, contigs), [c for c, _ in contigs])
+    else:
+        intervals = [(c, 1, l) for c, l in contigs]
+    return partition_intervals(intervals, n, split=split)
@@ -14,6 +14,9 @@
 import random
 import sys
 import os
+import re
+import math
+import time
 import yaml
 from datetime import datetime
 import subprocess
@@ -25,6 +28,7 @@ from itertools import izip
 from luigi.task import flatten
 import ratatosk.shell as shell
 import ratatosk
+import ratatosk.priority
 from ratatosk.jobrunner import DefaultShellJobRunner, PipedJobRunner
 from ratatosk import backend
 from ratatosk.handler import RatatoskHandler, register_attr
@@ -82,6 +86,25 @@ class BaseJobTask(luigi.Task):
     use_target_names = luigi.Parameter(default=False, description="Use target names in graph visualization", is_boolean=True, is_global=True)
     """Use target names in graph visualization."""
 
+    critical_path = luigi.Parameter(default=True, is_global=True, is_boolean=True, description="Prioritize tasks by the expected runtime of the longest path to the final target")
+    """Prioritize tasks on the critical path. See :mod:`ratatosk.priority`."""
+
+    runtime_history = luigi.Parameter(default=None, is_global=True, description="File in which task runtimes are recorded. Historical runtimes are used to weight critical path priorities.")
+    """Runtime history file. If set, runtimes are recorded here and
+    used in preference to :attr:`.expected_runtime`."""
+
+    concurrent_jobs = luigi.Parameter(default=1, is_global=True, description="Number of jobs expected to run concurrently on a node. Used to share cores and memory between jobs when sizing tasks.")
+    """Number of concurrent jobs per node. See :mod:`ratatosk.resources`."""
+
+    capture_region = luigi.Parameter(default=None, is_global=True, description="Capture target interval file (bed or interval list). If set, tasks that support intervals are restricted to it.")
+    """Capture target region. Tasks that support intervals process
+    only this region, see e.g.
+    :meth:`ratatosk.lib.tools.gatk.GATKJobTask.region`."""
+
+    drop_off_target = luigi.Parameter(default=False, is_global=True, is_boolean=True, description="Drop reads outside capture_region in tasks that write reads and support intervals")
+    """Drop off-target reads. Tasks that write reads only write reads
+    in :attr:`.capture_region` if this is set."""
+
     label = luigi.Parameter(default=None)
     """Output label for this task. Used to generate target name. For
     instance, if source=file.txt, label=.label, and suffix=.txt, then
@@ -113,6 +136,10 @@ class BaseJobTask(luigi.Task):
     workers should be less than the memory of the computing
     resource."""
 
+    expected_runtime = 1
+    """Declared runtime (in minutes) of this task. Used to weight
+    critical path priorities in the absence of runtime history."""
+
     _handlers = {}
     """Handlers attached to a task"""
 
@@ -126,6 +153,9 @@ class BaseJobTask(luigi.Task):
     _target_iter = 0
     """Counter."""
 
+    _priority = None
+    """Critical path priority, set by :func:`ratatosk.priority.assign_priorities`."""
+
     def __init__(self, *args, **kwargs):
         """Initializes job task. A job task can be customized via
         configuration files. There are currently two configuration
@@ -155,6 +185,7 @@ class BaseJobTask(luigi.Task):
         """
         self._parent_cls = []
         self._handlers = {}
+        self._priority = None
         params = self.get_params()
         param_values = self.get_param_values(params, args, kwargs)
         param_values_dict = {x[0]:x[1] for x in self.get_param_values(params, args, kwargs)}
@@ -362,8 +393,34 @@ class BaseJobTask(luigi.Task):
     def run(self):
         """Init job runner.
         """
+        t0 = time.time()
         self.init_local()
         self.job_runner().run_job(self)
+        ratatosk.priority.record_runtime(self.runtime_history, self, time.time() - t0)
+
+    @property
+    def priority(self):
+        """Task priority. Corresponds to the expected runtime of the
+        longest path from this task to the final target."""
+        return self._priority or 0
+
+    def deps(self):
+        """Task dependencies, as used by the scheduler. If
+        :attr:`.critical_path` is set, priorities are assigned to the
+        whole task graph the first time this is called, and
+        dependencies are ordered so that the worker, which adds tasks
+        from a stack, schedules the dependency with the highest
+        priority first."""
+        deps = super(BaseJobTask, self).deps()
+        if not self.critical_path:
+            return deps
+        if self._priority is None:
+            try:
+                ratatosk.priority.assign_priorities(self, self.runtime_history)
+            except:
+                logger.warn("Failed to assign critical path priorities for task {}".format(self))
+                self._priority = 0
+        return sorted(deps, key=lambda x: getattr(x, "priority", 0))
 
     def parent(self):
         """Parent task class(es). List of tuples consisting of
@@ -449,6 +506,12 @@ class BaseJobTask(luigi.Task):
         else:
             return [self._make_source_file_name(p) for p in self.parent()]
 
+    def source_target(self):
+        """Target from which source file names are generated. Override
+        for tasks whose target names don't follow the label and suffix
+        conventions, e.g. shards of a scattered task."""
+        return self.target
+
     def _make_source_file_name(self, parent_cls, diff_label=None, add_label=None):
         """Make source file name for parent tasks. Uses parent_cls to
         get parent class suffix (i.e. source suffix as viewed
@@ -467,7 +530,7 @@ class BaseJobTask(luigi.Task):
         src_label = parent_cls().label
         tgt_suffix = self.suffix
         src_suffix = parent_cls().suffix
-        target = self.target
+        target = self.source_target()
         if isinstance(self.target, tuple) or isinstance(self.target, list):
             target = self.target[self._target_iter]
             self._target_iter += 1
@@ -509,9 +572,63 @@ class JobTask(BaseJobTask):
     def args(self):
         return []
 
+class JavaJobTask(JobTask):
+    """Job task for programs that run in a java virtual machine. JVM
+    options are derived from the resource reservation of the task:
+    unless set in java_options, the max heap size (-Xmx) is a fraction
+    :attr:`.java_heap_fraction` of max_memory_gb, leaving room for
+    memory used outside the heap, and the number of garbage collection
+    threads equals the number of task threads. If java_options sets
+    the heap size, max_memory() is raised to match, so that the
+    reservation seen by the scheduler is consistent with the JVM."""
+    java_exe = luigi.Parameter(default="java")
+    java_options = luigi.Parameter(default=(), description="Java options", is_list=True)
+    java_tmpdir = luigi.Parameter(default=None, description="Temporary directory of the java virtual machine")
+
+    java_heap_fraction = 0.8
+    """Fraction of max_memory_gb used for the java heap."""
+
+    def java(self):
+        return self.java_exe
+
+    def _java_option_heap_mb(self):
+        """Get heap size in Mb set in java_options, or None"""
+        for x in self.java_options:
+            m = re.match(r'^-Xmx([0-9]+)([kKmMgG]?)$', x)
+            if m:
+                unit = {"k" : 1.0 / 1024, "m" : 1, "g" : 1024, "" : 1.0 / 1024 ** 2}[m.group(2).lower()]
+                return int(int(m.group(1)) * unit)
+        return None
+
+    def heap_size(self):
+        """Get max java heap size in Mb"""
+        heap = self._java_option_heap_mb()
+        if heap:
+            return heap
+        return max(1, int(self.max_memory_gb * self.java_heap_fraction)) * 1024
+
+    def max_memory(self):
+        heap = self._java_option_heap_mb()
+        if heap:
+            return max(self.max_memory_gb, int(math.ceil(heap / 1024.0 / self.java_heap_fraction)))
+        return self.max_memory_gb
+
+    def java_opt(self):
+        retval = list(self.java_options)
+        if not any(x.startswith("-Xmx") for x in retval):
+            heap = self.heap_size()
+            retval.insert(0, "-Xmx{}g".format(heap // 1024) if heap % 1024 == 0 else "-Xmx{}m".format(heap))
+        if not any(x.startswith("-XX:ParallelGCThreads") for x in retval):
+            retval.append("-XX:ParallelGCThreads={}".format(self.threads()))
+        if self.java_tmpdir and not any(x.startswith("-Djava.io.tmpdir") for x in retval):
+            retval.append("-Djava.io.tmpdir={}".format(self.java_tmpdir))
+        return retval
+
 class InputJobTask(JobTask):
     """Input job task. Should have as a parent task one of the tasks
     in ratatosk.lib.files.external"""
+    expected_runtime = 0
+
     def requires(self):
         cls = self.parent()[0]
         return cls(target=self.target)
@@ -522,6 +639,8 @@ class InputJobTask(JobTask):
 
 class JobWrapperTask(JobTask):
     """Wrapper task that adds target by default"""
+    expected_runtime = 0
+
     def complete(self):
         return all(r.complete() for r in flatten(self.requires()))
 
@@ -530,6 +649,8 @@ class JobWrapperTask(JobTask):
 
 class NullJobTask(JobTask):
     """Task that always completes"""
+    expected_runtime = 0
+
     def run(self):
         pass
 
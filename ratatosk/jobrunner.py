@@ -14,6 +14,9 @@
 import random
 import sys
 import os
+import time
+import signal
+import tempfile
 import yaml
 from datetime import datetime
 import subprocess
@@ -101,16 +104,167 @@ class DefaultShellJobRunner(JobRunner):
         (stdout, stderr, returncode) = shell.exec_cmd(cmd, shell=True)
         if returncode == 0:
             logger.info("Shell job completed")
-            for a, b in tmp_files:
-                logger.info("renaming {0} to {1}".format(a.path, b.path))
-                # This is weird; using the example in luigi
-                # (a.move(b)) doesn't work, and using just b.path
-                # fails unless it contains a directory (e.g. './file'
-                # works, 'file' doesn't)
-                a.move(os.path.join(os.curdir, b.path))
+            self._move_tmp_files(tmp_files)
         else:
             raise Exception("Job '{}' failed: \n{}".format(' '.join(arglist), " ".join([stderr])))
-                
+
+    def _move_tmp_files(self, tmp_files):
+        """Move temporary output files to their final destinations.
+
+        :param tmp_files: list of (temporary target, target) tuples
+        """
+        for a, b in tmp_files:
+            logger.info("renaming {0} to {1}".format(a.path, b.path))
+            # This is weird; using the example in luigi
+            # (a.move(b)) doesn't work, and using just b.path
+            # fails unless it contains a directory (e.g. './file'
+            # works, 'file' doesn't)
+            a.move(os.path.join(os.curdir, b.path))
+            self._move_index_file(a, b)
+
+    def _move_index_file(self, a, b):
+        """Move a bam index written alongside a temporary bam file to
+        the index of the final bam file (file.bai). Depending on the
+        program, the index of a temporary file file.bam-luigi-tmp-XXX
+        is written as file.bam-luigi-tmp-XXX.bai or, with the
+        extension stripped, directly as file.bai.
+
+        :param a: temporary target
+        :param b: target
+        """
+        if not b.path.endswith(".bam"):
+            return
+        baifile = rreplace(b.path, ".bam", ".bai", 1)
+        for fn in [a.path + ".bai", os.path.splitext(a.path)[0] + ".bai"]:
+            if fn != baifile and os.path.exists(fn):
+                logger.info("renaming {0} to {1}".format(fn, baifile))
+                os.rename(fn, baifile)
+
+    def _remove_tmp_files(self, tmp_files):
+        """Remove temporary output files, e.g. after a failed or
+        killed job.
+
+        :param tmp_files: list of (temporary target, target) tuples
+        """
+        for a, b in tmp_files:
+            for fn in [a.path, a.path + ".bai", a.path + ".idx"]:
+                if os.path.exists(fn):
+                    logger.info("removing temporary file {0}".format(fn))
+                    os.unlink(fn)
+
+class SpeculativeShellJobRunner(DefaultShellJobRunner):
+    """Job runner for shards of a split task, e.g.
+    :class:`ratatosk.lib.tools.gatk.SplitUnifiedGenotyper`. Shards
+    of a task live in the same directory and record their runtimes in
+    a hidden subdirectory. If a shard runs longer than
+    job.speculative_multiple times the median runtime of its finished
+    siblings, a duplicate job writing to separate temporary files is
+    launched. The output of the job that finishes first is kept,
+    whereas the other job is killed and its temporary output
+    discarded. Running jobs are likewise killed if the runner is
+    interrupted or fails.
+    """
+    poll_interval = 10
+    """Maximum interval (in seconds) between checks of job status"""
+
+    min_poll_interval = 0.1
+    """Interval (in seconds) before the first check of job status; the interval is doubled after every check up to poll_interval"""
+
+    min_finished = 3
+    """Minimum number of finished siblings required to estimate median runtime"""
+
+    runtime_dir = ".ratatosk-runtimes"
+    """Name of directory in which shard runtimes are recorded"""
+
+    def __init__(self):
+        pass
+
+    def _runtime_file(self, job):
+        return os.path.join(os.path.dirname(os.path.abspath(job.target)), self.runtime_dir, os.path.basename(job.target))
+
+    def _record_runtime(self, job, runtime):
+        runtime_file = self._runtime_file(job)
+        if not os.path.exists(os.path.dirname(runtime_file)):
+            os.makedirs(os.path.dirname(runtime_file))
+        with open(runtime_file, "w") as fh:
+            fh.write("{:.1f}\n".format(runtime))
+
+    def _sibling_median(self, job):
+        """Get median runtime of finished siblings, or None if too few
+        siblings have finished"""
+        runtime_file = self._runtime_file(job)
+        if not os.path.exists(os.path.dirname(runtime_file)):
+            return None
+        runtimes = []
+        for fn in os.listdir(os.path.dirname(runtime_file)):
+            if fn == os.path.basename(runtime_file):
+                continue
+            try:
+                with open(os.path.join(os.path.dirname(runtime_file), fn)) as fh:
+                    runtimes.append(float(fh.read().strip()))
+            except (IOError, ValueError):
+                continue
+        if len(runtimes) < self.min_finished:
+            return None
+        runtimes.sort()
+        n = len(runtimes)
+        return (runtimes[(n - 1) // 2] + runtimes[n // 2]) / 2.0
+
+    def _launch(self, arglist):
+        """Launch a job in its own process group so that it can be
+        killed along with its children."""
+        cmd = ' '.join(arglist)
+        logger.info("\nJob runner '{0}';\n\trunning command '{1}'\n".format(self.__class__, cmd))
+        stderr = tempfile.TemporaryFile()
+        proc = Popen(cmd, stderr=stderr, shell=True, preexec_fn=os.setsid)
+        return (proc, stderr, time.time())
+
+    def _kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        proc.wait()
+
+    def run_job(self, job):
+        (arglist, tmp_files) = self._make_arglist(job)
+        attempts = [(arglist, tmp_files) + self._launch(arglist)]
+        speculated = False
+        interval = min(self.min_poll_interval, self.poll_interval)
+        try:
+            while attempts:
+                for attempt in list(attempts):
+                    (arglist, tmp_files, proc, stderr, t0) = attempt
+                    if proc.poll() is None:
+                        continue
+                    attempts.remove(attempt)
+                    if proc.returncode == 0:
+                        logger.info("Shell job completed")
+                        self._move_tmp_files(tmp_files)
+                        self._record_runtime(job, time.time() - t0)
+                        return
+                    self._remove_tmp_files(tmp_files)
+                    if not attempts:
+                        stderr.seek(0)
+                        raise Exception("Job '{}' failed: \n{}".format(' '.join(arglist), stderr.read()))
+                if not speculated and attempts:
+                    median = self._sibling_median(job)
+                    elapsed = time.time() - attempts[0][4]
+                    if median is not None and elapsed > float(job.speculative_multiple) * median:
+                        logger.info("Job '{}' has run for {:.0f}s, more than {} times the median runtime {:.0f}s of its siblings; launching speculative duplicate".format(job, elapsed, job.speculative_multiple, median))
+                        (arglist, tmp_files) = self._make_arglist(job)
+                        attempts.append((arglist, tmp_files) + self._launch(arglist))
+                        speculated = True
+                if attempts:
+                    time.sleep(interval)
+                    interval = min(2 * interval, self.poll_interval)
+        finally:
+            # Jobs still running lost the race, or the runner was
+            # interrupted; kill them and discard their output
+            for (_, tmp_files, proc, _, _) in attempts:
+                logger.info("killing running attempt of job '{}'".format(job))
+                self._kill(proc)
+                self._remove_tmp_files(tmp_files)
 
 # Aaarrgh - it doesn't get uglier than this. Some programs
 # "seamlessly" read and write gzipped files. In the job runner we work
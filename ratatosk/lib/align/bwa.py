@@ -18,13 +18,16 @@ Wrapper library for `bwa <http://bio-bwa.sourceforge.net/>`_.
 Classes
 --------
 """
+import os
 import re
 import luigi
 from itertools import izip
 import ratatosk.lib.files.input
-from ratatosk.job import JobTask, JobWrapperTask, DefaultShellJobRunner, PipedTask
-from ratatosk.lib.tools.samtools import SamToBam
-from ratatosk.utils import rreplace, fullclassname, determine_read_type
+from ratatosk.job import JobTask, JobWrapperTask, InputJobTask, DefaultShellJobRunner, PipedTask
+from ratatosk.jobrunner import JobRunner
+from ratatosk.lib.tools.samtools import SamToBam, SamtoolsJobTask
+from ratatosk.lib.files.fastq import split_fastq
+from ratatosk.utils import rreplace, fullclassname, determine_read_type, shard_target, sibling_shard_target, unscattered_target
 
 class InputFastqFile(ratatosk.lib.files.input.InputFastqFile):
     pass
@@ -50,6 +53,7 @@ class BwaJobTask(JobTask):
 
 class Aln(BwaJobTask):
     sub_executable = "aln"
+    expected_runtime = 60
     parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.InputFastqFile",))
     suffix = luigi.Parameter(default=".sai")
     read1_suffix = luigi.Parameter(default="_R1_001")
@@ -100,6 +104,7 @@ class BwaAlnWrapperTask(JobWrapperTask):
 
 class Sampe(BwaJobTask):
     sub_executable = "sampe"
+    expected_runtime = 30
     add_label = luigi.Parameter(default=("_R1_001", "_R2_001"), is_list=True)
     suffix = luigi.Parameter(default=".sam")
     read_group = luigi.Parameter(default=None)
@@ -114,6 +119,9 @@ class Sampe(BwaJobTask):
             cls = self.parent()[0]
             sai1 = self.input()[0]
             rgid = rreplace(rreplace(sai1.path, cls().sfx(), "", 1), self.add_label[0], "", 1)
+            # Chunks of a lane share the read group of the lane
+            if os.path.dirname(rgid).endswith("-scatter"):
+                rgid = unscattered_target(rgid)
             smid = rgid
             # Get sample information if present in global vars. Note
             # that this requires the
@@ -139,16 +147,86 @@ class Sampe(BwaJobTask):
         return ["-r", self._get_read_group(), self.bwaref, self.input()[0].path, self.input()[1].path, fastq1, fastq2, ">", self.output()]
 
 class Bampe(PipedTask):
+    expected_runtime = 40
     add_label = luigi.Parameter(default=("_R1_001", "_R2_001"), is_list=True)
     parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.Aln", "ratatosk.lib.align.bwa.Aln"), is_list=True)
     suffix = luigi.Parameter(default=".bam")
     read_group = luigi.Parameter(default=None)
     platform = luigi.Parameter(default="Illumina")
-    can_multi_thread = False
+    # bwa sampe is single-threaded; threads go to bam compression
+    can_multi_thread = True
     max_memory_gb = 6 # bwa documentation says ~5.4 for human genome
 
     def args(self):
-        return [Sampe(target=self.target.replace(".bam", ".sam"), pipe=True), SamToBam(target=self.target, pipe=True)]
+        return [Sampe(target=self.target.replace(".bam", ".sam"), pipe=True), SamToBam(target=self.target, pipe=True, num_threads=self.threads())]
+
+class SplitFastqJobRunner(JobRunner):
+    def run_job(self, job):
+        split_fastq(job.input()[0].path, [x.path for x in job.output()])
+
+class SplitFastq(JobTask):
+    """Split a fastq file into scatter_count chunks, in a single pass.
+    The target is the first chunk; chunks of {base}_R1_001.fastq.gz
+    are named {base}-scatter/{base}.{index}_R1_001.fastq.gz."""
+    expected_runtime = 10
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.InputFastqFile",), is_list=True)
+    suffix = luigi.Parameter(default=".fastq.gz")
+    scatter_count = luigi.Parameter(default=4, description="Number of chunks")
+
+    def job_runner(self):
+        return SplitFastqJobRunner()
+
+    def requires(self):
+        cls = self.parent()[0]
+        return [cls(target=unscattered_target(self.target))]
+
+    def output(self):
+        return [luigi.LocalTarget(sibling_shard_target(self.target, i)) for i in range(int(self.scatter_count))]
+
+class FastqChunk(InputJobTask):
+    """Chunk of a fastq file, written by :class:`SplitFastq`"""
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.SplitFastq",), is_list=True)
+    suffix = luigi.Parameter(default=".fastq.gz")
+    scatter_count = luigi.Parameter(default=4, description="Number of chunks")
+
+    def requires(self):
+        cls = self.parent()[0]
+        return cls(target=sibling_shard_target(self.target, 0), scatter_count=self.scatter_count)
+
+class AlnChunk(Aln):
+    """Align a chunk of a fastq file"""
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.FastqChunk",), is_list=True)
+    scatter_count = luigi.Parameter(default=4, description="Number of chunks")
+
+    def requires(self):
+        return [cls(target=source, scatter_count=self.scatter_count) for cls, source in izip(self.parent(), self.source())]
+
+class BampeChunk(Bampe):
+    """Align a chunk of a read pair to bam"""
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.AlnChunk", "ratatosk.lib.align.bwa.AlnChunk"), is_list=True)
+    scatter_count = luigi.Parameter(default=4, description="Number of chunks")
+
+    def requires(self):
+        return [cls(target=source, scatter_count=self.scatter_count) for cls, source in izip(self.parent(), self.source())]
+
+class BampeScatterGather(SamtoolsJobTask):
+    """Align a read pair in chunks and concatenate the chunk bam
+    files to the lane bam file with samtools cat. The fastq files are
+    split into scatter_count chunks, which are aligned independently
+    by the parent task, by default :class:`BampeChunk`. Chunk bam
+    files are kept, so that a failed chunk is rerun on its own, and
+    carry the read group of the lane."""
+    sub_executable = "cat"
+    expected_runtime = 5
+    parent_task = luigi.Parameter(default=("ratatosk.lib.align.bwa.BampeChunk",), is_list=True)
+    scatter_count = luigi.Parameter(default=4, description="Number of chunks")
+
+    def requires(self):
+        cls = self.parent()[0]
+        return [cls(target=shard_target(self.target, self.sfx(), i), scatter_count=self.scatter_count) for i in range(int(self.scatter_count))]
+
+    def args(self):
+        return ["-o", self.output()] + self.input()
 
 class Index(BwaJobTask):
     sub_executable = "index"
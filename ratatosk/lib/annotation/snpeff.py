@@ -24,7 +24,7 @@ import luigi
 import logging
 import ratatosk.lib.files.input
 from ratatosk.utils import rreplace, fullclassname
-from ratatosk.job import JobTask, JobWrapperTask
+from ratatosk.job import JobTask, JobWrapperTask, JavaJobTask
 from ratatosk.jobrunner import  DefaultShellJobRunner
 from ratatosk.log import get_logger
 import ratatosk.shell as shell
@@ -72,16 +72,14 @@ class snpEffJobRunner(DefaultShellJobRunner):
         else:
             raise Exception("Job '{}' failed: \n{}".format(cmd, " ".join([stderr])))
 
-class snpEffJobTask(JobTask):
+class snpEffJobTask(JavaJobTask):
     _snpeff_default_home = os.getenv("SNPEFF_HOME") if os.getenv("SNPEFF_HOME") else os.curdir
     exe_path = luigi.Parameter(default=_snpeff_default_home)
     executable = luigi.Parameter(default="snpEff.jar")
-    java_exe = luigi.Parameter(default="java")
     source_suffix = luigi.Parameter(default=".vcf")
     target_suffix = luigi.Parameter(default=".vcf")
     snpeff_config = luigi.Parameter(default=os.path.join(_snpeff_default_home, "snpEff.config"))
     genome = luigi.Parameter(default="GRCh37.64")
-    java_options = luigi.Parameter(default=("-Xmx2g",), description="Java options", is_list=True)
 
     def jar(self):
         return self.executable
@@ -89,12 +87,6 @@ class snpEffJobTask(JobTask):
     def exe(self):
         return self.jar()
 
-    def java(self):
-        return self.java_exe
-
-    def java_opt(self):
-        return list(self.java_options)
-
     def job_runner(self):
         return snpEffJobRunner()
 
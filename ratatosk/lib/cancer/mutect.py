@@ -24,7 +24,7 @@ import luigi
 import logging
 import ratatosk.lib.files.input
 from ratatosk.utils import rreplace, fullclassname
-from ratatosk.job import JobTask, DefaultShellJobRunner
+from ratatosk.job import JobTask, JavaJobTask, DefaultShellJobRunner
 from ratatosk.log import get_logger
 import ratatosk.shell as shell
 
@@ -52,13 +52,11 @@ class MutectJobRunner(DefaultShellJobRunner):
         arglist += job_args
         return (arglist, tmp_files)
 
-class MutectJobTask(JobTask):
+class MutectJobTask(JavaJobTask):
     exe_path = luigi.Parameter(default=os.getenv("MUTECT_HOME") if os.getenv("MUTECT_HOME") else os.curdir)
     executable = luigi.Parameter(default="muTect.jar")
     source_suffix = luigi.Parameter(default=".bam")
     target_suffix = luigi.Parameter(default=".bam")
-    java_exe = luigi.Parameter(default="java")
-    java_options = luigi.Parameter(default=("-Xmx2g",), description="Java options", is_list=True)
     parent_task = luigi.Parameter(default="ratatosk.lib.tools.gatk.InputBamFile")
     ref = luigi.Parameter(default=None)
     can_multi_thread = True
@@ -69,12 +67,6 @@ class MutectJobTask(JobTask):
     def exe(self):
         return self.jar()
 
-    def java_opt(self):
-        return list(self.java_options)
-
-    def java(self):
-        return self.java_exe
-
     def job_runner(self):
         return MutectJobRunner()
 
@@ -20,13 +20,63 @@ Classes
 """
 
 import os
+import gzip
+import random
 import luigi
+from itertools import izip
 import ratatosk.lib.files.external
 from ratatosk.job import JobTask
 from ratatosk.log import get_logger
 
 logger = get_logger()
 
+def split_fastq(fastqfile, outfiles, compresslevel=1):
+    """Split a fastq file into chunks, assigning reads to chunks in
+    turn. Read pairs stay paired when both mate files are split into
+    the same number of chunks. Chunks are written to temporary files
+    that are renamed once all reads have been written.
+
+    :param fastqfile: fastq file name, optionally gzipped
+    :param outfiles: chunk file names; chunks ending in .gz are gzipped
+    :param compresslevel: gzip compression level of chunks
+
+    :returns: number of reads
+    """
+    tmpfiles = [x + '-luigi-tmp-%09d' % random.randrange(0, 1e10) for x in outfiles]
+    for outdir in set(os.path.dirname(x) for x in outfiles):
+        if outdir and not os.path.exists(outdir):
+            os.makedirs(outdir)
+    handles = [gzip.open(tmp, "wb", compresslevel) if fn.endswith(".gz") else open(tmp, "w") for tmp, fn in izip(tmpfiles, outfiles)]
+    n = 0
+    try:
+        fh = gzip.open(fastqfile) if fastqfile.endswith(".gz") else open(fastqfile)
+        try:
+            record = []
+            for line in fh:
+                record.append(line)
+                if len(record) < 4:
+                    continue
+                if not record[0].startswith("@"):
+                    raise Exception("{} is not a fastq file: read {} starts with '{}'".format(fastqfile, n + 1, record[0].rstrip()))
+                handles[n % len(handles)].write("".join(record))
+                record = []
+                n += 1
+            if record:
+                raise Exception("{} is truncated after read {}".format(fastqfile, n))
+        finally:
+            fh.close()
+        for h in handles:
+            h.close()
+        for tmp, fn in izip(tmpfiles, outfiles):
+            os.rename(tmp, fn)
+    finally:
+        for h, tmp in izip(handles, tmpfiles):
+            h.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    logger.info("Split {} reads of {} into {} chunks".format(n, fastqfile, len(outfiles)))
+    return n
+
 class FastqFileLink(JobTask):
     outdir = luigi.Parameter(default=os.curdir)
     # This is tricky: it is easy enough to make links based on
@@ -20,22 +20,28 @@ Classes
 """
 import os
 import re
+import hashlib
 import luigi
 from itertools import izip
+from ratatosk import backend
 import ratatosk.lib.files.input
 import ratatosk.lib.tools.samtools
-from ratatosk.utils import rreplace, fullclassname
-from ratatosk.job import JobTask
-from ratatosk.jobrunner import DefaultShellJobRunner
+from ratatosk.utils import rreplace, fullclassname, shard_target, gather_target
+from ratatosk.job import JavaJobTask
+from ratatosk.jobrunner import JobRunner, DefaultShellJobRunner, SpeculativeShellJobRunner
 from ratatosk.log import get_logger
 from ratatosk.handler import RatatoskHandler, register_task_handler
+from ratatosk.interval import write_intervals, region_intervals, interval_length, UNMAPPED
+import ratatosk.reference
+import ratatosk.bam
+import ratatosk.priority
+import ratatosk.resources
+import ratatosk.sites
+import ratatosk.vcf
+import ratatosk.filtration
+import ratatosk.evaluation
 import ratatosk.shell as shell
 
-try:
-    import pysam
-except:
-    pass
-
 logger = get_logger()
 
 class InputBamFile(ratatosk.lib.files.input.InputBamFile):
@@ -44,6 +50,11 @@ class InputBamFile(ratatosk.lib.files.input.InputBamFile):
 class InputVcfFile(ratatosk.lib.files.input.InputVcfFile):
     pass
 
+# Scatter partitions, keyed by (task class name, gathered target,
+# scatter count). A partition must stay fixed while the workflow runs,
+# even if e.g. the bam index used to plan it appears.
+_scatter_partitions = {}
+
 class GATKJobRunner(DefaultShellJobRunner):
     @staticmethod
     def _get_main(job):
@@ -63,37 +74,104 @@ class GATKJobRunner(DefaultShellJobRunner):
         arglist += job_args
         return (arglist, tmp_files)
 
+    def _move_tmp_files(self, tmp_files):
+        for a, b in tmp_files:
+            logger.info("renaming {0} to {1}".format(a.path, b.path))
+            # TODO : this should be relpath?
+            a.move(os.path.join(os.curdir, b.path))
+            # Some GATK programs generate bai or idx files on the fly...
+            self._move_index_file(a, b)
+            if os.path.exists(a.path + ".idx"):
+                logger.info("Saw {} file".format(a.path + ".idx"))
+                os.rename(a.path + ".idx", b.path + ".idx")
+
+class SpeculativeGATKJobRunner(SpeculativeShellJobRunner, GATKJobRunner):
+    """GATK job runner with speculative re-execution of straggling
+    shards."""
+    pass
+
+class NativeSelectVariantsJobRunner(JobRunner):
+    """Job runner that selects variants in-process, in a single pass
+    of the input, see :func:`ratatosk.vcf.split_variants`."""
     def run_job(self, job):
-        (arglist, tmp_files) = self._make_arglist(job)
-        cmd = ' '.join(arglist)        
-        logger.info("\nJob runner '{0}';\n\trunning command '{1}'".format(self.__class__, cmd))
-        (stdout, stderr, returncode) = shell.exec_cmd(cmd, shell=True)
-        if returncode == 0:
-            logger.info("Shell job completed")
-            for a, b in tmp_files:
-                logger.info("renaming {0} to {1}".format(a.path, b.path))
-                # TODO : this should be relpath?
-                a.move(os.path.join(os.curdir, b.path))
-                # Some GATK programs generate bai or idx files on the fly...
-                if os.path.exists(a.path + ".bai"):
-                    logger.info("Saw {} file".format(a.path + ".bai"))
-                    os.rename(a.path + ".bai", b.path.replace(".bam", ".bai"))
-                if os.path.exists(a.path + ".idx"):
-                    logger.info("Saw {} file".format(a.path + ".idx"))
-                    os.rename(a.path + ".idx", b.path + ".idx")
-        else:
-            raise Exception("Job '{}' failed: \n{}".format(cmd, " ".join([stderr])))
+        if job.output().exists():
+            logger.info("{} already written by a split task".format(job.output().path))
+            return
+        outputs = [(job.variant_types(), job.output().path)]
+        for task in job.split_tasks():
+            if not task.output().exists():
+                outputs.append((task.variant_types(), task.output().path))
+        intervals = None
+        if job.region():
+            intervals = region_intervals(job.region(), ratatosk.reference.contig_lengths(job.ref) if job.ref else [])
+        ratatosk.vcf.split_variants(job.input()[0].path, outputs, intervals)
+
+class NativeVariantFiltrationJobRunner(JobRunner):
+    """Job runner that hard filters variants in-process, see
+    :func:`ratatosk.filtration.filter_variants`."""
+    def run_job(self, job):
+        intervals = None
+        if job.region():
+            intervals = region_intervals(job.region(), ratatosk.reference.contig_lengths(job.ref) if job.ref else [])
+        ratatosk.filtration.filter_variants(job.input()[0].path, job.output().path, intervals=intervals,
+                                            **ratatosk.filtration.filter_options(job.opts()))
+
+class NativeVariantEvalJobRunner(JobRunner):
+    """Job runner that evaluates variants in-process, see
+    :mod:`ratatosk.evaluation`."""
+    def run_job(self, job):
+        (intervals, processed_loci) = (None, 0)
+        if job.region():
+            intervals = region_intervals(job.region(), ratatosk.reference.contig_lengths(job.ref) if job.ref else [])
+            processed_loci = interval_length(intervals)
+        elif job.ref:
+            processed_loci = ratatosk.reference.genome_length(job.ref)
+        tables = ratatosk.evaluation.evaluate_variants(job.input()[0].path, job.sites(job.dbsnp) if job.dbsnp else None,
+                                                       intervals=intervals, processed_loci=processed_loci)
+        tmpfile = job.output().path + ".tmp"
+        ratatosk.evaluation.write_report(tables, tmpfile)
+        ratatosk.evaluation.write_table(tables, job.table_file())
+        os.rename(tmpfile, job.output().path)
+
+class GATKGatherJobRunner(GATKJobRunner):
+    """Job runner for gathering the shard outputs of a scattered
+    GATK task. The command is given by the job's gather_cmd."""
+    def _make_arglist(self, job):
+        arglist = job.gather_cmd()
+        (tmp_files, job_args) = DefaultShellJobRunner._fix_paths(job)
+        arglist += job_args
+        return (arglist, tmp_files)
 
-class GATKJobTask(JobTask):
+class GATKJobTask(JavaJobTask):
     exe_path = luigi.Parameter(default=os.getenv("GATK_HOME") if os.getenv("GATK_HOME") else os.curdir)
     executable = luigi.Parameter(default="GenomeAnalysisTK.jar")
     suffix = luigi.Parameter(default=".bam")
-    java_exe = luigi.Parameter(default="java")
-    java_options = luigi.Parameter(default=("-Xmx2g",), description="Java options", is_list=True)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputBamFile",), is_list=True)
     ref = luigi.Parameter(default=None)
     # Additional commonly used options
     target_region = luigi.Parameter(default=None)
+    speculative = luigi.Parameter(default=False, is_boolean=True, description="Launch a duplicate of a straggling shard and keep the output of whichever finishes first")
+    speculative_multiple = luigi.Parameter(default=2.0, description="Launch speculative duplicate when a shard has run longer than this multiple of the median runtime of its siblings")
+    scatter_count = luigi.Parameter(default=1, description="Number of shards to scatter task over")
+    scatter_index = luigi.Parameter(default=None, description="Index of the shard processed by this task")
+    auto_threads = luigi.BooleanParameter(default=False, description="Choose data (-nt) and cpu (-nct) thread counts from node resources, concurrent_jobs and runtime history")
+    scatter_by = luigi.Parameter(default="length", description="Scatter mode: 'length' for equally long shards, 'reads' for shards with equal numbers of mapped reads, as estimated from the bam index. The partition is planned when shard tasks are scheduled and is then kept for the run, so 'reads' only applies if the bam index exists at scheduling time; a bam file generated in the same run is scattered by length.")
+    subset_known_sites = luigi.BooleanParameter(default=True, description="Use cached copies of known sites resources restricted to the region of the walker")
+
+    # Restrict walker to target_region, if set
+    use_target_region = False
+
+    known_sites_params = ()
+    """Names of parameters that hold known sites resources"""
+
+    data_threads = False
+    """Flag to indicate whether the walker supports data threads (-nt)"""
+
+    cpu_threads = False
+    """Flag to indicate whether the walker supports cpu threads (-nct)"""
+
+    data_thread_memory_gb = 1
+    """Memory needed per data thread"""
 
     def jar(self):
         return self.executable
@@ -101,15 +179,229 @@ class GATKJobTask(JobTask):
     def exe(self):
         return self.jar()
 
-    def java_opt(self):
-        return list(self.java_options)
+    def gatk_threads(self):
+        """Get data (-nt) and cpu (-nct) thread counts. If
+        auto_threads is set, thread counts are chosen with
+        :func:`ratatosk.resources.gatk_threads`. Otherwise, walkers
+        that can multi-thread use num_threads data threads.
+
+        :returns: tuple (nt, nct), where unused options are None
+        """
+        if not self.auto_threads:
+            return (self.num_threads, None) if self.can_multi_thread else (None, None)
+        if not self.data_threads and not self.cpu_threads:
+            return (None, None)
+        history = ratatosk.priority.read_runtime_history(self.runtime_history)
+        return ratatosk.resources.gatk_threads(self.data_threads, self.cpu_threads, self.max_memory(),
+                                               self.data_thread_memory_gb, concurrent_jobs=self.concurrent_jobs,
+                                               runtimes=history.get(fullclassname(self.__class__)))
+
+    def threads(self):
+        if self.auto_threads:
+            (nt, nct) = self.gatk_threads()
+            return (nt or 1) * (nct or 1)
+        return super(GATKJobTask, self).threads()
+
+    def opts(self):
+        retval = list(self.options)
+        (nt, nct) = self.gatk_threads()
+        if nt:
+            retval.append("-nt {}".format(nt))
+        if nct:
+            retval.append("-nct {}".format(nct))
+        return retval
 
-    def java(self):
-        return self.java_exe
+    def is_shard(self):
+        """Return True if this task processes a shard (region) of its
+        input, as part of a split task."""
+        return self.scatter_index is not None
 
     def job_runner(self):
+        if self.speculative and self.is_shard():
+            return SpeculativeGATKJobRunner()
         return GATKJobRunner()
 
+    def source_target(self):
+        """Shards of a scattered task generate sources from the
+        gathered target, see :func:`shard_target`."""
+        if self.scatter_index is not None:
+            return gather_target(self.target, self.sfx())
+        return self.target
+
+    def scatter_partition(self):
+        """Partition the reference, or :meth:`region` if set, into at
+        most scatter_count groups of intervals. Tasks that output bam
+        files are scattered by whole contigs, since reads overlapping
+        a split point would be written by both shards, and an
+        additional shard processes the unmapped reads.
+
+        If scatter_by is set to reads, and the input bam file is
+        indexed, groups have roughly equal numbers of mapped reads
+        (see :func:`ratatosk.bam.plan_shards`), and otherwise equal
+        lengths. The partition is fixed the first time it is
+        computed, which is when the shard tasks are scheduled: if the
+        input bam file is generated in the same run, its index does
+        not exist yet and the groups have equal lengths.
+
+        :returns: list of interval lists
+        """
+        key = (self.__class__.__name__, self.source_target(), int(self.scatter_count))
+        if key in _scatter_partitions:
+            return _scatter_partitions[key]
+        if not self.ref:
+            raise Exception("need reference for scatter-gather")
+        region = self.region()
+        split = self.sfx() != ".bam"
+        partition = []
+        if self.scatter_by == "reads":
+            bamfiles = [x for x in self.source() if x.endswith(".bam")]
+            baifile = ratatosk.bam.find_index(bamfiles[0]) if bamfiles else None
+            if baifile:
+                partition = ratatosk.bam.plan_shards(baifile, ratatosk.reference.contig_lengths(self.ref), self.scatter_count, region=region, split=split)
+            else:
+                logger.warn("No bam index for {}; scattering by length".format(self))
+        if not partition:
+            partition = ratatosk.reference.partition(self.ref, self.scatter_count, region=region, split=split)
+        if not split:
+            partition += [[(UNMAPPED, None, None)]]
+        _scatter_partitions[key] = partition
+        return partition
+
+    def shard_intervals(self):
+        """Get the intervals processed by this shard"""
+        return self.scatter_partition()[int(self.scatter_index)]
+
+    def shard_interval_file(self):
+        """Get the name of the interval file of this shard"""
+        return rreplace(self.target, self.sfx(), ".scatter.intervals", 1)
+
+    def region(self):
+        """Get the region the walker is restricted to: target_region if
+        use_target_region is set, and otherwise capture_region.
+        Walkers that write reads only write reads in the region, and
+        are therefore only restricted to capture_region if
+        drop_off_target is set.
+
+        :returns: interval file name or interval string, or None
+        """
+        if self.use_target_region and self.target_region:
+            return self.target_region
+        if self.capture_region and (self.sfx() != ".bam" or self.drop_off_target):
+            return self.capture_region
+        return None
+
+    def interval_opts(self):
+        """Interval (-L) options. Shards are restricted to their
+        intervals, other tasks to :meth:`region`."""
+        if self.scatter_index is not None:
+            if self.shard_intervals() == [(UNMAPPED, None, None)]:
+                return ["-L", UNMAPPED]
+            return ["-L", self.shard_interval_file()]
+        if self.region():
+            return ["-L", self.region()]
+        return []
+
+    def known_sites(self):
+        """Get the known sites resources of the walker, as given by
+        the parameters in :attr:`known_sites_params`"""
+        retval = []
+        for param in self.known_sites_params:
+            value = getattr(self, param)
+            if isinstance(value, tuple) or isinstance(value, list):
+                retval += [x for x in value if x]
+            elif value:
+                retval.append(value)
+        return retval
+
+    def sites(self, resource):
+        """Get the file to use for a known sites resource. If
+        subset_known_sites is set and the walker is restricted to a
+        region, this is a cached copy of the resource restricted to
+        the region (see :mod:`ratatosk.sites`).
+
+        :param resource: known sites vcf file name
+
+        :returns: vcf file name
+        """
+        if not self.subset_known_sites or not self.region() or not self.ref:
+            return resource
+        if not os.path.exists(os.path.expanduser(resource)):
+            return resource
+        return ratatosk.sites.subset_file(os.path.expanduser(resource), self.region())
+
+    def init_local(self):
+        if self.scatter_index is not None:
+            if not os.path.exists(os.path.dirname(self.target)):
+                os.makedirs(os.path.dirname(self.target))
+            intervals = self.shard_intervals()
+            if intervals != [(UNMAPPED, None, None)]:
+                write_intervals(intervals, self.shard_interval_file())
+        for resource in self.known_sites():
+            if self.sites(resource) != resource:
+                ratatosk.sites.subset(os.path.expanduser(resource), self.region(), ratatosk.reference.contig_lengths(self.ref))
+
+class GATKScatterGatherTask(GATKJobTask):
+    """Scatter a GATK walker, given by the parent task, over
+    intervals and gather the shard outputs. Shards are run with -L
+    restricted to a partition of the reference, or of target_region
+    for walkers that use it, in roughly equally sized groups of
+    intervals (see :func:`ratatosk.interval.scatter_intervals`).
+
+    Shard outputs are gathered depending on suffix: vcf files with
+    CatVariants, bam files with samtools cat, BQSR reports with
+    GatherBqsrReports and intervals files by concatenation. The
+    default gatherers are those of GATK 3.4 or later
+    (org.broadinstitute.gatk); earlier versions lack GatherBqsrReports.
+
+    Subclasses should set label and suffix to those of the walker.
+    """
+    expected_runtime = 5
+    scatter_count = luigi.Parameter(default=4, description="Number of shards to scatter task over")
+    samtools = luigi.Parameter(default="samtools", description="samtools executable, used to gather bam files")
+    vcf_gatherer = luigi.Parameter(default="org.broadinstitute.gatk.tools.CatVariants", description="Class used to gather vcf files")
+    bqsr_gatherer = luigi.Parameter(default="org.broadinstitute.gatk.tools.GatherBqsrReports", description="Class used to gather BQSR reports")
+
+    def walker(self):
+        """Get the (unscattered) walker task"""
+        return self.parent()[0](target=self.target, scatter_count=self.scatter_count, scatter_by=self.scatter_by)
+
+    def requires(self):
+        cls = self.parent()[0]
+        n = len(self.walker().scatter_partition())
+        return [cls(target=shard_target(self.target, self.sfx(), i), scatter_index=i, scatter_count=self.scatter_count, scatter_by=self.scatter_by) for i in range(n)]
+
+    def job_runner(self):
+        return GATKGatherJobRunner()
+
+    def gather_cmd(self):
+        """Get the gather command, excluding input and output arguments"""
+        walker = self.walker()
+        java = [walker.java()] + walker.java_opt() + ['-cp', os.path.join(walker.path(), walker.jar())]
+        if self.sfx() == ".vcf":
+            if not walker.ref:
+                raise Exception("need reference for gathering vcf files")
+            return java + [self.vcf_gatherer, "-R", walker.ref, "-assumeSorted"]
+        elif self.sfx() == ".bam":
+            return [self.samtools, "cat"]
+        elif self.sfx().endswith(".grp"):
+            return java + [self.bqsr_gatherer]
+        return ["cat"]
+
+    def args(self):
+        if self.sfx() == ".vcf":
+            retval = []
+            for x in self.input():
+                retval += ["-V", x]
+            return retval + ["-out", self.output()]
+        elif self.sfx() == ".bam":
+            return ["-o", self.output()] + self.input()
+        elif self.sfx().endswith(".grp"):
+            retval = []
+            for x in self.input():
+                retval += ["I=", x]
+            return retval + ["O=", self.output()]
+        return self.input() + [">", self.output()]
+
 
 class GATKIndexedJobTask(GATKJobTask):
     """Similar to GATKJobTask, with the only difference that these
@@ -130,16 +422,18 @@ class GATKIndexedJobTask(GATKJobTask):
 
 class RealignerTargetCreator(GATKIndexedJobTask):
     sub_executable = "RealignerTargetCreator"
+    expected_runtime = 20
+    use_target_region = True
+    data_threads = True
     known = luigi.Parameter(default=(), is_list=True)
+    known_sites_params = ("known", )
     suffix = luigi.Parameter(default=".intervals")
     can_multi_thread = True
 
     def opts(self):
-        retval = list(self.options)
-        retval.append("-nt {}".format(self.num_threads))
-        if self.target_region:
-            retval.append("-L {}".format(self.target_region))
-        retval.append(" ".join(["-known {}".format(x) for x in self.known]))
+        retval = super(RealignerTargetCreator, self).opts()
+        retval += self.interval_opts()
+        retval.append(" ".join(["-known {}".format(self.sites(x)) for x in self.known]))
         return retval
 
     def args(self):
@@ -151,7 +445,9 @@ class RealignerTargetCreator(GATKIndexedJobTask):
 
 class IndelRealigner(GATKIndexedJobTask):
     sub_executable = "IndelRealigner"
+    expected_runtime = 60
     known = luigi.Parameter(default=(), is_list=True)
+    known_sites_params = ("known", )
     label = luigi.Parameter(default=".realign")
     parent_task = luigi.Parameter(default=('ratatosk.lib.tools.gatk.InputBamFile',
                                            'ratatosk.lib.tools.gatk.RealignerTargetCreator',
@@ -159,8 +455,9 @@ class IndelRealigner(GATKIndexedJobTask):
                                            ), is_list=True)
 
     def opts(self):
-        retval = list(self.options)
-        retval += ["{}".format(" ".join(["-known {}".format(x) for x in self.known]))]
+        retval = super(IndelRealigner, self).opts()
+        retval += self.interval_opts()
+        retval += ["{}".format(" ".join(["-known {}".format(self.sites(x)) for x in self.known]))]
         return retval
 
     def args(self):
@@ -176,13 +473,16 @@ class IndelRealigner(GATKIndexedJobTask):
 
 class BaseRecalibrator(GATKIndexedJobTask):
     sub_executable = "BaseRecalibrator"
+    expected_runtime = 60
+    use_target_region = True
+    cpu_threads = True
     knownSites = luigi.Parameter(default=(), is_list=True)
+    known_sites_params = ("knownSites", )
     suffix = luigi.Parameter(default=".recal_data.grp")
 
     def opts(self):
-        retval = list(self.options)
-        if self.target_region:
-            retval += ["-L {}".format(self.target_region)]
+        retval = super(BaseRecalibrator, self).opts()
+        retval += self.interval_opts()
         return retval
 
     def args(self):
@@ -192,16 +492,23 @@ class BaseRecalibrator(GATKIndexedJobTask):
         if not self.knownSites:
             raise Exception("need knownSites to run BaseRecalibrator")
         retval += ["-R", self.ref]
-        retval += [" ".join([" -knownSites {}".format(x) for x in self.knownSites])]
+        retval += [" ".join([" -knownSites {}".format(self.sites(x)) for x in self.knownSites])]
         return retval
 
 class PrintReads(GATKJobTask):
     sub_executable = "PrintReads"
+    expected_runtime = 60
+    cpu_threads = True
     parent_task = luigi.Parameter(default=('ratatosk.lib.tools.gatk.InputBamFile',
                                            'ratatosk.lib.tools.gatk.BaseRecalibrator'), is_list=True)
     label = luigi.Parameter(default=".recal")
     suffix = luigi.Parameter(default=(".bam",), is_list=True)
 
+    def opts(self):
+        retval = super(PrintReads, self).opts()
+        retval += self.interval_opts()
+        return retval
+
     def args(self):
         retval = ["-I", self.input()[0], "-o", self.output()]
         if len(self.input()) > 1:
@@ -212,35 +519,64 @@ class PrintReads(GATKJobTask):
         return retval
 
 class ClipReads(GATKJobTask):
+    """ClipReads. If a second parent task is given, typically
+    :class:`.BaseRecalibrator`, its recalibration table is applied
+    with -BQSR while clipping, so that recalibrated reads are written
+    in the same pass and the :class:`.PrintReads` output is not
+    needed.
+    """
     sub_executable = "ClipReads"
+    expected_runtime = 30
     # Tailored for HaloPlex
     options = luigi.Parameter(default=("--cyclesToTrim 1-5 --clipRepresentation WRITE_NS",), is_list=True)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputBamFile", ), is_list=True)
     label = luigi.Parameter(default=".clip")
 
+    def opts(self):
+        retval = super(ClipReads, self).opts()
+        retval += self.interval_opts()
+        return retval
+
     def args(self):
         retval = ["-I", self.input()[0], "-o", self.output()]
+        if len(self.input()) > 1:
+            retval += ["-BQSR", self.input()[1]]
         if not self.ref:
             raise Exception("need reference for ClipReads")
         retval += ["-R", self.ref]
         return retval
 
 class VariantEval(GATKJobTask):
+    """Evaluate variants. If native is set, variants are evaluated
+    in-process and the results are also written as a tab-separated
+    table."""
     sub_executable = "VariantEval"
+    use_target_region = True
+    data_threads = True
     options = luigi.Parameter(default=("-ST Filter -l INFO --doNotUseAllStandardModules --evalModule CompOverlap --evalModule CountVariants --evalModule GenotypeConcordance --evalModule TiTvVariantEvaluator --evalModule ValidationReport --stratificationModule Filter",), is_list=True)
     dbsnp = luigi.Parameter(default=None)
+    known_sites_params = ("dbsnp", )
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputVcfFile", ), is_list=True)
     suffix = luigi.Parameter(default=".eval_metrics")
+    native = luigi.BooleanParameter(default=False, description="Evaluate variants in-process, without starting GATK. Computes CompOverlap, CountVariants and TiTvVariantEvaluator tables only.")
+
+    def job_runner(self):
+        if self.native:
+            return NativeVariantEvalJobRunner()
+        return super(VariantEval, self).job_runner()
+
+    def table_file(self):
+        """Get the name of the tab-separated table written by a native
+        run, see :func:`ratatosk.evaluation.write_table`"""
+        return os.path.splitext(self.output().path)[0] + ".eval_table"
 
     def opts(self):
-        retval = list(self.options)
+        retval = super(VariantEval, self).opts()
         # TODO: Sort this one out
         if not self.dbsnp:
             raise Exception("need dbsnp for VariantEval")
-        retval += ["--dbsnp", self.dbsnp]
-        # TODO: This too
-        if self.target_region:
-            retval += ["-L", self.target_region]
+        retval += ["--dbsnp", self.sites(self.dbsnp)]
+        retval += self.interval_opts()
         return retval
     
     def args(self):
@@ -252,6 +588,8 @@ class VariantEval(GATKJobTask):
 
 class VariantAnnotator(GATKJobTask):
     sub_executable = "VariantAnnotator"
+    use_target_region = True
+    data_threads = True
     options = luigi.Parameter(default=("",), is_list=True)
     dbsnp = luigi.Parameter(default=None)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputVcfFile", ), is_list=True)
@@ -265,9 +603,8 @@ class VariantAnnotator(GATKJobTask):
                    "QualByDepth", "ReadPosRankSumTest", "RMSMappingQuality"]
 
     def opts(self):
-        retval = list(self.options)
-        if self.target_region:
-            retval += ["-L {}".format(self.target_region)]
+        retval = super(VariantAnnotator, self).opts()
+        retval += self.interval_opts()
         return retval
     
     def args(self):
@@ -298,19 +635,22 @@ class VariantSnpEffAnnotator(VariantAnnotator):
         
 class UnifiedGenotyper(GATKIndexedJobTask):
     sub_executable = "UnifiedGenotyper"
+    expected_runtime = 30
+    use_target_region = True
+    data_threads = True
+    cpu_threads = True
     options = luigi.Parameter(default=("-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_VARIANTS_ONLY -glm BOTH",), is_list=True)
     suffix = luigi.Parameter(default=".vcf")
     dbsnp = luigi.Parameter(default=None)
+    known_sites_params = ("dbsnp", )
     #label = luigi.Parameter(default=".RAW")?
     can_multi_thread = True
 
     def opts(self):
-        retval = list(self.options)
-        retval += ["-nt {}".format(self.num_threads)]
-        if self.target_region:
-            retval += ["-L {}".format(self.target_region)]
+        retval = super(UnifiedGenotyper, self).opts()
+        retval += self.interval_opts()
         if self.dbsnp:
-            retval += ["--dbsnp", self.dbsnp]
+            retval += ["--dbsnp", self.sites(self.dbsnp)]
         return retval
 
     def args(self):
@@ -348,10 +688,59 @@ class UnifiedGenotyperAlleles(UnifiedGenotyper):
         retval = super(UnifiedGenotyperAlleles, self).args() + ['--alleles', self.input()[1]]
         return retval
 
+class UnifiedGenotyperAllelesBatch(UnifiedGenotyperAlleles):
+    """Genotype a batch of samples at given alleles in one
+    UnifiedGenotyper invocation, thereby reading the reference, the
+    alleles and known sites once per batch instead of once per
+    sample. The output is a multi-sample vcf file.
+
+    The batch consists of the targets of per-sample genotyping tasks,
+    given by :meth:`sample_task`, whose requirements are bam file,
+    alleles vcf file and optionally bam index. Memory usage grows with
+    the number of samples in a batch, so java_options may need
+    adjusting.
+    """
+    sample_targets = luigi.Parameter(default=(), is_list=True, description="Targets of the per-sample genotyping tasks in this batch")
+    alleles = luigi.Parameter(default=None, description="Alleles vcf file, generated by the second parent task. If None, use the alleles of the per-sample genotyping tasks")
+
+    def sample_task(self, target):
+        """Get the per-sample genotyping task for a target"""
+        return UnifiedGenotyperAlleles(target=target)
+
+    def requires(self):
+        tasks = [self.sample_task(tgt) for tgt in self.sample_targets]
+        if not tasks:
+            return []
+        bams = [t.requires()[0] for t in tasks]
+        indices = [x for t in tasks for x in t.requires()[2:]]
+        if self.alleles:
+            alleles = self.parent()[1](target=self.alleles)
+        else:
+            alleles = tasks[0].requires()[1]
+        return [alleles] + bams + indices
+
+    def args(self):
+        retval = []
+        for x in self.input()[1:len(self.sample_targets) + 1]:
+            retval += ["-I", x]
+        retval += ["-o", self.output(), "--alleles", self.input()[0]]
+        if not self.ref:
+            raise Exception("need reference for UnifiedGenotyper")
+        retval += ["-R", self.ref]
+        return retval
+
 class SplitUnifiedGenotyper(UnifiedGenotyper):
     # Label should be same as calling function (often CombineVariants)
     label = luigi.Parameter(default="-variants")
     suffix = luigi.Parameter(default=(".vcf", ), is_list=True)
+
+    def is_shard(self):
+        return True
+
+    def init_local(self):
+        if not os.path.exists(os.path.dirname(self.target)):
+            os.makedirs(os.path.dirname(self.target))
+        super(SplitUnifiedGenotyper, self).init_local()
     
     def _make_source_file_name(self, parent_cls):
         """Assume pattern is {base}-split/{base}-{ref}{ext}, as in
@@ -368,14 +757,31 @@ class CombineVariants(GATKJobTask):
     Generic task for combining variants from variant files. Input can
     be tasks that generate vcf files, or output from
     :func:`.target_generator_handler`.
+
+    If merge_fan_in is set, and there are more input files than
+    merge_fan_in, files are combined in a tree of merges in which each
+    node combines at most merge_fan_in files. Nodes on the same level
+    run in parallel, and intermediate files are written to
+    {base}-merge/{base}.L{level}.{index}{suffix}. Subclasses should
+    generate their input tasks in :meth:`leaf_tasks`.
     """
     sub_executable = "CombineVariants"
+    data_threads = True
     suffix = luigi.Parameter(default=".vcf")
     label = luigi.Parameter(default="-variants")
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputVcfFile",), is_list=True)
     target_generator_handler = luigi.Parameter(default=None)
+    merge_fan_in = luigi.Parameter(default=0, description="Max number of files combined per merge. If set, input files are combined in a tree of merges.")
+    merge_level = luigi.Parameter(default=None, description="Level of this task in the merge tree")
+    merge_index = luigi.Parameter(default=None, description="Index of this task on its level in the merge tree")
 
-    def requires(self):
+    def opts(self):
+        retval = super(CombineVariants, self).opts()
+        retval += self.interval_opts()
+        return retval
+
+    def leaf_tasks(self):
+        """Tasks that generate the files to combine"""
         if self.target_generator_handler:
             cls = self.parent()[0]
             sources = []
@@ -387,6 +793,55 @@ class CombineVariants(GATKJobTask):
         else:
             return [cls(target=source) for cls, source in izip(self.parent(), self.source())]
 
+    def sorted_leaf_tasks(self):
+        """Leaf tasks in merge order, by default sorted by target"""
+        return sorted(self.leaf_tasks(), key=lambda x: str(x.target))
+
+    def _merge_task(self, target, level, index):
+        """Copy of this task with a new target and merge tree position"""
+        params = dict(self.get_params())
+        kwargs = dict((k, v) for k, v in self.param_kwargs.items() if not params[k].is_global)
+        kwargs.update(target=target, merge_level=level, merge_index=index)
+        return self.__class__(**kwargs)
+
+    def merge_root(self):
+        """Get the root task of the merge tree"""
+        if self.merge_level is None:
+            return self
+        target = rreplace(os.path.dirname(self.target), "-merge", "", 1) + self.sfx()
+        return self._merge_task(target, None, None)
+
+    def merge_node(self, level, index):
+        """Get a node task of the merge tree"""
+        base = rreplace(self.merge_root().target, self.sfx(), "", 1)
+        target = os.path.join("{}-merge".format(base), "{}.L{}.{:04d}{}".format(os.path.basename(base), level, index, self.sfx()))
+        return self._merge_task(target, level, index)
+
+    def requires(self):
+        fan_in = int(self.merge_fan_in)
+        if self.merge_level is None and fan_in < 2:
+            return self.leaf_tasks()
+        leaves = self.merge_root().sorted_leaf_tasks()
+        # Number of tasks on each level of the tree; the top level
+        # is combined by the root
+        sizes = [len(leaves)]
+        while fan_in > 1 and sizes[-1] > fan_in:
+            sizes.append((sizes[-1] + fan_in - 1) // fan_in)
+        if self.merge_level is None:
+            level = len(sizes) - 1
+            (start, end) = (0, sizes[level])
+        else:
+            level = int(self.merge_level) - 1
+            (start, end) = (int(self.merge_index) * fan_in, min((int(self.merge_index) + 1) * fan_in, sizes[level]))
+        if level == 0:
+            return leaves[start:end]
+        return [self.merge_node(level, i) for i in range(start, end)]
+
+    def init_local(self):
+        if self.merge_level is not None and not os.path.exists(os.path.dirname(self.target)):
+            os.makedirs(os.path.dirname(self.target))
+        super(CombineVariants, self).init_local()
+
     def args(self):
         retval = []
         for x in self.input():
@@ -408,30 +863,20 @@ class CombineSplitVariants(CombineVariants):
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.SplitUnifiedGenotyper", ), is_list=True)
     split_by = luigi.Parameter(default="chromosome", description="Splitting mode")
 
-    def requires(self):
+    def sorted_leaf_tasks(self):
+        """Leaf tasks are already in reference order"""
+        return self.leaf_tasks()
+
+    def leaf_tasks(self):
         cls = self.parent()[0]
-        bamcls = self.parent()[0]().parent()[0]
         source = self.source()[0]
         if self.split_by == "chromosome":
-            # Partition sources by chromosome. Need to get the
-            # references from the source bam file, i.e. the source to
-            # the parent task
-            bamfile = rreplace(source, self.sfx(), bamcls().sfx(), 1)
-            if os.path.exists(bamfile):
-                samfile = pysam.Samfile(bamfile, "rb")
-                refs = samfile.references
-                samfile.close()
-            elif os.path.exists(os.path.expanduser(self.ref)):
-                dictfile = os.path.expanduser(os.path.splitext(self.ref)[0] + ".dict")
-                with open(dictfile) as fh:
-                    seqdict = [x for x in fh.readlines() if x.startswith("@SQ")]
-                m = [re.search(r'SN:([a-zA-z0-9]+)', x) for x in seqdict]
-                refs = [x.group(1) for x in m]
+            # Partition sources by chromosome, as given by the
+            # reference
+            if self.ref and os.path.exists(os.path.expanduser(self.ref)):
+                refs = ratatosk.reference.contigs(self.ref)
             else:
                 return []
-            outdir = "{base}-split".format(base=os.path.splitext(self.target)[0])
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
             split_targets = [os.path.join("{base}-split".format(base=os.path.splitext(self.target)[0]), 
                                           "{base}-{ref}{ext}".format(base=os.path.splitext(os.path.basename(self.target))[0], ref=chr_ref, ext=self.sfx())) for chr_ref in refs]
             return [cls(target=tgt, target_region=chr_ref) for tgt, chr_ref in izip(split_targets, refs)]
@@ -439,7 +884,15 @@ class CombineSplitVariants(CombineVariants):
             return [cls(target=source)]
 
 class SelectVariants(GATKJobTask):
+    """Select variants by type. If native is set, variants are
+    selected in-process, without starting GATK. A native task also
+    writes the outputs of the tasks returned by :meth:`split_tasks`
+    that are native and select from the same input, so that these
+    are generated in the same pass of the input and complete when
+    scheduled. Native selection implements selectType and the region
+    only; a task with options runs GATK instead."""
     sub_executable = "SelectVariants"
+    data_threads = True
     suffix = luigi.Parameter(default=".vcf")
     label = luigi.Parameter(default="-all")
     selectType = luigi.Parameter(default=("--selectTypeToInclude", "SNP", 
@@ -449,6 +902,53 @@ class SelectVariants(GATKJobTask):
                                           "--selectTypeToInclude", "SYMBOLIC",
                                           "--selectTypeToInclude", "NO_VARIATION"), is_list=True)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.UnifiedGenotyper", ), is_list=True)
+    native = luigi.BooleanParameter(default=False, description="Select variants in-process, in a single pass of the input shared with the split tasks")
+
+    def job_runner(self):
+        if self.native_selection():
+            return NativeSelectVariantsJobRunner()
+        return super(SelectVariants, self).job_runner()
+
+    def native_selection(self):
+        """Check whether variants are selected in-process. Options,
+        e.g. -select or --excludeFiltered, are not implemented by the
+        native selection, and a task with options runs GATK."""
+        if not self.native:
+            return False
+        options = [x for x in self.options if str(x).strip()]
+        if options:
+            logger.warn("Native SelectVariants does not implement options {}; running GATK for {}".format(options, self.target))
+            return False
+        return True
+
+    def variant_types(self):
+        """Get the variant types given by selectType"""
+        return [y for x, y in izip(self.selectType[:-1], self.selectType[1:]) if x in ["--selectTypeToInclude", "-selectType"]]
+
+    def split_classes(self):
+        """Get the classes of tasks that split the same input"""
+        return []
+
+    def split_tasks(self):
+        """Get the native tasks of :meth:`split_classes` that select
+        from the same input. Targets are named as the target of this
+        task, with label replaced by the label of the task."""
+        retval = []
+        if not self.native_selection() or not self.label or not self.label in self.target:
+            return retval
+        for cls in self.split_classes():
+            label = cls().label
+            if not label:
+                continue
+            task = cls(target=rreplace(self.target, self.label, label, 1))
+            if task.native_selection() and task.source() == self.source():
+                retval.append(task)
+        return retval
+
+    def opts(self):
+        retval = super(SelectVariants, self).opts()
+        retval += self.interval_opts()
+        return retval
 
     def args(self):
         retval = [x for x in self.selectType]
@@ -462,6 +962,9 @@ class SelectSnpVariants(SelectVariants):
     label = luigi.Parameter(default="-snp")
     selectType = luigi.Parameter(default=("--selectTypeToInclude", "SNP"), is_list=True)
 
+    def split_classes(self):
+        return [SelectIndelVariants]
+
 class SelectIndelVariants(SelectVariants):
     label = luigi.Parameter(default="-indel")
     selectType = luigi.Parameter(default=("--selectTypeToInclude", "INDEL",
@@ -470,6 +973,243 @@ class SelectIndelVariants(SelectVariants):
                                           "--selectTypeToInclude", "SYMBOLIC",
                                           "--selectTypeToInclude", "NO_VARIATION"), is_list=True)
 
+    def split_classes(self):
+        return [SelectSnpVariants]
+
+# Incremental cohort genotyping
+#
+# A cohort vcf is generated by genotyping all samples at the sites of
+# a master vcf, the union of the variant calls of the samples. The
+# samples of a cohort vcf are recorded in {cohort}.samples, so that
+# samples added to a project can be added to the cohort incrementally.
+#
+def read_cohort_samples(cohort):
+    """Read the samples of a cohort vcf.
+
+    :param cohort: cohort vcf file name
+
+    :returns: list of sample prefixes, or None if the samples of the cohort are unknown
+    """
+    if not os.path.exists(cohort + ".samples"):
+        return None
+    with open(cohort + ".samples") as fh:
+        return [x.strip() for x in fh if x.strip()]
+
+def write_cohort_samples(cohort, samples):
+    """Write the samples of a cohort vcf.
+
+    :param cohort: cohort vcf file name
+    :param samples: list of sample prefixes
+    """
+    with open(cohort + ".samples", "w") as fh:
+        fh.write("".join("{}\n".format(x) for x in samples))
+
+def sample_prefixes():
+    """Get the sample prefixes of the targets registered by a pipeline"""
+    return sorted(set(x.prefix("sample") for x in backend.__global_vars__.get("targets", [])))
+
+def new_cohort_samples(cohort, master):
+    """Get the samples that are not in a cohort vcf.
+
+    :param cohort: cohort vcf file name
+    :param master: master vcf file name
+
+    :returns: list of sample prefixes, or None if the cohort vcf, its samples or the master vcf are missing
+    """
+    old = read_cohort_samples(cohort)
+    if old is None or not os.path.exists(cohort) or not os.path.exists(master):
+        return None
+    return [x for x in sample_prefixes() if x not in set(old)]
+
+def cohort_update_target(master, samples):
+    """Get the name of an updated master vcf, {base}-update-{id}{ext},
+    where id is derived from the samples added to the master.
+
+    :param master: master vcf file name
+    :param samples: list of sample prefixes
+
+    :returns: updated master vcf file name
+    """
+    (base, ext) = os.path.splitext(master)
+    return "{}-update-{}{}".format(base, hashlib.md5("\n".join(sorted(samples))).hexdigest()[:8], ext)
+
+def genotype_batch_target(base, sample_targets):
+    """Get the name of a batch genotype vcf, {base}-genotype-batch-{id}.vcf,
+    where id is derived from the sample targets of the batch, so that
+    a batch with other samples gets another name.
+
+    :param base: file name base
+    :param sample_targets: list of genotype targets of the samples in the batch
+
+    :returns: batch vcf file name
+    """
+    return "{}-genotype-batch-{}.vcf".format(base, hashlib.md5("\n".join(sorted(sample_targets))).hexdigest()[:8])
+
+class UpdateMasterVariants(CombineVariants):
+    """Add the variant calls of samples that are new to a cohort vcf
+    to the master vcf. The variant calls of the new samples are
+    selected among the inputs of the :class:`.CombineVariants` task
+    that generates the master vcf. The target is named as given by
+    :func:`cohort_update_target`, in the directory of the master and
+    cohort vcf files.
+    """
+    master = luigi.Parameter(default="CombinedVariants.vcf", description="Master vcf file name")
+    cohort = luigi.Parameter(default="CombinedVariantsAll.vcf", description="Cohort vcf file name")
+    options = luigi.Parameter(default=(), is_list=True, description="Options of the update; the options of the master CombineVariants task are not used")
+
+    def master_task(self):
+        """Get the task that generates the master vcf"""
+        return CombineVariants(target=os.path.join(os.path.dirname(self.target), self.master))
+
+    def leaf_tasks(self):
+        master = self.master_task()
+        samples = new_cohort_samples(os.path.join(os.path.dirname(self.target), self.cohort), master.target) or []
+        calls = [x for x in master.leaf_tasks() if any(str(x.target).startswith(p + ".") for p in samples)]
+        return [InputVcfFile(target=master.target)] + calls
+
+class SelectNovelSites(SelectVariants):
+    """Select the sites of an updated master vcf that are not in the
+    master vcf it was updated from."""
+    label = luigi.Parameter(default="-novel")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.UpdateMasterVariants", ), is_list=True)
+
+    def requires(self):
+        update = self.parent()[0](target=rreplace(self.target, self.label, "", 1))
+        return [update, InputVcfFile(target=os.path.join(os.path.dirname(self.target), update.master))]
+
+    def args(self):
+        retval = ['--variant', self.input()[0], '--discordance', self.input()[1], '--out', self.output()]
+        if not self.ref:
+            raise Exception("need reference for SelectVariants")
+        retval += ["-R", self.ref]
+        return retval
+
+class CombineCohortVariants(CombineVariants):
+    """Combine samples genotyped at the sites of a master vcf into a
+    cohort vcf. Subclasses define the genotype target of a sample in
+    :meth:`genotype_target`, and the genotyping tasks in
+    :meth:`genotype_task` and :meth:`genotype_batch_task`.
+
+    If incremental is set and the cohort vcf exists, samples that are
+    new to the cohort are genotyped at the sites of an updated master
+    vcf (:class:`.UpdateMasterVariants`), and samples already in the
+    cohort are genotyped only at the sites that are new to the master
+    (:class:`.SelectNovelSites`). The cohort vcf is then updated by
+    combining it with the new genotypes, and the updated master vcf
+    replaces the master vcf. As the cohort vcf is also an input, the
+    combined variants are written to :meth:`update_target` and renamed
+    to the cohort vcf once CombineVariants has finished. Nodes of the
+    merge tree are named by their position only, so an incremental
+    update combines its inputs directly, without a merge tree. A cohort
+    vcf without a record of its samples (:func:`read_cohort_samples`)
+    is complete, as if incremental was not set.
+    """
+    batch_size = luigi.Parameter(default=1, description="Number of samples to genotype per UnifiedGenotyper invocation. If larger than 1, multi-sample batch vcf files are combined.")
+    incremental = luigi.BooleanParameter(default=False, description="Genotype only samples and sites that are new to an existing cohort vcf")
+
+    def genotype_target(self, sample):
+        """Get the genotype target of a sample prefix"""
+        raise NotImplementedError
+
+    def genotype_task(self, target):
+        """Get the task that genotypes a sample at the master vcf sites"""
+        raise NotImplementedError
+
+    def genotype_batch_task(self, target, sample_targets, **kwargs):
+        """Get the task that genotypes a batch of samples"""
+        raise NotImplementedError
+
+    def master_target(self):
+        return os.path.join(os.path.dirname(self.merge_root().target), UpdateMasterVariants().master)
+
+    def new_samples(self):
+        """Get the samples that are new to the cohort if the cohort vcf
+        is updated incrementally, otherwise None"""
+        if not self.incremental:
+            return None
+        return new_cohort_samples(self.merge_root().target, self.master_target())
+
+    def update_target(self):
+        """Get the file the cohort vcf is written to when it is updated
+        incrementally, or None if the cohort vcf is generated from
+        scratch or this is a node of the merge tree"""
+        new = self.new_samples() if self.merge_level is None else None
+        return cohort_update_target(self.target, new) if new else None
+
+    def genotype_batches(self, base, targets, **kwargs):
+        n = max(1, int(self.batch_size))
+        return [self.genotype_batch_task(genotype_batch_target(base, targets[i:i + n]), targets[i:i + n], **kwargs) for i in range(0, len(targets), n)]
+
+    def leaf_tasks(self):
+        samples = sample_prefixes()
+        new = self.new_samples()
+        if new:
+            update = cohort_update_target(self.master_target(), new)
+            novel = rreplace(update, ".vcf", SelectNovelSites().label + ".vcf", 1)
+            old_targets = [self.genotype_target(x) for x in samples if x not in new]
+            new_targets = [self.genotype_target(x) for x in new]
+            return ([InputVcfFile(target=self.merge_root().target)] +
+                    self.genotype_batches(os.path.splitext(update)[0], new_targets, alleles=update,
+                                          parent_task=("ratatosk.lib.tools.gatk.InputBamFile", "ratatosk.lib.tools.gatk.UpdateMasterVariants")) +
+                    self.genotype_batches(os.path.splitext(novel)[0], old_targets, alleles=novel,
+                                          parent_task=("ratatosk.lib.tools.gatk.InputBamFile", "ratatosk.lib.tools.gatk.SelectNovelSites")))
+        targets = [self.genotype_target(x) for x in samples]
+        if int(self.batch_size) > 1:
+            return self.genotype_batches(os.path.splitext(self.master_target())[0], targets)
+        return [self.genotype_task(tgt) for tgt in targets]
+
+    def requires(self):
+        if self.update_target():
+            # Merge tree nodes of the previous build would be taken for complete
+            return self.leaf_tasks()
+        return super(CombineCohortVariants, self).requires()
+
+    def complete(self):
+        if not super(CombineCohortVariants, self).complete():
+            return False
+        if self.incremental and self.merge_level is None:
+            samples = read_cohort_samples(self.target)
+            if samples is None:
+                # Cohort vcf generated before its samples were
+                # recorded; it cannot be updated incrementally
+                logger.warn("No samples recorded for cohort vcf {}; not updating it".format(self.target))
+                return True
+            return set(sample_prefixes()) <= set(samples)
+        return True
+
+    def opts(self):
+        retval = super(CombineCohortVariants, self).opts()
+        if self.incremental and not any([re.search("genotypeMergeOptions", x) for x in retval]):
+            retval += ["-genotypeMergeOptions", "UNSORTED"]
+        return retval
+
+    def args(self):
+        retval = super(CombineCohortVariants, self).args()
+        update = self.update_target()
+        if update:
+            retval[retval.index("-o") + 1] = luigi.LocalTarget(update)
+        return retval
+
+    def run(self):
+        new = self.new_samples() if self.merge_level is None else None
+        cohort_update = self.update_target()
+        if cohort_update and os.path.exists(cohort_update):
+            # Left over from a failed run; must not be taken for an input
+            os.unlink(cohort_update)
+        super(CombineCohortVariants, self).run()
+        if self.merge_level is not None:
+            return
+        if cohort_update:
+            os.rename(cohort_update, self.target)
+            if os.path.exists(cohort_update + ".idx"):
+                os.rename(cohort_update + ".idx", self.target + ".idx")
+            elif os.path.exists(self.target + ".idx"):
+                os.unlink(self.target + ".idx")
+        update = cohort_update_target(self.master_target(), new) if new else None
+        if update and os.path.exists(update):
+            os.rename(update, self.master_target())
+        write_cohort_samples(self.target, sample_prefixes())
+
 # Variant recalibration
 #
 # This section has many different tasks, tailored for various best practice settings
@@ -478,12 +1218,18 @@ class VariantRecalibrator(GATKJobTask):
     """Generic VariantRecalibrator task from which specialized
     recalibration tasks inherit"""
     sub_executable = "VariantRecalibrator"
+    data_threads = True
     label = luigi.Parameter(default=None)
     mode = luigi.Parameter(default="BOTH")
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.InputVcfFile", ), is_list=True)
     suffix = luigi.Parameter(default=(".tranches", ".recal"), is_list=True)
     options = luigi.Parameter(default=())
 
+    def opts(self):
+        retval = super(VariantRecalibrator, self).opts()
+        retval += self.interval_opts()
+        return retval
+
     def output(self):
         if isinstance(self.suffix, tuple):
             return [luigi.LocalTarget(rreplace(self.target, self.suffix[0], x, 1)) for x in self.suffix]
@@ -508,6 +1254,7 @@ class VariantSnpRecalibrator(VariantRecalibrator):
     train_hapmap = luigi.Parameter(default=None)
     train_1000g_omni = luigi.Parameter(default=None)
     dbsnp = luigi.Parameter(default=None)
+    known_sites_params = ("train_hapmap", "train_1000g_omni", "dbsnp")
     options = luigi.Parameter(default=( 
                               "-an", "QD",
                               "-an", "HaplotypeScore",
@@ -517,18 +1264,18 @@ class VariantSnpRecalibrator(VariantRecalibrator):
                               "-an", "MQ",
                               "-an", "DP"), is_list=True)
     def opts(self):
-        retval = list(self.options)
+        retval = super(VariantSnpRecalibrator, self).opts()
         if not self.train_hapmap and not self.train_1000g_omni:
             raise Exception("need training file for VariantSnp")
         if self.train_hapmap:
             retval += ["-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0",
-                       self.train_hapmap]
+                       self.sites(self.train_hapmap)]
         if self.train_1000g_omni:
             retval += ["-resource:omni,VCF,known=false,training=true,truth=false,prior=12.0",
-                       self.train_1000g_omni]
+                       self.sites(self.train_1000g_omni)]
         if self.dbsnp:
             retval += ["-resource:dbsnp,VCF,known=true,training=false,truth=false,prior=8.0",
-                       self.dbsnp]
+                       self.sites(self.dbsnp)]
         return retval
 
 class VariantSnpRecalibratorExome(VariantSnpRecalibrator):
@@ -565,6 +1312,7 @@ class VariantIndelRecalibrator(VariantRecalibrator):
     label = luigi.Parameter(default=None)
     mode = luigi.Parameter(default="INDEL")
     train_indels = luigi.Parameter(default=None)
+    known_sites_params = ("train_indels", )
     options = luigi.Parameter(default=(
             "-an", "QD",
             "-an", "FS",
@@ -572,22 +1320,35 @@ class VariantIndelRecalibrator(VariantRecalibrator):
             "-an", "ReadPosRankSum"), is_list=True)
 
     def opts(self):
-        retval = list(self.options)
+        retval = super(VariantIndelRecalibrator, self).opts()
         if not self.train_indels:
             raise Exception("need indel training file for VariantIndelRecalibrator")
         retval += ["-resource:mills,VCF,known=true,training=true,truth=true,prior=12.0",
-                   self.train_indels]
+                   self.sites(self.train_indels)]
         return retval
 
 # 
 # VariantFiltration
 #
 class VariantFiltration(GATKJobTask):
-    """Generic VariantFiltration class"""
+    """Generic VariantFiltration class. If native is set, the filter
+    expressions and cluster settings of the options are evaluated
+    in-process, see :mod:`ratatosk.filtration`."""
     sub_executable = "VariantFiltration"
     parent_task = luigi.Parameter(default="ratatosk.lib.tools.gatk.InputVcfFile")
     label = luigi.Parameter(default=".filtered")
     suffix = luigi.Parameter(default=".vcf")
+    native = luigi.BooleanParameter(default=False, description="Evaluate filter expressions in-process, without starting GATK")
+
+    def job_runner(self):
+        if self.native:
+            return NativeVariantFiltrationJobRunner()
+        return super(VariantFiltration, self).job_runner()
+
+    def opts(self):
+        retval = super(VariantFiltration, self).opts()
+        retval += self.interval_opts()
+        return retval
         
     def args(self):
         retval = ["--variant", self.input()[0], "--out", self.output()]
@@ -601,7 +1362,7 @@ class VariantFiltrationExp(VariantFiltration):
     expressions = luigi.Parameter(default=(), is_list=True)
 
     def opts(self):
-        retval = list(self.options)
+        retval = super(VariantFiltrationExp, self).opts()
         for exp in self.expressions:
             retval += ["--filterName", "GATKStandard{e}".format(e=exp.split()[0]),
                        "--filterExpression", "'{}'".format(exp)]
@@ -633,8 +1394,9 @@ class ApplyRecalibration(GATKJobTask):
     suffix = luigi.Parameter(default=".vcf")
     
     def opts(self):
-        retval = list(self.options)
+        retval = super(ApplyRecalibration, self).opts()
         retval += ["--mode", self.mode]
+        retval += self.interval_opts()
         return retval
 
     def args(self):
@@ -654,6 +1416,11 @@ class ReadBackedPhasing(GATKJobTask):
                                            'ratatosk.lib.tools.gatk.UnifiedGenotyper'), is_list=True)
     suffix = luigi.Parameter(default=".vcf")
 
+    def opts(self):
+        retval = super(ReadBackedPhasing, self).opts()
+        retval += self.interval_opts()
+        return retval
+
     def args(self):
         retval = ["-I", self.input()[0], '--variant', self.input()[1],
                   '--out', self.output()]
@@ -661,4 +1428,36 @@ class ReadBackedPhasing(GATKJobTask):
             raise Exception("need reference for ReadBackedPhasing")
         retval += ["-R", self.ref]
         return retval
-    
+
+#
+# Scatter-gather tasks
+#
+class RealignerTargetCreatorScatterGather(GATKScatterGatherTask):
+    suffix = luigi.Parameter(default=".intervals")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.RealignerTargetCreator",), is_list=True)
+
+class IndelRealignerScatterGather(GATKScatterGatherTask):
+    label = luigi.Parameter(default=".realign")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.IndelRealigner",), is_list=True)
+
+class BaseRecalibratorScatterGather(GATKScatterGatherTask):
+    suffix = luigi.Parameter(default=".recal_data.grp")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.BaseRecalibrator",), is_list=True)
+
+class PrintReadsScatterGather(GATKScatterGatherTask):
+    label = luigi.Parameter(default=".recal")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.PrintReads",), is_list=True)
+
+class ReadBackedPhasingScatterGather(GATKScatterGatherTask):
+    label = luigi.Parameter(default="-phased")
+    suffix = luigi.Parameter(default=".vcf")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.ReadBackedPhasing",), is_list=True)
+
+class VariantAnnotatorScatterGather(GATKScatterGatherTask):
+    label = luigi.Parameter(default="-gatkann")
+    suffix = luigi.Parameter(default=".vcf")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.VariantAnnotator",), is_list=True)
+
+class UnifiedGenotyperScatterGather(GATKScatterGatherTask):
+    suffix = luigi.Parameter(default=".vcf")
+    parent_task = luigi.Parameter(default=("ratatosk.lib.tools.gatk.UnifiedGenotyper",), is_list=True)
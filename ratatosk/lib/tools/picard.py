@@ -22,13 +22,19 @@ Classes
 import os
 import luigi
 import re
+import shutil
+import hashlib
+import tempfile
 import ratatosk.lib.files.input
 from ratatosk.utils import rreplace
 from ratatosk.config import get_config
-from ratatosk.job import JobWrapperTask, JobTask
-from ratatosk.jobrunner import DefaultShellJobRunner
+from ratatosk.job import JobWrapperTask, JobTask, JavaJobTask
+from ratatosk.jobrunner import JobRunner, DefaultShellJobRunner
 from ratatosk.handler import RatatoskHandler, register_task_handler
 from ratatosk.log import get_logger
+from ratatosk.interval import read_intervals, write_interval_list
+import ratatosk.metrics
+import ratatosk.bam
 
 logger = get_logger()
 
@@ -53,36 +59,105 @@ class PicardJobRunner(DefaultShellJobRunner):
         arglist += job_args
         return (arglist, tmp_files)
 
-class PicardJobTask(JobTask):
-    java_exe = "java"
-    java_options = luigi.Parameter(default=("-Xmx2g",), is_list=True)
+    def run_job(self, job):
+        """Run job, creating its temporary directory before and
+        removing it after the run."""
+        tmp_dir = job.tmp_dir()
+        if job.pipe or not tmp_dir or not "TMP_DIR={}".format(tmp_dir) in job.opts():
+            return super(PicardJobRunner, self).run_job(job)
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        try:
+            return super(PicardJobRunner, self).run_job(job)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class PicardJobTask(JavaJobTask):
     exe_path = luigi.Parameter(default=os.getenv("PICARD_HOME") if os.getenv("PICARD_HOME") else os.curdir)
     executable = luigi.Parameter(default=None)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.picard.InputBamFile", ), is_list=True)
     suffix = luigi.Parameter(default=".bam")
     ref = luigi.Parameter(default=None)
     validation_stringency = luigi.Parameter(default="SILENT", description="Validation stringency to use")
+    scratch_dir = luigi.Parameter(default=None, description="Local scratch directory in which tasks that sort records create a temporary directory. Defaults to $TMPDIR or the system temporary directory")
+    compression_level = luigi.Parameter(default=None, description="Compression level (0-9) of output bam files. Defaults to the picard default")
+    use_async_io = luigi.BooleanParameter(default=False, description="Write bam files asynchronously, in a separate thread")
+    create_index = luigi.BooleanParameter(default=False, description="Index output bam files while writing them")
+    # Tasks that sort records spill to TMP_DIR when more than
+    # MAX_RECORDS_IN_RAM records are held in memory
+    sorts_records = False
+    # Records that fit in one Gb of heap
+    records_per_gb = 250000
 
     def jar(self):
         """Path to the jar for this Picard job"""
         return self.executable
     
-    def java_opt(self):
-        return list(self.java_options)
-
     def exe(self):
         return self.jar()
 
     def job_runner(self):
         return PicardJobRunner()
 
-    def java(self):
-        return self.java_exe
+    def java_opt(self):
+        retval = super(PicardJobTask, self).java_opt()
+        if self.use_async_io and not re.search("samjdk.use_async_io", " ".join(retval)):
+            retval.append("-Dsamjdk.use_async_io=true")
+        return retval
+
+    def max_records_in_ram(self):
+        """Get the number of records to hold in memory, given the heap size"""
+        return max(1, int(self.heap_size() / 1024.0 * self.records_per_gb))
+
+    def tmp_dir(self):
+        """Get the job temporary directory in local scratch, or None
+        if the task doesn't sort records"""
+        if not self.sorts_records:
+            return None
+        scratch_dir = os.path.expanduser(self.scratch_dir or os.getenv("TMPDIR") or tempfile.gettempdir())
+        return os.path.join(scratch_dir, "ratatosk-{}-{}".format(self.__class__.__name__, hashlib.md5(self.task_id).hexdigest()[0:12]))
 
     def opts(self):
+        retval = list(self.options)
         if not re.search("VALIDATION_STRINGENCY", " ".join(list(self.options))):
-            return list(self.options) + ["VALIDATION_STRINGENCY={}".format(self.validation_stringency)]
-        return list(self.options)
+            retval += ["VALIDATION_STRINGENCY={}".format(self.validation_stringency)]
+        if self.create_index and not re.search("CREATE_INDEX", " ".join(list(self.options))):
+            retval += ["CREATE_INDEX=true"]
+        return retval + self.resource_opts()
+
+    def resource_opts(self):
+        """Get options derived from task resources, unless set in options"""
+        options = " ".join(list(self.options))
+        retval = []
+        if self.sorts_records:
+            if not re.search("MAX_RECORDS_IN_RAM", options):
+                retval += ["MAX_RECORDS_IN_RAM={}".format(self.max_records_in_ram())]
+            if not re.search("TMP_DIR", options):
+                retval += ["TMP_DIR={}".format(self.tmp_dir())]
+        if self.compression_level is not None and not re.search("COMPRESSION_LEVEL", options):
+            retval += ["COMPRESSION_LEVEL={}".format(self.compression_level)]
+        return retval
+
+class NativeMetricsJobRunner(JobRunner):
+    """Job runner that collects metrics in-process, see
+    :mod:`ratatosk.metrics`."""
+    def run_job(self, job):
+        ratatosk.metrics.collect_metrics(job.input()[0].path, ref=job.ref, **job.native_outputs())
+
+class PicardMetricsJobTask(PicardJobTask):
+    """Picard metrics task that can be run natively, i.e.
+    in-process with pysam and numpy, see :mod:`ratatosk.metrics`.
+    Subclasses define the native outputs."""
+    native = luigi.BooleanParameter(default=False, description="Collect metrics in-process with pysam and numpy, without starting picard")
+
+    def job_runner(self):
+        if self.native:
+            return NativeMetricsJobRunner()
+        return super(PicardMetricsJobTask, self).job_runner()
+
+    def native_outputs(self):
+        """Output keyword arguments to :func:`ratatosk.metrics.collect_metrics`"""
+        raise NotImplementedError
 
 class CreateSequenceDictionary(PicardJobTask):
     executable = "CreateSequenceDictionary.jar"
@@ -92,21 +167,68 @@ class CreateSequenceDictionary(PicardJobTask):
     def args(self):
         return ["REFERENCE=", self.input()[0], "OUTPUT=", self.output()]
 
+class SortSamJobRunner(PicardJobRunner):
+    """Job runner for SortSam. Input that is already sorted by
+    coordinate, according to its header, is linked to the output
+    instead of being sorted."""
+    def run_job(self, job):
+        if job.pipe or not job.input_is_sorted():
+            return super(SortSamJobRunner, self).run_job(job)
+        logger.info("{0} is sorted by coordinate; linking to {1}".format(job.input()[0].path, job.output().path))
+        ratatosk.bam.link_bam(job.input()[0].path, job.output().path)
+
 class SortSam(PicardJobTask):
     executable = "SortSam.jar"
-    options = luigi.Parameter(default=("SO=coordinate MAX_RECORDS_IN_RAM=750000",), is_list=True)
+    expected_runtime = 20
+    options = luigi.Parameter(default=("SO=coordinate",), is_list=True)
     label = luigi.Parameter(default=".sort")
+    compression_level = luigi.Parameter(default=1, description="Compression level (0-9) of output bam files. Sorted bam files are intermediate and are compressed lightly")
+    use_async_io = luigi.BooleanParameter(default=True, description="Write bam files asynchronously, in a separate thread")
+    create_index = luigi.BooleanParameter(default=True, description="Index output bam files while writing them, so that a separate index task has nothing to do")
+    sorts_records = True
+    skip_sorted = luigi.BooleanParameter(default=True, description="Link input that is sorted by coordinate to the output instead of sorting it")
+    check_index = luigi.BooleanParameter(default=False, description="Only skip sorting if the input also has an up-to-date index")
+
+    def job_runner(self):
+        return SortSamJobRunner()
+
+    def input_is_sorted(self):
+        """Check whether the input already has the requested coordinate sort order"""
+        inbam = self.input()[0].path
+        if not self.skip_sorted or not re.search("SO=coordinate", " ".join(list(self.options))) or not os.path.exists(inbam):
+            return False
+        # The output format follows the extension; a sam file has to be converted
+        if os.path.splitext(inbam)[1] != os.path.splitext(self.output().path)[1]:
+            return False
+        return ratatosk.bam.is_coordinate_sorted(inbam, self.check_index)
 
     def args(self):
         return ["INPUT=", self.input()[0], "OUTPUT=", self.output()]
 
+class MergeSamFilesJobRunner(PicardJobRunner):
+    """Job runner for MergeSamFiles. A single input is linked to the
+    output instead of being merged."""
+    def run_job(self, job):
+        inputs = job.input()
+        if len(inputs) != 1:
+            return super(MergeSamFilesJobRunner, self).run_job(job)
+        logger.info("Single input {0}; linking to {1}".format(inputs[0].path, job.output().path))
+        ratatosk.bam.link_bam(inputs[0].path, job.output().path)
+
 class MergeSamFiles(PicardJobTask):
     executable = "MergeSamFiles.jar"
+    expected_runtime = 20
     label = luigi.Parameter(default=".merge")
     read1_suffix = luigi.Parameter(default="_R1_001")
     target_generator_handler = luigi.Parameter(default=None)
-    # FIXME: TMP_DIR should not be hard-coded
-    options = luigi.Parameter(default=("SO=coordinate TMP_DIR=./tmp", ), is_list=True)
+    options = luigi.Parameter(default=("SO=coordinate", ), is_list=True)
+    compression_level = luigi.Parameter(default=1, description="Compression level (0-9) of output bam files. Merged bam files are intermediate and are compressed lightly")
+    use_async_io = luigi.BooleanParameter(default=True, description="Write bam files asynchronously, in a separate thread")
+    create_index = luigi.BooleanParameter(default=True, description="Index output bam files while writing them, so that a separate index task has nothing to do")
+    sorts_records = True
+
+    def job_runner(self):
+        return MergeSamFilesJobRunner()
 
     def args(self):
         return ["OUTPUT=", self.output()] + [item for sublist in [["INPUT=", x] for x in self.input()] for item in sublist]
@@ -121,10 +243,10 @@ class MergeSamFiles(PicardJobTask):
         if not "target_generator_handler" in self._handlers.keys():
             logging.warn("MergeSamFiles requires a target generator handler; no defaults are as of yet implemented")
             return []
-        sources = list(set(self._handlers["target_generator_handler"](self)))
+        sources = sorted(set(self._handlers["target_generator_handler"](self)))
         return [cls(target=src) for src in sources]    
     
-class AlignmentMetrics(PicardJobTask):
+class AlignmentMetrics(PicardMetricsJobTask):
     executable = "CollectAlignmentSummaryMetrics.jar"
     suffix = luigi.Parameter(default=".align_metrics")
 
@@ -139,7 +261,10 @@ class AlignmentMetrics(PicardJobTask):
     def args(self):
         return ["INPUT=", self.input()[0], "OUTPUT=", self.output()]
 
-class InsertMetrics(PicardJobTask):
+    def native_outputs(self):
+        return {"alignment_file" : self.output().path}
+
+class InsertMetrics(PicardMetricsJobTask):
     executable = "CollectInsertSizeMetrics.jar"
     suffix = luigi.Parameter(default=(".insert_metrics", ".insert_hist"), is_list=True)
 
@@ -158,15 +283,89 @@ class InsertMetrics(PicardJobTask):
     def args(self):
         return ["INPUT=", self.input()[0], "OUTPUT=", self.output()[0], "HISTOGRAM_FILE=", self.output()[1]]
 
+    def native_outputs(self):
+        return {"insert_file" : self.output()[0].path, "histogram_file" : self.output()[1].path}
+
+class MultipleMetricsJobRunner(PicardJobRunner):
+    """Job runner for CollectMultipleMetrics. Outputs of the metrics
+    programs are renamed to the outputs of the task."""
+    def run_job(self, job):
+        super(MultipleMetricsJobRunner, self).run_job(job)
+        for src, tgt in zip(job.program_outputs(), job.output()):
+            logger.info("renaming {0} to {1}".format(src, tgt.path))
+            os.rename(src, tgt.path)
+
+class MultipleMetrics(PicardMetricsJobTask):
+    """Collect alignment summary and insert size metrics in a single
+    pass of the bam file with CollectMultipleMetrics. Outputs are
+    named as those of AlignmentMetrics and InsertMetrics, i.e.
+    {prefix}.align_metrics, {prefix}.insert_metrics and
+    {prefix}.insert_hist, the target being {prefix}.align_metrics."""
+    executable = "CollectMultipleMetrics.jar"
+    suffix = luigi.Parameter(default=(".align_metrics", ".insert_metrics", ".insert_hist"), is_list=True)
+    # Output extensions of the metrics programs, in the order of suffix
+    programs = (("CollectAlignmentSummaryMetrics", ".alignment_summary_metrics"),
+                ("CollectInsertSizeMetrics", ".insert_size_metrics"),
+                (None, ".insert_size_histogram.pdf"))
+
+    def job_runner(self):
+        if self.native:
+            return NativeMetricsJobRunner()
+        return MultipleMetricsJobRunner()
+
+    def opts(self):
+        retval = list(self.options)
+        if not re.search("VALIDATION_STRINGENCY", " ".join(list(self.options))):
+            retval += ["VALIDATION_STRINGENCY={}".format(self.validation_stringency)]
+        if self.ref:
+            retval += [" REFERENCE_SEQUENCE={}".format(self.ref)]
+        if not re.search("PROGRAM=", " ".join(list(self.options))):
+            retval += ["PROGRAM={}".format(x) for x, _ in self.programs if x]
+        return retval
+
+    def output(self):
+        return [luigi.LocalTarget(rreplace(self.target, self.suffix[0], x, 1)) for x in self.suffix]
+
+    def output_prefix(self):
+        """Output prefix passed to CollectMultipleMetrics"""
+        return rreplace(self.target, self.suffix[0], ".multiple_metrics-tmp", 1)
+
+    def program_outputs(self):
+        """Get the files written by CollectMultipleMetrics, in the order of output"""
+        return [self.output_prefix() + ext for _, ext in self.programs]
+
+    def args(self):
+        return ["INPUT=", self.input()[0], "OUTPUT=", self.output_prefix()]
+
+    def native_outputs(self):
+        return dict(zip(["alignment_file", "insert_file", "histogram_file"], [x.path for x in self.output()]))
+
 class DuplicationMetrics(PicardJobTask):
+    """Mark duplicates with MarkDuplicates. If merge_inputs is set and
+    the parent task is :class:`MergeSamFiles`, duplicates are marked
+    on the inputs of MergeSamFiles, which MarkDuplicates merges in the
+    same pass, so that no merged bam file is written. A single input
+    is processed as is."""
     executable = "MarkDuplicates.jar"
+    expected_runtime = 30
     label = luigi.Parameter(default=".dup")
     suffix = luigi.Parameter(default=(".bam", ".dup_metrics"), is_list=True)
+    merge_inputs = luigi.BooleanParameter(default=False, description="Mark duplicates on the inputs of the parent MergeSamFiles task, merging them in the same pass")
+    use_async_io = luigi.BooleanParameter(default=True, description="Write bam files asynchronously, in a separate thread")
+    create_index = luigi.BooleanParameter(default=True, description="Index output bam files while writing them, so that a separate index task has nothing to do")
+    sorts_records = True
+
+    def requires(self):
+        cls = self.parent()[0]
+        if self.merge_inputs and issubclass(cls, MergeSamFiles):
+            return cls(target=self.source()[0]).requires()
+        return super(DuplicationMetrics, self).requires()
 
     def args(self):
-        return ["INPUT=", self.input()[0], "OUTPUT=", self.output(), "METRICS_FILE=", rreplace(self.output().path, "{}{}".format(self.label, self.suffix[0]), self.suffix[1], 1)]
+        inputs = self.input() if self.merge_inputs else self.input()[0:1]
+        return [item for x in inputs for item in ["INPUT=", x]] + ["OUTPUT=", self.output(), "METRICS_FILE=", rreplace(self.output().path, "{}{}".format(self.label, self.suffix[0]), self.suffix[1], 1)]
 
-class HsMetrics(PicardJobTask):
+class HsMetrics(PicardMetricsJobTask):
     executable = "CalculateHsMetrics.jar"
     bait_regions = luigi.Parameter(default=None)
     target_regions = luigi.Parameter(default=None)
@@ -180,27 +379,75 @@ class HsMetrics(PicardJobTask):
             retval += [" REFERENCE_SEQUENCE={}".format(self.ref)]
         return retval
 
-    def args(self):
-        if not self.bait_regions or not self.target_regions:
+    def regions(self):
+        """Get bait and target regions, falling back on the capture region.
+        Bed files are converted to interval lists (see :meth:`interval_list`)."""
+        bait_regions = self.bait_regions or self.capture_region
+        target_regions = self.target_regions or self.capture_region
+        if not bait_regions or not target_regions:
             raise Exception("need bait and target regions to run CalculateHsMetrics")
-        return ["INPUT=", self.input()[0], "OUTPUT=", self.output(), "BAIT_INTERVALS=", os.path.expanduser(self.bait_regions), "TARGET_INTERVALS=", os.path.expanduser(self.target_regions)]
+        return (self.interval_list(os.path.expanduser(bait_regions)), self.interval_list(os.path.expanduser(target_regions)))
+
+    def interval_list(self, region):
+        """Get a picard interval list of a region file. CalculateHsMetrics
+        only reads interval lists, so a bed file is converted to
+        {base}.interval_list in the directory of the target, with the
+        header of the reference sequence dictionary.
+
+        :param region: interval list or bed file name
+
+        :returns: interval list file name
+        """
+        if not region.endswith(".bed"):
+            return region
+        if not self.ref:
+            raise Exception("need reference to convert bed file {} to an interval list".format(region))
+        dictfile = os.path.splitext(os.path.expanduser(self.ref))[0] + ".dict"
+        if not os.path.exists(dictfile):
+            raise Exception("need sequence dictionary {} to convert bed file {} to an interval list".format(dictfile, region))
+        fn = os.path.join(os.path.dirname(self.target), rreplace(os.path.basename(region), ".bed", ".interval_list", 1))
+        if not os.path.exists(fn) or os.path.getmtime(fn) < os.path.getmtime(region):
+            logger.info("Converting bed file {} to interval list {}".format(region, fn))
+            write_interval_list(read_intervals(region), fn + ".tmp", dictfile)
+            os.rename(fn + ".tmp", fn)
+        return fn
+
+    def args(self):
+        (bait_regions, target_regions) = self.regions()
+        return ["INPUT=", self.input()[0], "OUTPUT=", self.output(), "BAIT_INTERVALS=", bait_regions, "TARGET_INTERVALS=", target_regions]
+
+    def native_outputs(self):
+        (bait_regions, target_regions) = self.regions()
+        return {"hs_file" : self.output().path, "baits" : bait_regions, "targets" : target_regions}
 
 class HsMetricsNonDup(HsMetrics):
     """Run on non-deduplicated data"""
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.picard.MergeSamFiles", ), is_list=True)
 
 class PicardMetrics(JobWrapperTask):
+    """Collect insert size, hybrid selection and alignment summary
+    metrics. If multiple_metrics is set, insert size and alignment
+    summary metrics are collected in one pass with
+    :class:`MultipleMetrics`. Hybrid selection metrics cannot be
+    collected with CollectMultipleMetrics and are always collected
+    separately."""
     suffix = luigi.Parameter(default=("", ), is_list=True)
-    def requires(self):
+    multiple_metrics = luigi.BooleanParameter(default=False, description="Collect insert size and alignment summary metrics in a single pass with CollectMultipleMetrics")
+
+    def metrics_tasks(self):
+        if self.multiple_metrics:
+            return [MultipleMetrics(target=self.target + str(MultipleMetrics().suffix[0]))]
         return [InsertMetrics(target=self.target + str(InsertMetrics().sfx())),
-                HsMetrics(target=self.target + str(HsMetrics().sfx())),
                 AlignmentMetrics(target=self.target + str(AlignmentMetrics().sfx()))]
 
-class PicardMetricsNonDup(JobWrapperTask):
+    def requires(self):
+        tasks = self.metrics_tasks()
+        return tasks[0:1] + [HsMetrics(target=self.target + str(HsMetrics().sfx()))] + tasks[1:]
+
+class PicardMetricsNonDup(PicardMetrics):
     """Runs hs metrics on both duplicated and de-duplicated data"""
     def requires(self):
-        return [InsertMetrics(target=self.target + str(InsertMetrics().suffix)),
-                HsMetrics(target=self.target + str(HsMetrics().suffix)),
-                HsMetricsNonDup(target=rreplace(self.target, str(DuplicationMetrics().label), "", 1) + str(HsMetrics().suffix)),
-                AlignmentMetrics(target=self.target + str(AlignmentMetrics().suffix))]
+        tasks = self.metrics_tasks()
+        return tasks[0:1] + [HsMetrics(target=self.target + str(HsMetrics().suffix)),
+                             HsMetricsNonDup(target=rreplace(self.target, str(DuplicationMetrics().label), "", 1) + str(HsMetrics().suffix))] + tasks[1:]
 
@@ -19,14 +19,17 @@ Classes
 -------
 """
 import os
+import re
+import random
 import luigi
 import ratatosk.lib.files.input
+import ratatosk.bam
 from ratatosk.job import InputJobTask, JobTask
 from ratatosk.utils import rreplace
-from ratatosk.jobrunner import DefaultShellJobRunner
+from ratatosk.jobrunner import JobRunner, DefaultShellJobRunner
 from ratatosk.log import get_logger
 
-logger = get_logger
+logger = get_logger()
 
 class InputBamFile(ratatosk.lib.files.input.InputBamFile):
     pass
@@ -43,11 +46,30 @@ class SamtoolsJobTask(JobTask):
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.samtools.InputSamFile", ), is_list=True)
     suffix = luigi.Parameter(default=".bam")
 
+    memory_fraction = 0.8
+    """Fraction of max_memory_gb used for sort buffers, leaving room
+    for memory used by samtools otherwise."""
+
     def job_runner(self):
         return SamtoolsJobRunner()
 
+    def thread_opts(self):
+        """Get the thread option (-@) for tasks that run multi-threaded"""
+        if int(self.threads()) > 1 and not re.search("-@", " ".join(list(self.options))):
+            return ["-@ {}".format(self.threads())]
+        return []
+
+    def memory_per_thread_mb(self):
+        """Get the memory per thread in Mb, dividing the memory
+        reservation of the task among its threads"""
+        return max(1, int(self.max_memory() * 1024 * self.memory_fraction / int(self.threads())))
+
+    def opts(self):
+        return list(self.options) + self.thread_opts()
+
 class SamToBam(SamtoolsJobTask):
     sub_executable = "view"
+    can_multi_thread = True
     options = luigi.Parameter(default=("-bSh",), is_list=True)
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.samtools.InputSamFile", ), is_list=True)
     suffix = luigi.Parameter(default=".bam")
@@ -58,11 +80,40 @@ class SamToBam(SamtoolsJobTask):
             return retval + ["-"]
         return retval
 
+class SortBamJobRunner(SamtoolsJobRunner):
+    """Job runner for SortBam. Input that is already sorted by
+    coordinate, according to its header, is linked to the output
+    instead of being sorted."""
+    def run_job(self, job):
+        if job.pipe or not job.input_is_sorted():
+            return super(SortBamJobRunner, self).run_job(job)
+        logger.info("{0} is sorted by coordinate; linking to {1}".format(job.input()[0].path, job.output().path))
+        ratatosk.bam.link_bam(job.input()[0].path, job.output().path)
+
 class SortBam(SamtoolsJobTask):
     sub_executable = "sort"
     suffix = luigi.Parameter(default=".bam")
     label = luigi.Parameter(default=".sort")
     parent_task = luigi.Parameter(default=("ratatosk.lib.tools.samtools.SamToBam", ), is_list=True)
+    skip_sorted = luigi.BooleanParameter(default=True, description="Link input that is sorted by coordinate to the output instead of sorting it")
+    check_index = luigi.BooleanParameter(default=False, description="Only skip sorting if the input also has an up-to-date index")
+    can_multi_thread = True
+
+    def job_runner(self):
+        return SortBamJobRunner()
+
+    def opts(self):
+        retval = super(SortBam, self).opts()
+        if not "-m" in " ".join(list(self.options)).split():
+            retval += ["-m {}M".format(self.memory_per_thread_mb())]
+        return retval
+
+    def input_is_sorted(self):
+        """Check whether the input is already sorted by coordinate"""
+        inbam = self.input()[0].path
+        if not self.skip_sorted or "-n" in " ".join(list(self.options)).split() or not os.path.exists(inbam):
+            return False
+        return ratatosk.bam.is_coordinate_sorted(inbam, self.check_index)
 
     def add_suffix(self):
         """samtools sort generates its output based on a prefix, hence
@@ -73,10 +124,42 @@ class SortBam(SamtoolsJobTask):
         output_prefix = luigi.LocalTarget(rreplace(self.output().path, self.suffix, "", 1))
         return [self.input()[0], output_prefix]
 
+class IndexJobRunner(SamtoolsJobRunner):
+    """Job runner for Index. Nothing is done if the index was already
+    written along with the bam file, e.g. by picard with
+    CREATE_INDEX=true or by GATK."""
+    def run_job(self, job):
+        if not job.pipe and job.output().exists() and ratatosk.bam.has_current_index(job.input()[0].path, job.output().path):
+            logger.info("{} already written along with the bam file".format(job.output().path))
+            return
+        return super(IndexJobRunner, self).run_job(job)
+
+class NativeIndexJobRunner(JobRunner):
+    """Job runner that indexes in-process with pysam, see
+    :func:`ratatosk.bam.index_bam`."""
+    def run_job(self, job):
+        inbam = job.input()[0].path
+        if job.output().exists() and ratatosk.bam.has_current_index(inbam, job.output().path):
+            logger.info("{} already written along with the bam file".format(job.output().path))
+            return
+        tmp_path = job.output().path + '-luigi-tmp-%09d' % random.randrange(0, 1e10)
+        try:
+            ratatosk.bam.index_bam(inbam, tmp_path)
+            os.rename(tmp_path, job.output().path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
 class Index(SamtoolsJobTask):
     sub_executable = "index"
     suffix = luigi.Parameter(default=".bai")
     parent_task = luigi.Parameter(default="ratatosk.lib.tools.samtools.InputBamFile")
+    native = luigi.BooleanParameter(default=False, description="Index in-process with pysam, without starting samtools")
+
+    def job_runner(self):
+        if self.native:
+            return NativeIndexJobRunner()
+        return IndexJobRunner()
 
     def args(self):
         return [self.input()[0], self.output()]
@@ -0,0 +1,652 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Native collection of alignment summary, insert size and hybrid
+selection metrics, as done by picard CollectAlignmentSummaryMetrics,
+CollectInsertSizeMetrics and CalculateHsMetrics.
+
+For small bam files, such as those of HaloPlex and other capture
+experiments, starting the JVM takes longer than collecting the
+metrics. Here, reads are read with pysam and their values collected
+in numpy arrays, chunk_size reads at a time. Coverage over targets
+is accumulated in interval arrays, i.e. one depth array over the
+concatenated (merged) targets. All metrics are collected in a single
+pass of the bam file.
+
+Metrics are written in the picard metrics file format, with the
+columns of the picard metrics classes, so that the outputs can
+replace those of picard. Mismatch rates are computed against the
+reference, if given. Columns that depend on models not implemented
+here (HS_PENALTY_*, AT_DROPOUT and GC_DROPOUT) are left empty. The
+insert size histogram file is written as a picard histogram table
+instead of a pdf chart.
+
+Parity with picard is tested by TestMetricsParity in
+test/test_commands.py, which requires pysam and PICARD_HOME and is
+only run with the full test attribute. Run it before relying on the
+native collectors.
+
+"""
+import os
+import time
+from ratatosk.interval import read_intervals
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+CHUNK_SIZE = 100000
+"""Number of reads collected at a time"""
+
+MAPPING_QUALITY_THRESHOLD = 20
+BASE_QUALITY_THRESHOLD = 20
+MAX_INSERT_SIZE = 100000
+"""Insert size above which a pair is chimeric"""
+NEAR_DISTANCE = 250
+"""Distance from a bait within which reads are near bait"""
+DEVIATIONS = 10
+"""Insert size histogram is trimmed at median + DEVIATIONS * median absolute deviation"""
+MINIMUM_PCT = 0.05
+"""Minimum fraction of pairs for an orientation to be reported"""
+COVERAGE_LEVELS = [2, 10, 20, 30, 40, 50, 100]
+ORIENTATIONS = ["FR", "RF", "TANDEM"]
+CATEGORIES = ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR", "UNPAIRED"]
+
+# picard IlluminaUtil.IlluminaAdapterPair adapters, the defaults of
+# CollectAlignmentSummaryMetrics ADAPTER_SEQUENCE
+ADAPTERS = ["AATGATACGGCGACCACCGAGATCTACACTCTTTCCCTACACGACGCTCTTCCGATCT",
+            "AGATCGGAAGAGCGGTTCAGCAGGAATGCCGAGACCGATCTCGTATGCCGTCTTCTGCTTG",
+            "AGATCGGAAGAGCACACGTCTGAACTCCAGTCACNNNNNNNNATCTCGTATGCCGTCTTCTGCTTG",
+            "AATGATACGGCGACCACCGACAGGTTCAGAGTTCTACAGTCCGACG",
+            "ATCTCGTATGCCGTCTTCTGCTTG"]
+ADAPTER_MATCH_LENGTH = 16
+MAX_ADAPTER_ERRORS = 1
+
+ALIGNMENT_COLUMNS = ["CATEGORY", "TOTAL_READS", "PF_READS", "PCT_PF_READS", "PF_NOISE_READS",
+                     "PF_READS_ALIGNED", "PCT_PF_READS_ALIGNED", "PF_ALIGNED_BASES", "PF_HQ_ALIGNED_READS",
+                     "PF_HQ_ALIGNED_BASES", "PF_HQ_ALIGNED_Q20_BASES", "PF_HQ_MEDIAN_MISMATCHES",
+                     "PF_MISMATCH_RATE", "PF_HQ_ERROR_RATE", "PF_INDEL_RATE", "MEAN_READ_LENGTH",
+                     "READS_ALIGNED_IN_PAIRS", "PCT_READS_ALIGNED_IN_PAIRS", "BAD_CYCLES", "STRAND_BALANCE",
+                     "PCT_CHIMERAS", "PCT_ADAPTER", "SAMPLE", "LIBRARY", "READ_GROUP"]
+INSERT_SIZE_COLUMNS = ["MEDIAN_INSERT_SIZE", "MEDIAN_ABSOLUTE_DEVIATION", "MIN_INSERT_SIZE",
+                       "MAX_INSERT_SIZE", "MEAN_INSERT_SIZE", "STANDARD_DEVIATION", "READ_PAIRS",
+                       "PAIR_ORIENTATION"] + ["WIDTH_OF_{}_PERCENT".format(x) for x in range(10, 100, 10) + [99]] + ["SAMPLE", "LIBRARY", "READ_GROUP"]
+HS_COLUMNS = ["BAIT_SET", "GENOME_SIZE", "BAIT_TERRITORY", "TARGET_TERRITORY", "BAIT_DESIGN_EFFICIENCY",
+              "TOTAL_READS", "PF_READS", "PF_UNIQUE_READS", "PCT_PF_READS", "PCT_PF_UQ_READS",
+              "PF_UQ_READS_ALIGNED", "PCT_PF_UQ_READS_ALIGNED", "PF_UQ_BASES_ALIGNED", "ON_BAIT_BASES",
+              "NEAR_BAIT_BASES", "OFF_BAIT_BASES", "ON_TARGET_BASES", "PCT_SELECTED_BASES", "PCT_OFF_BAIT",
+              "ON_BAIT_VS_SELECTED", "MEAN_BAIT_COVERAGE", "MEAN_TARGET_COVERAGE", "PCT_USABLE_BASES_ON_BAIT",
+              "PCT_USABLE_BASES_ON_TARGET", "FOLD_ENRICHMENT", "ZERO_CVG_TARGETS_PCT", "FOLD_80_BASE_PENALTY"] + \
+              ["PCT_TARGET_BASES_{}X".format(x) for x in COVERAGE_LEVELS] + ["HS_LIBRARY_SIZE"] + \
+              ["HS_PENALTY_{}X".format(x) for x in [10, 20, 30, 40, 50, 100]] + ["AT_DROPOUT", "GC_DROPOUT", "SAMPLE", "LIBRARY", "READ_GROUP"]
+
+METRICS_CLASSES = {"alignment" : "net.sf.picard.analysis.AlignmentSummaryMetrics",
+                   "insert" : "net.sf.picard.analysis.InsertSizeMetrics",
+                   "hs" : "net.sf.picard.analysis.directed.HsMetrics"}
+
+# Sam flags
+(PAIRED, UNMAPPED, MATE_UNMAPPED, REVERSE, MATE_REVERSE, READ1, SECONDARY, QCFAIL, DUPLICATE, SUPPLEMENTARY) = \
+    (0x1, 0x4, 0x8, 0x10, 0x20, 0x40, 0x100, 0x200, 0x400, 0x800)
+
+# Per-read values, in column order of the read arrays
+_FIELDS = ["flag", "tid", "start", "end", "mapq", "tlen", "mtid", "mpos", "length",
+           "aligned", "indels", "mismatches", "q20", "mate_mapq", "noise", "adapter"]
+
+# Alignment summary counts, summed over chunks
+_ALIGNMENT_COUNTS = ["TOTAL_READS", "PF_READS", "PF_NOISE_READS", "PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+                     "PF_HQ_ALIGNED_READS", "PF_HQ_ALIGNED_BASES", "PF_HQ_ALIGNED_Q20_BASES", "READS_ALIGNED_IN_PAIRS",
+                     "mismatches", "hq_mismatches", "indels", "read_length", "positive", "chimeras", "non_chimeras", "adapter"]
+
+def _adapter_kmers(adapters=ADAPTERS):
+    """Adapter kmers of length ADAPTER_MATCH_LENGTH, and their reverse
+    complements, with at most MAX_ADAPTER_ERRORS no-calls"""
+    comp = dict(zip("ACGTN", "TGCAN"))
+    kmers = set()
+    for seq in adapters:
+        for i in range(len(seq) - ADAPTER_MATCH_LENGTH + 1):
+            kmer = seq[i:i + ADAPTER_MATCH_LENGTH].upper()
+            if kmer.count("N") <= MAX_ADAPTER_ERRORS:
+                kmers.add(kmer)
+                kmers.add("".join(comp[x] for x in reversed(kmer)))
+    return np.array([np.frombuffer(x, dtype=np.uint8) for x in sorted(kmers)])
+
+def _is_adapter(bases, kmers):
+    """Check whether the first bases of a read match an adapter kmer"""
+    if len(bases) < ADAPTER_MATCH_LENGTH:
+        return False
+    errors = (kmers != bases[0:ADAPTER_MATCH_LENGTH]).sum(axis=1)
+    return bool((errors <= MAX_ADAPTER_ERRORS).any())
+
+def _read_values(read, refseq, kmers):
+    """Get per-read values and aligned blocks of a read.
+
+    :param read: pysam aligned read
+    :param refseq: reference sequence of the read contig as numpy array, or None
+    :param kmers: adapter kmers
+
+    :returns: tuple (values, in order of _FIELDS, list of (start, end) aligned blocks, list of no-call cycles)
+    """
+    flag = read.flag
+    seq = (read.seq or "").upper()
+    bases = np.frombuffer(seq, dtype=np.uint8)
+    quals = np.frombuffer(read.qual, dtype=np.uint8) - 33 if read.qual and read.qual != "*" else None
+    tags = dict(read.tags)
+    (qpos, rpos) = (0, read.pos)
+    (aligned, indels, mismatches, q20) = (0, 0, 0, 0)
+    blocks = []
+    if not flag & UNMAPPED:
+        for (op, n) in read.cigar or []:
+            if op in (0, 7, 8):
+                length = n if refseq is None else max(0, min(n, len(refseq) - rpos))
+                aligned += length
+                if refseq is not None and length > 0:
+                    mismatches += int(np.count_nonzero(bases[qpos:qpos + length] != refseq[rpos:rpos + length]))
+                if quals is not None:
+                    q20 += int(np.count_nonzero(quals[qpos:qpos + length] >= BASE_QUALITY_THRESHOLD))
+                blocks.append((rpos + 1, rpos + n))
+                qpos += n
+                rpos += n
+            elif op == 1:
+                indels += 1
+                qpos += n
+            elif op == 2:
+                indels += 1
+                rpos += n
+            elif op == 3:
+                rpos += n
+            elif op == 4:
+                qpos += n
+    nocalls = np.nonzero(bases == ord("N"))[0]
+    cycles = list(len(bases) - nocalls if flag & REVERSE else nocalls + 1)
+    adapter = flag & UNMAPPED and not flag & QCFAIL and _is_adapter(bases, kmers)
+    values = (flag, read.tid, read.pos + 1, max(rpos, read.pos + 1), read.mapq, read.tlen, read.rnext, read.pnext + 1,
+              len(bases), aligned, indels, mismatches, q20, tags.get("MQ", -1), int("XN" in tags), int(adapter))
+    return (values, blocks, cycles)
+
+def _read_chunks(samfile, fasta=None, chunk_size=CHUNK_SIZE):
+    """Read primary alignments of a sam/bam file in chunks.
+
+    :param samfile: pysam Samfile
+    :param fasta: pysam Fastafile of the reference, or None
+    :param chunk_size: number of reads per chunk
+
+    :returns: generator of dictionaries with per-read arrays (see _FIELDS), aligned blocks (block_read, block_start, block_end) and no-call cycles (nocall_read, nocall_cycle)
+    """
+    kmers = _adapter_kmers()
+    (tid, refseq) = (None, None)
+    (rows, blocks, nocalls) = ([], [], [])
+    for read in samfile:
+        if read.flag & (SECONDARY | SUPPLEMENTARY):
+            continue
+        if fasta is not None and read.tid != tid:
+            tid = read.tid
+            refseq = None
+            if tid >= 0:
+                try:
+                    refseq = np.frombuffer(fasta.fetch(samfile.references[tid]).upper(), dtype=np.uint8)
+                except (KeyError, ValueError):
+                    logger.warn("No reference sequence for {}; not counting mismatches".format(samfile.references[tid]))
+        (values, b, c) = _read_values(read, refseq if read.tid >= 0 else None, kmers)
+        blocks += [(len(rows), start, end) for (start, end) in b]
+        nocalls += [(len(rows), x) for x in c]
+        rows.append(values)
+        if len(rows) == chunk_size:
+            yield _chunk(rows, blocks, nocalls)
+            (rows, blocks, nocalls) = ([], [], [])
+    if rows:
+        yield _chunk(rows, blocks, nocalls)
+
+def _chunk(rows, blocks, nocalls):
+    """Convert rows to per-read arrays"""
+    values = np.array(rows, dtype=np.int64).reshape(len(rows), len(_FIELDS))
+    chunk = dict((x, values[:, i]) for i, x in enumerate(_FIELDS))
+    blocks = np.array(blocks, dtype=np.int64).reshape(len(blocks), 3)
+    (chunk["block_read"], chunk["block_start"], chunk["block_end"]) = (blocks[:, 0], blocks[:, 1], blocks[:, 2])
+    nocalls = np.array(nocalls, dtype=np.int64).reshape(len(nocalls), 2)
+    (chunk["nocall_read"], chunk["nocall_cycle"]) = (nocalls[:, 0], nocalls[:, 1])
+    return chunk
+
+def _add_bincount(counts, values):
+    """Add bincount of values to counts, extending counts if needed"""
+    new = np.bincount(values) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+    total = np.zeros(max(len(counts), len(new)), dtype=np.int64)
+    total[0:len(counts)] += counts
+    total[0:len(new)] += new
+    return total
+
+def pair_orientations(chunk):
+    """Get pair orientations (indices in :data:`ORIENTATIONS`) of
+    reads, as picard SamPairUtil.getPairOrientation"""
+    reverse = chunk["flag"] & REVERSE > 0
+    pos_five = np.where(reverse, chunk["mpos"], chunk["start"])
+    neg_five = np.where(reverse, chunk["end"], chunk["start"] + chunk["tlen"])
+    orientations = np.where(pos_five < neg_five, 0, 1)
+    orientations[reverse == (chunk["flag"] & MATE_REVERSE > 0)] = 2
+    return orientations
+
+def merge_intervals(intervals):
+    """Merge overlapping and abutting intervals.
+
+    :param intervals: list of (contig, start, end) tuples
+
+    :returns: sorted list of merged intervals
+    """
+    merged = []
+    for (c, s, e) in sorted(intervals):
+        if merged and merged[-1][0] == c and s <= merged[-1][2] + 1:
+            merged[-1] = (c, merged[-1][1], max(e, merged[-1][2]))
+        else:
+            merged.append((c, s, e))
+    return merged
+
+class IntervalArray(object):
+    """Merged intervals stored as arrays of starts and ends per contig,
+    for vectorized overlap queries. Intervals are numbered in sorted
+    order, and bases of the intervals are numbered consecutively, so
+    that per-base values can be kept in a single array of length
+    :meth:`territory`."""
+    def __init__(self, intervals, contigs, padding=0):
+        """
+        :param intervals: list of (contig, start, end) tuples
+        :param contigs: list of contig names, in bam header order
+        :param padding: number of bases by which to pad intervals before merging
+        """
+        tids = dict((c, i) for i, c in enumerate(contigs))
+        self.intervals = merge_intervals([(c, max(1, s - padding), e + padding) for (c, s, e) in intervals if c in tids])
+        self.index = {}
+        offset = 0
+        for (c, s, e) in self.intervals:
+            self.index.setdefault(tids[c], ([], [], []))
+            self.index[tids[c]][0].append(s)
+            self.index[tids[c]][1].append(e)
+            self.index[tids[c]][2].append(offset)
+            offset += e - s + 1
+        self.index = dict((k, tuple(np.array(x, dtype=np.int64) for x in v)) for k, v in self.index.items())
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def territory(self):
+        """Number of bases covered by the intervals"""
+        return sum(e - s + 1 for (_, s, e) in self.intervals)
+
+    def overlaps(self, tids, starts, ends):
+        """Get the overlaps of ranges with the intervals.
+
+        :param tids: array of contig ids
+        :param starts: array of 1-based starts
+        :param ends: array of 1-based, inclusive ends
+
+        :returns: tuple of arrays (range index, base offset of overlap start, base offset of overlap end), one element per overlapping (range, interval) pair
+        """
+        out = [(np.zeros(0, dtype=np.int64),) * 3]
+        for tid, (istarts, iends, offsets) in self.index.items():
+            sel = np.nonzero(tids == tid)[0]
+            if len(sel) == 0:
+                continue
+            first = np.searchsorted(iends, starts[sel])
+            n = np.maximum(np.searchsorted(istarts, ends[sel], side="right") - first, 0)
+            ranges = np.repeat(sel, n)
+            k = np.repeat(first - np.cumsum(n) + n, n) + np.arange(n.sum())
+            ovstart = np.maximum(starts[ranges], istarts[k]) - istarts[k] + offsets[k]
+            ovend = np.minimum(ends[ranges], iends[k]) - istarts[k] + offsets[k]
+            out.append((ranges, ovstart, ovend))
+        return tuple(np.concatenate(x) for x in zip(*out))
+
+    def depths(self, coverage):
+        """Split per-base values into per-interval arrays"""
+        bounds = np.cumsum([e - s + 1 for (_, s, e) in self.intervals])
+        return np.split(coverage, bounds[:-1]) if len(bounds) > 0 else []
+
+class _Collector(object):
+    """Accumulate metrics over chunks of reads"""
+    def __init__(self, contigs, baits=None, targets=None):
+        self.contigs = contigs
+        self.align = dict((x, dict((y, 0) for y in _ALIGNMENT_COUNTS)) for x in CATEGORIES)
+        for x in CATEGORIES:
+            (self.align[x]["hq_mismatch_hist"], self.align[x]["nocalls"]) = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        self.inserts = [np.zeros(0, dtype=np.int64) for x in ORIENTATIONS]
+        self.hs = None
+        if targets is not None:
+            names = [c for c, _ in contigs]
+            self.baits = IntervalArray(baits, names)
+            self.near_baits = IntervalArray(baits, names, padding=NEAR_DISTANCE)
+            self.targets = IntervalArray(targets, names)
+            self.hs = dict((x, 0) for x in ["TOTAL_READS", "PF_READS", "PF_BASES", "PF_UNIQUE_READS", "PF_SELECTED_PAIRS",
+                                            "PF_SELECTED_UNIQUE_PAIRS", "PF_UQ_READS_ALIGNED", "PF_UQ_BASES_ALIGNED",
+                                            "ON_BAIT_BASES", "NEAR_BAIT_BASES", "OFF_BAIT_BASES", "ON_TARGET_BASES"])
+            # Coverage differences; cumulative sum gives per-base target depths
+            self.coverage = np.zeros(self.targets.territory() + 1, dtype=np.int64)
+
+    def add(self, chunk):
+        """Add a chunk of reads, see :func:`_read_chunks`"""
+        self._add_alignment(chunk)
+        self._add_inserts(chunk)
+        if self.hs is not None:
+            self._add_hs(chunk)
+
+    def _add_alignment(self, chunk):
+        flag = chunk["flag"]
+        paired = flag & PAIRED > 0
+        first = paired & (flag & READ1 > 0)
+        pf = flag & QCFAIL == 0
+        aligned = pf & (flag & UNMAPPED == 0)
+        hq = aligned & (chunk["mapq"] >= MAPPING_QUALITY_THRESHOLD)
+        in_pairs = aligned & paired & (flag & MATE_UNMAPPED == 0)
+        mate_mapq = chunk["mate_mapq"]
+        non_chimeras = in_pairs & ((mate_mapq < 0) | ((mate_mapq >= MAPPING_QUALITY_THRESHOLD) & (chunk["mapq"] >= MAPPING_QUALITY_THRESHOLD)))
+        chimeras = non_chimeras & ((np.abs(chunk["tlen"]) > MAX_INSERT_SIZE) | (chunk["tid"] != chunk["mtid"]) | (pair_orientations(chunk) != 0))
+        masks = {"FIRST_OF_PAIR" : first, "SECOND_OF_PAIR" : paired & ~first, "PAIR" : paired, "UNPAIRED" : ~paired}
+        for category, m in masks.items():
+            counts = self.align[category]
+            values = {"TOTAL_READS" : m.sum(), "PF_READS" : (m & pf).sum(),
+                      "PF_NOISE_READS" : (m & pf & (chunk["noise"] > 0)).sum(),
+                      "PF_READS_ALIGNED" : (m & aligned).sum(), "PF_ALIGNED_BASES" : chunk["aligned"][m & aligned].sum(),
+                      "PF_HQ_ALIGNED_READS" : (m & hq).sum(), "PF_HQ_ALIGNED_BASES" : chunk["aligned"][m & hq].sum(),
+                      "PF_HQ_ALIGNED_Q20_BASES" : chunk["q20"][m & hq].sum(), "READS_ALIGNED_IN_PAIRS" : (m & in_pairs).sum(),
+                      "mismatches" : chunk["mismatches"][m & aligned].sum(), "hq_mismatches" : chunk["mismatches"][m & hq].sum(),
+                      "indels" : chunk["indels"][m & aligned].sum(), "read_length" : chunk["length"][m].sum(),
+                      "positive" : (m & aligned & (flag & REVERSE == 0)).sum(), "chimeras" : (m & chimeras).sum(),
+                      "non_chimeras" : (m & non_chimeras).sum(), "adapter" : (m & (chunk["adapter"] > 0)).sum()}
+            for k, v in values.items():
+                counts[k] += int(v)
+            counts["hq_mismatch_hist"] = _add_bincount(counts["hq_mismatch_hist"], chunk["mismatches"][m & hq])
+            counts["nocalls"] = _add_bincount(counts["nocalls"], chunk["nocall_cycle"][m[chunk["nocall_read"]]])
+
+    def _add_inserts(self, chunk):
+        flag = chunk["flag"]
+        m = (flag & PAIRED > 0) & (flag & (UNMAPPED | MATE_UNMAPPED | READ1 | DUPLICATE) == 0) & (chunk["tlen"] != 0)
+        orientations = pair_orientations(chunk)
+        for i in range(len(ORIENTATIONS)):
+            self.inserts[i] = _add_bincount(self.inserts[i], np.abs(chunk["tlen"][m & (orientations == i)]))
+
+    def _add_hs(self, chunk):
+        flag = chunk["flag"]
+        pf = flag & QCFAIL == 0
+        mapped = flag & UNMAPPED == 0
+        (near, _, _) = self.near_baits.overlaps(chunk["tid"], chunk["start"], chunk["end"])
+        near = np.in1d(np.arange(len(flag)), near) & mapped
+        selected = pf & (flag & PAIRED > 0) & (flag & READ1 > 0) & mapped & (flag & MATE_UNMAPPED == 0) & near
+        unique = pf & (flag & DUPLICATE == 0)
+        uq_aligned = unique & mapped & (chunk["mapq"] > 0)
+        # Aligned blocks of unique, aligned reads
+        blocks = uq_aligned[chunk["block_read"]]
+        (block_read, block_start, block_end) = (chunk["block_read"][blocks], chunk["block_start"][blocks], chunk["block_end"][blocks])
+        block_tid = chunk["tid"][block_read]
+        mapped_bases = (block_end - block_start + 1).sum()
+        near_bases = (block_end - block_start + 1)[near[block_read]].sum()
+        (_, ovstart, ovend) = self.baits.overlaps(block_tid, block_start, block_end)
+        on_bait = (ovend - ovstart + 1).sum()
+        (_, ovstart, ovend) = self.targets.overlaps(block_tid, block_start, block_end)
+        np.add.at(self.coverage, ovstart, 1)
+        np.add.at(self.coverage, ovend + 1, -1)
+        values = {"TOTAL_READS" : len(flag), "PF_READS" : pf.sum(), "PF_BASES" : chunk["length"][pf].sum(),
+                  "PF_SELECTED_PAIRS" : selected.sum(), "PF_SELECTED_UNIQUE_PAIRS" : (selected & unique).sum(),
+                  "PF_UNIQUE_READS" : unique.sum(), "PF_UQ_READS_ALIGNED" : uq_aligned.sum(),
+                  "PF_UQ_BASES_ALIGNED" : mapped_bases, "ON_BAIT_BASES" : on_bait,
+                  "NEAR_BAIT_BASES" : near_bases - on_bait, "OFF_BAIT_BASES" : mapped_bases - near_bases,
+                  "ON_TARGET_BASES" : (ovend - ovstart + 1).sum()}
+        for k, v in values.items():
+            self.hs[k] += int(v)
+
+    def alignment_metrics(self):
+        """Get alignment summary metrics, one row per category"""
+        categories = (CATEGORIES[0:3] if self.align["PAIR"]["TOTAL_READS"] > 0 else []) + \
+            (CATEGORIES[3:] if self.align["UNPAIRED"]["TOTAL_READS"] > 0 else [])
+        rows = []
+        for category in categories:
+            c = self.align[category]
+            row = dict((k, c[k]) for k in ALIGNMENT_COLUMNS if k in c)
+            row.update({"CATEGORY" : category,
+                        "PCT_PF_READS" : _ratio(c["PF_READS"], c["TOTAL_READS"]),
+                        "PCT_PF_READS_ALIGNED" : _ratio(c["PF_READS_ALIGNED"], c["PF_READS"]),
+                        "PF_HQ_MEDIAN_MISMATCHES" : histogram_median(c["hq_mismatch_hist"]),
+                        "PF_MISMATCH_RATE" : _ratio(c["mismatches"], c["PF_ALIGNED_BASES"]),
+                        "PF_HQ_ERROR_RATE" : _ratio(c["hq_mismatches"], c["PF_HQ_ALIGNED_BASES"]),
+                        "PF_INDEL_RATE" : _ratio(c["indels"], c["PF_ALIGNED_BASES"]),
+                        "MEAN_READ_LENGTH" : _ratio(c["read_length"], c["TOTAL_READS"]),
+                        "PCT_READS_ALIGNED_IN_PAIRS" : _ratio(c["READS_ALIGNED_IN_PAIRS"], c["PF_READS_ALIGNED"]),
+                        "BAD_CYCLES" : int((c["nocalls"] >= 0.8 * c["TOTAL_READS"]).sum()) if c["TOTAL_READS"] > 0 else 0,
+                        "STRAND_BALANCE" : _ratio(c["positive"], c["PF_READS_ALIGNED"]),
+                        "PCT_CHIMERAS" : _ratio(c["chimeras"], c["non_chimeras"]),
+                        "PCT_ADAPTER" : _ratio(c["adapter"], c["PF_READS"])})
+            rows.append(row)
+        return rows
+
+    def hs_metrics(self, bait_set=None):
+        """Get hybrid selection metrics"""
+        m = dict(self.hs)
+        depths = self.targets.depths(np.cumsum(self.coverage)[:-1])
+        covered = [d for d in depths if (d > 0).any()]
+        considered = np.sort(np.concatenate(covered)) if covered else np.zeros(0, dtype=np.int64)
+        (bait_territory, target_territory) = (self.baits.territory(), self.targets.territory())
+        genome_size = sum(l for _, l in self.contigs)
+        selected = m["ON_BAIT_BASES"] + m["NEAR_BAIT_BASES"]
+        total = selected + m["OFF_BAIT_BASES"]
+        m.update({"BAIT_SET" : bait_set, "GENOME_SIZE" : genome_size,
+                  "BAIT_TERRITORY" : bait_territory, "TARGET_TERRITORY" : target_territory,
+                  "BAIT_DESIGN_EFFICIENCY" : _ratio(target_territory, bait_territory),
+                  "PCT_PF_READS" : _ratio(m["PF_READS"], m["TOTAL_READS"]),
+                  "PCT_PF_UQ_READS" : _ratio(m["PF_UNIQUE_READS"], m["TOTAL_READS"]),
+                  "PCT_PF_UQ_READS_ALIGNED" : _ratio(m["PF_UQ_READS_ALIGNED"], m["PF_UNIQUE_READS"]),
+                  "PCT_SELECTED_BASES" : _ratio(selected, total),
+                  "PCT_OFF_BAIT" : _ratio(m["OFF_BAIT_BASES"], total),
+                  "ON_BAIT_VS_SELECTED" : _ratio(m["ON_BAIT_BASES"], selected),
+                  "MEAN_BAIT_COVERAGE" : _ratio(m["ON_BAIT_BASES"], bait_territory),
+                  "MEAN_TARGET_COVERAGE" : _ratio(considered.sum(), len(considered)),
+                  "PCT_USABLE_BASES_ON_BAIT" : _ratio(m["ON_BAIT_BASES"], m["PF_BASES"]),
+                  "PCT_USABLE_BASES_ON_TARGET" : _ratio(m["ON_TARGET_BASES"], m["PF_BASES"]),
+                  "FOLD_ENRICHMENT" : _ratio(_ratio(m["ON_BAIT_BASES"], total), _ratio(bait_territory, genome_size)),
+                  "ZERO_CVG_TARGETS_PCT" : _ratio(len(depths) - len(covered), len(depths)),
+                  "HS_LIBRARY_SIZE" : estimate_library_size(m["PF_SELECTED_PAIRS"], m["PF_SELECTED_UNIQUE_PAIRS"])})
+        # Coverage at the 80th percentile, i.e. 20% into the sorted
+        # depths of covered targets
+        i = int(len(considered) * 0.2) - 1
+        if i >= 0 and considered[i] > 0:
+            m["FOLD_80_BASE_PENALTY"] = m["MEAN_TARGET_COVERAGE"] / considered[i]
+        all_depths = np.concatenate(depths) if depths else np.zeros(0)
+        for x in COVERAGE_LEVELS:
+            m["PCT_TARGET_BASES_{}X".format(x)] = _ratio((all_depths >= x).sum(), target_territory)
+        return [m]
+
+def _ratio(num, denom):
+    if not denom:
+        return 0.0
+    return float(num) / denom
+
+def weighted_median(values, weights):
+    """Get the median of values with integer weights, as picard
+    Histogram.getMedian, i.e. the mean of the two middle values if
+    the total weight is even.
+
+    :param values: array of values
+    :param weights: array of weights
+
+    :returns: median, or 0 if the total weight is 0
+    """
+    n = int(np.sum(weights))
+    if n == 0:
+        return 0
+    order = np.argsort(values, kind="mergesort")
+    cumulative = np.cumsum(np.asarray(weights)[order])
+    (low, high) = (n // 2, n // 2 + 1) if n % 2 == 0 else ((n + 1) // 2, (n + 1) // 2)
+    values = np.asarray(values)[order]
+    return (values[np.searchsorted(cumulative, low)] + values[np.searchsorted(cumulative, high)]) / 2.0
+
+def histogram_median(counts):
+    """Get the median of a histogram given as counts of 0, 1, 2, ..."""
+    return weighted_median(np.arange(len(counts)), counts)
+
+def insert_size_metrics(histograms):
+    """Get insert size metrics from insert size histograms, as picard
+    InsertSizeMetricsCollector. Histograms are trimmed at median +
+    DEVIATIONS * median absolute deviation before calculating mean
+    and standard deviation.
+
+    :param histograms: list of insert size counts (counts of insert size 0, 1, 2, ...), one per orientation in :data:`ORIENTATIONS`
+
+    :returns: tuple (list of metrics, one per reported orientation, histogram as tuple (columns, rows), or None if no orientation is reported)
+    """
+    total = sum(h.sum() for h in histograms)
+    (rows, reported) = ([], [])
+    for orientation, h in zip(ORIENTATIONS, histograms):
+        n = h.sum()
+        if n == 0 or n < total * MINIMUM_PCT:
+            continue
+        keys = np.nonzero(h)[0]
+        median = histogram_median(h)
+        mad = weighted_median(np.abs(np.arange(len(h)) - median), h)
+        row = {"PAIR_ORIENTATION" : orientation, "READ_PAIRS" : int(n), "MIN_INSERT_SIZE" : int(keys[0]),
+               "MAX_INSERT_SIZE" : int(keys[-1]), "MEDIAN_INSERT_SIZE" : median, "MEDIAN_ABSOLUTE_DEVIATION" : mad}
+        (covered, low, high) = (0.0, median, median)
+        widths = [x for x in INSERT_SIZE_COLUMNS if x.startswith("WIDTH_OF")]
+        while (low >= keys[0] or high <= keys[-1]) and widths:
+            if 0 <= int(low) < len(h):
+                covered += h[int(low)]
+            if low != high and int(high) < len(h):
+                covered += h[int(high)]
+            for w in list(widths):
+                if covered / n >= int(w.split("_")[2]) / 100.0:
+                    row[w] = int(high - low) + 1
+                    widths.remove(w)
+            (low, high) = (low - 1, high + 1)
+        for w in widths:
+            row[w] = 0
+        trimmed = h[0:int(median + DEVIATIONS * mad) + 1]
+        values = np.arange(len(trimmed))
+        mean = (values * trimmed).sum() / float(trimmed.sum())
+        row["MEAN_INSERT_SIZE"] = mean
+        row["STANDARD_DEVIATION"] = np.sqrt((trimmed * (values - mean) ** 2).sum() / (trimmed.sum() - 1)) if trimmed.sum() > 1 else 0.0
+        rows.append(row)
+        reported.append((orientation, trimmed))
+    if not reported:
+        return (rows, None)
+    keys = sorted(set(k for _, t in reported for k in np.nonzero(t)[0]))
+    histogram = (["insert_size"] + ["{}_count".format(x.lower()) for x, _ in reported],
+                 [[k] + [int(t[k]) if k < len(t) else 0 for _, t in reported] for k in keys])
+    return (rows, histogram)
+
+def estimate_library_size(read_pairs, unique_pairs):
+    """Estimate library size from the number of read pairs and the
+    number of unique (non-duplicate) read pairs, as picard
+    DuplicationMetrics.estimateLibrarySize.
+
+    :param read_pairs: number of read pairs
+    :param unique_pairs: number of unique read pairs
+
+    :returns: estimated number of unique molecules, or None if there are no duplicates
+    """
+    def f(x, c, n):
+        return c / x - 1 + np.exp(-n / x)
+    if read_pairs <= 0 or read_pairs - unique_pairs <= 0:
+        return None
+    (n, c) = (float(read_pairs), float(unique_pairs))
+    (m, M) = (1.0, 100.0)
+    if c >= n or f(m * c, c, n) < 0:
+        raise Exception("invalid values for pairs and unique pairs: {}, {}".format(read_pairs, unique_pairs))
+    while f(M * c, c, n) >= 0:
+        M *= 10.0
+    for i in range(40):
+        r = (m + M) / 2.0
+        u = f(r * c, c, n)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return long(c * (m + M) / 2.0)
+
+def _format_value(value):
+    """Format a value as picard FormatUtil, with at most six decimals"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if np.isnan(value) or np.isinf(value):
+            return "?"
+        value = "{:.6f}".format(value).rstrip("0").rstrip(".")
+        return "0" if value == "-0" else value
+    return str(value)
+
+def write_metrics(outfile, metrics_class, columns, rows, histogram=None, command=None):
+    """Write metrics in the picard metrics file format.
+
+    :param outfile: output file name
+    :param metrics_class: picard metrics class name
+    :param columns: metrics columns
+    :param rows: list of dictionaries mapping column to value; missing values are written as empty
+    :param histogram: tuple (columns, rows) or None
+    :param command: command line written to the header
+    """
+    lines = ["## net.sf.picard.metrics.StringHeader", "# {}".format(command or "ratatosk.metrics"),
+             "## net.sf.picard.metrics.StringHeader", "# Started on: {}".format(time.strftime("%a %b %d %H:%M:%S %Z %Y")), ""]
+    if metrics_class:
+        lines += ["## METRICS CLASS\t{}".format(metrics_class), "\t".join(columns)]
+        lines += ["\t".join(_format_value(row.get(x)) for x in columns) for row in rows] + [""]
+    if histogram:
+        lines += ["## HISTOGRAM\tjava.lang.Integer", "\t".join(histogram[0])]
+        lines += ["\t".join(_format_value(x) for x in row) for row in histogram[1]] + [""]
+    tmpfile = "{}.{}.tmp".format(outfile, os.getpid())
+    with open(tmpfile, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    os.rename(tmpfile, outfile)
+
+def collect_metrics(bamfile, alignment_file=None, insert_file=None, histogram_file=None, hs_file=None,
+                    ref=None, baits=None, targets=None, chunk_size=CHUNK_SIZE):
+    """Collect metrics of a sam or bam file in a single pass, and
+    write the requested metrics files.
+
+    :param bamfile: sam or bam file name
+    :param alignment_file: alignment summary metrics output file
+    :param insert_file: insert size metrics output file
+    :param histogram_file: insert size histogram output file
+    :param hs_file: hybrid selection metrics output file
+    :param ref: reference fasta file, used for mismatch rates; must be indexed
+    :param baits: bait interval file, required for hybrid selection metrics
+    :param targets: target interval file, required for hybrid selection metrics
+    :param chunk_size: number of reads collected at a time
+    """
+    if pysam is None or np is None:
+        raise Exception("native metrics collection requires pysam and numpy")
+    if hs_file and (not baits or not targets):
+        raise Exception("need bait and target regions to collect hybrid selection metrics")
+    samfile = pysam.Samfile(bamfile, "rb" if bamfile.endswith(".bam") else "r")
+    contigs = zip(samfile.references, samfile.lengths)
+    fasta = pysam.Fastafile(ref) if ref and alignment_file else None
+    collector = _Collector(contigs, read_intervals(baits) if hs_file else None, read_intervals(targets) if hs_file else None)
+    logger.info("Collecting metrics of {}".format(bamfile))
+    for chunk in _read_chunks(samfile, fasta, chunk_size):
+        collector.add(chunk)
+    samfile.close()
+    command = "ratatosk.metrics.collect_metrics INPUT={} REFERENCE_SEQUENCE={}".format(bamfile, ref)
+    if alignment_file:
+        write_metrics(alignment_file, METRICS_CLASSES["alignment"], ALIGNMENT_COLUMNS, collector.alignment_metrics(), command=command)
+    if insert_file or histogram_file:
+        (rows, histogram) = insert_size_metrics(collector.inserts)
+        if insert_file:
+            write_metrics(insert_file, METRICS_CLASSES["insert"], INSERT_SIZE_COLUMNS, rows, histogram, command=command)
+        if histogram_file:
+            write_metrics(histogram_file, None, None, None, histogram, command=command)
+    if hs_file:
+        bait_set = os.path.basename(baits).split(".")[0]
+        write_metrics(hs_file, METRICS_CLASSES["hs"], HS_COLUMNS, collector.hs_metrics(bait_set), command=command)
@@ -20,6 +20,7 @@ It adds the following custom tasks:
 2. :class:`.VariantHaloFiltration`
 3. :class:`.HaloPlexUnifiedGenotyperAlleles`
 4. :class:`.CombineAllVariants`
+5. :class:`.HaloPlexUnifiedGenotyperAllelesBatch`
 
 The main pipeline tasks are 
 
@@ -42,6 +43,29 @@ Calling via ratatosk_run.py
    ratatosk_run.py HaloPlexCombine --indir inputdir --custom-config custom_config_file.yaml
 
 
+Fused recalibration and clipping
+--------------------------------
+
+By default, recalibration is applied by
+:class:`PrintReads <ratatosk.lib.tools.gatk.PrintReads>`, which writes
+a .recal.bam that is then read and rewritten by
+:class:`ClipReads <ratatosk.lib.tools.gatk.ClipReads>`. With the
+following custom configuration, ClipReads applies the recalibration
+table, computed on the realigned reads, in its own write pass, so
+that the .recal.bam is never generated. Target names are unchanged.
+
+.. code-block:: text
+
+   ratatosk.lib.tools.gatk:
+     ClipReads:
+       parent_task:
+         - ratatosk.lib.tools.gatk.IndelRealigner
+         - ratatosk.lib.tools.gatk.BaseRecalibrator
+       diff_label:
+         - .recal
+         - .recal
+
+
 Classes
 -------
 """
@@ -51,22 +75,26 @@ import os
 from ratatosk import backend
 from ratatosk.job import PipelineTask, JobTask, JobWrapperTask, PrintConfig
 from ratatosk.utils import make_fastq_links, rreplace, fullclassname
-from ratatosk.lib.tools.gatk import VariantEval, UnifiedGenotyper, UnifiedGenotyperAlleles, VariantFiltration, CombineVariants
+from ratatosk.lib.tools.gatk import VariantEval, UnifiedGenotyper, UnifiedGenotyperAlleles, UnifiedGenotyperAllelesBatch, VariantFiltration, CombineVariants, CombineCohortVariants
 from ratatosk.lib.variation.tabix import Bgzip
 from ratatosk.log import get_logger
 import ratatosk.lib.tools.samtools
 
 logger = get_logger()
 
-class CombineAllVariants(CombineVariants):
+class CombineAllVariants(CombineCohortVariants):
     """Combine all variants generated by :class:`.HaloPlexUnifiedGenotyperAlleles`
     """
     _config_section = "ratatosk.lib.tools.gatk"
 
-    def requires(self):
-        targets = backend.__global_vars__["targets"]
-        out_targets = list(set(["{}.{}".format(x.prefix("sample"), "trimmed.sync.sort.merge.realign.recal.clip.filtered-genotype.vcf") for x in targets]))
-        return [HaloPlexUnifiedGenotyperAlleles(target=tgt, outdir=os.path.dirname(self.target)) for tgt in out_targets]
+    def genotype_target(self, sample):
+        return "{}.{}".format(sample, "trimmed.sync.sort.merge.realign.recal.clip.filtered-genotype.vcf")
+
+    def genotype_task(self, target):
+        return HaloPlexUnifiedGenotyperAlleles(target=target, outdir=os.path.dirname(self.merge_root().target))
+
+    def genotype_batch_task(self, target, sample_targets, **kwargs):
+        return HaloPlexUnifiedGenotyperAllelesBatch(target=target, sample_targets=sample_targets, outdir=os.path.dirname(self.merge_root().target), **kwargs)
 
 class HaloPlexUnifiedGenotyperAlleles(UnifiedGenotyperAlleles):
     """ Temporary class that resolves the issue of calling
@@ -86,6 +114,14 @@ class HaloPlexUnifiedGenotyperAlleles(UnifiedGenotyperAlleles):
         return [bamcls(target=self.source()[0])]  + [CombineVariants(target=os.path.join(self.outdir, "CombinedVariants.vcf"))] + [indexcls(target=rreplace(self.source()[0], bamcls().sfx(), indexcls().sfx(), 1), parent_task=fullclassname(bamcls))]
 
 
+class HaloPlexUnifiedGenotyperAllelesBatch(UnifiedGenotyperAllelesBatch):
+    """Genotype a batch of samples with :class:`.HaloPlexUnifiedGenotyperAlleles` settings"""
+    _config_section = "ratatosk.lib.tools.gatk"
+    outdir = luigi.Parameter(description="Where analysis takes place", default=None)
+
+    def sample_task(self, target):
+        return HaloPlexUnifiedGenotyperAlleles(target=target, outdir=self.outdir)
+
 class RawUnifiedGenotyper(UnifiedGenotyper):
     """
     RawUnifiedGenotyper is a variant calling class done on merged data
@@ -172,6 +208,11 @@ class HaloPlexCombine(HaloPipeline):
     1. generating a master vcf with :class:`CombineVariants <ratatosk.lib.tools.gatk.CombineVariants>`
     2. genotyping samples at positions given by master vcf
     3. combining genotyped samples with :class:`.CombineAllVariants`
+
+    If CombineAllVariants is configured with incremental set, samples
+    added to the project are added to an existing cohort vcf without
+    regenotyping all samples at all sites. See
+    :class:`CombineCohortVariants <ratatosk.lib.tools.gatk.CombineCohortVariants>`.
     """
     def requires(self):
         self._setup()
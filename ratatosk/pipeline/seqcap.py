@@ -25,6 +25,7 @@ It adds the following custom tasks:
 3. SelectVariantsWrapper
 4. CombineAllVariants
 5. SeqCapUnifiedGenotyperAlleles
+6. SeqCapUnifiedGenotyperAllelesBatch
 
 The main pipeline tasks are 
 
@@ -35,6 +36,19 @@ Running only SeqCapSummary should invoke all dependencies in SeqCap.
 However, for many samples (>20), it is advisable to first run SeqCap
 with smaller number of samples in batches.
 
+The snp and indel variants selected by SelectVariantsWrapper and
+FiltrationWrapper can be split in-process, in a single pass of the
+variant file, by setting native for both SelectSnpVariants and
+SelectIndelVariants in the custom config:
+
+.. code-block:: text
+
+   ratatosk.lib.tools.gatk:
+     SelectSnpVariants:
+       native: true
+     SelectIndelVariants:
+       native: true
+
 Calling via ratatosk_run.py
 ----------------------------
 
@@ -51,22 +65,26 @@ import os
 import luigi
 from ratatosk import backend
 from ratatosk.job import PipelineTask, JobWrapperTask
-from ratatosk.lib.tools.gatk import  CombineVariants, SelectSnpVariants, SelectIndelVariants, VariantSnpRecalibrator, VariantIndelRecalibrator, VariantSnpRecalibrator, VariantIndelRecalibrator, VariantSnpFiltrationExp, VariantIndelFiltrationExp, VariantSnpEffAnnotator, UnifiedGenotyperAlleles
+from ratatosk.lib.tools.gatk import  CombineVariants, SelectSnpVariants, SelectIndelVariants, VariantSnpRecalibrator, VariantIndelRecalibrator, VariantSnpRecalibrator, VariantIndelRecalibrator, VariantSnpFiltrationExp, VariantIndelFiltrationExp, VariantSnpEffAnnotator, UnifiedGenotyperAlleles, UnifiedGenotyperAllelesBatch, CombineCohortVariants
 from ratatosk.utils import make_fastq_links, rreplace, fullclassname
 from ratatosk.log import get_logger
 import ratatosk.lib.tools.samtools
 
 logger = get_logger()
 
-class CombineAllVariants(CombineVariants):
+class CombineAllVariants(CombineCohortVariants):
     """Combine all variants generated by SeqCapUnifiedGenotyperAlleles"""
     _config_section = "ratatosk.lib.tools.gatk"
     parent_task = luigi.Parameter(default=("ratatosk.tools.lib.gatk.SeqCapUnifiedGenotyperAlleles", ), is_list=True)
 
-    def requires(self):
-        targets = backend.__global_vars__["targets"]
-        out_targets = list(set(["{}.{}".format(x.prefix("sample"), "sort.merge.dup.realign.recal-variants-combined-phased-annotated-genotype.vcf") for x in targets]))
-        return [SeqCapUnifiedGenotyperAlleles(target=tgt, outdir=os.path.dirname(self.target)) for tgt in out_targets]
+    def genotype_target(self, sample):
+        return "{}.{}".format(sample, "sort.merge.dup.realign.recal-variants-combined-phased-annotated-genotype.vcf")
+
+    def genotype_task(self, target):
+        return SeqCapUnifiedGenotyperAlleles(target=target, outdir=os.path.dirname(self.merge_root().target))
+
+    def genotype_batch_task(self, target, sample_targets, **kwargs):
+        return SeqCapUnifiedGenotyperAllelesBatch(target=target, sample_targets=sample_targets, outdir=os.path.dirname(self.merge_root().target), **kwargs)
 
 class SeqCapUnifiedGenotyperAlleles(UnifiedGenotyperAlleles):
     """ Temporary class that resolves the issue of calling
@@ -85,6 +103,14 @@ class SeqCapUnifiedGenotyperAlleles(UnifiedGenotyperAlleles):
         retval = [bamcls(target=self.source()[0])]  + [CombineVariants(target=os.path.join(self.outdir, "CombinedVariants.vcf"))] + [indexcls(target=rreplace(self.source()[0], bamcls().sfx(), indexcls().sfx(), 1), parent_task=fullclassname(bamcls))]
         return [bamcls(target=self.source()[0])]  + [CombineVariants(target=os.path.join(self.outdir, "CombinedVariants.vcf"))] + [indexcls(target=rreplace(self.source()[0], bamcls().sfx(), indexcls().sfx(), 1), parent_task=fullclassname(bamcls))]
 
+class SeqCapUnifiedGenotyperAllelesBatch(UnifiedGenotyperAllelesBatch):
+    """Genotype a batch of samples with :class:`.SeqCapUnifiedGenotyperAlleles` settings"""
+    _config_section = "ratatosk.lib.tools.gatk"
+    outdir = luigi.Parameter(description="Where analysis takes place", default=None)
+
+    def sample_task(self, target):
+        return SeqCapUnifiedGenotyperAlleles(target=target, outdir=self.outdir)
+
 class CombineFilteredVariants(CombineVariants):
     """
     CombineVariants is called elsewhere in pipeline so this class is
@@ -97,16 +123,10 @@ class CombineFilteredVariants(CombineVariants):
     suffix = ".vcf"
     split_by = None
 
-    def args(self):
+    def leaf_tasks(self):
+        """Combine the outputs of the tasks wrapped by the parent task"""
         cls = self.parent()[0]
-        retval = []
-        for x in cls(target=self.source()).input():
-            retval += ["-V", x]
-        retval += ["-o", self.output()]
-        if not self.ref:
-            raise Exception("need reference for CombineVariants")
-        retval += ["-R", self.ref]
-        return retval
+        return cls(target=self.source()[0]).requires()
 
 class FiltrationWrapper(JobWrapperTask):
     """
@@ -191,6 +211,11 @@ class SeqCap(SeqCapPipeline):
         return [VariantSnpEffAnnotator(target=tgt) for tgt in out_targets]
 
 class SeqCapSummary(SeqCapPipeline):
+    """Genotype samples at the positions of a master vcf and combine
+    them with :class:`.CombineAllVariants`. If CombineAllVariants is
+    configured with incremental set, samples added to the project are
+    added to an existing cohort vcf without regenotyping all samples
+    at all sites."""
     def requires(self):
         self._setup()
         return [CombineAllVariants(target=os.path.join(self.outdir, "CombinedVariantsAll.vcf"))]
@@ -0,0 +1,143 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Functions for critical path scheduling of tasks.
+
+The priority of a task is the length of the longest path from the
+task to the root of the dependency graph, where every task on the
+path is weighted by its expected runtime. Expected runtimes are taken
+from a runtime history file, if one is given, and otherwise from the
+declared :attr:`expected_runtime <ratatosk.job.BaseJobTask.expected_runtime>`
+of the task class.
+
+"""
+import os
+import time
+from luigi.task import flatten
+from ratatosk.utils import fullclassname
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+# Cache of parsed runtime history files, keyed by path. Values are
+# tuples (mtime, history dict).
+_history_cache = {}
+
+def record_runtime(history_file, task, runtime):
+    """Append the runtime of a task to a runtime history file. Each
+    line consists of class name, runtime in seconds and number of
+    threads, separated by tabs.
+
+    :param history_file: runtime history file name
+    :param task: task instance
+    :param runtime: runtime in seconds
+    """
+    if not history_file:
+        return
+    line = "{}\t{:.1f}\t{}\n".format(fullclassname(task.__class__), runtime, task.threads())
+    try:
+        with open(os.path.expanduser(history_file), "a") as fh:
+            fh.write(line)
+    except IOError:
+        logger.warn("Failed to write runtime to history file {}".format(history_file))
+
+def read_runtime_history(history_file):
+    """Read a runtime history file.
+
+    :param history_file: runtime history file name
+
+    :returns: dictionary mapping class name to a list of (runtime, threads) tuples
+    """
+    if not history_file:
+        return {}
+    history_file = os.path.expanduser(history_file)
+    if not os.path.exists(history_file):
+        return {}
+    mtime = os.stat(history_file).st_mtime
+    if history_file in _history_cache and _history_cache[history_file][0] == mtime:
+        return _history_cache[history_file][1]
+    history = {}
+    with open(history_file) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            try:
+                history.setdefault(fields[0], []).append((float(fields[1]), int(fields[2])))
+            except ValueError:
+                continue
+    _history_cache[history_file] = (mtime, history)
+    return history
+
+def expected_runtime(task, history=None):
+    """Get the expected runtime of a task in seconds. Mean historical
+    runtime is preferred over the declared runtime.
+
+    :param task: task instance
+    :param history: runtime history as returned by :func:`read_runtime_history`
+
+    :returns: expected runtime in seconds
+    """
+    runtimes = (history or {}).get(fullclassname(task.__class__), [])
+    if runtimes:
+        return sum(x[0] for x in runtimes) / len(runtimes)
+    return 60.0 * getattr(task, "expected_runtime", 0)
+
+def _topological_order(root):
+    """Order the task graph rooted at root so that every task comes
+    before all of its dependencies.
+
+    :param root: root task
+
+    :returns: tuple (ordered task list, dictionary mapping task_id to dependent tasks)
+    """
+    postorder = []
+    dependents = {root.task_id: []}
+    visited = set([root.task_id])
+    stack = [(root, iter(flatten(root.requires())))]
+    while stack:
+        task, children = stack[-1]
+        for child in children:
+            dependents.setdefault(child.task_id, []).append(task)
+            if child.task_id not in visited:
+                visited.add(child.task_id)
+                stack.append((child, iter(flatten(child.requires()))))
+                break
+        else:
+            stack.pop()
+            postorder.append(task)
+    postorder.reverse()
+    return (postorder, dependents)
+
+def assign_priorities(root, history_file=None):
+    """Assign critical path priorities to all tasks in the task graph
+    rooted at root. The priority is stored in the attribute
+    ``_priority``, which is exposed via the luigi ``priority``
+    property of :class:`ratatosk.job.BaseJobTask`.
+
+    :param root: root task
+    :param history_file: runtime history file name
+
+    :returns: dictionary mapping task_id to priority
+    """
+    t0 = time.time()
+    history = read_runtime_history(history_file)
+    (order, dependents) = _topological_order(root)
+    priorities = {}
+    for task in order:
+        downstream = [priorities[x.task_id] for x in dependents[task.task_id]]
+        priorities[task.task_id] = expected_runtime(task, history) + max(downstream + [0])
+        task._priority = priorities[task.task_id]
+    logger.debug("Assigned critical path priorities to {} tasks in {:.2f}s".format(len(order), time.time() - t0))
+    return priorities
@@ -0,0 +1,178 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Reference sequence metadata.
+
+Contig names and lengths are read from the fasta index (.fai) of a
+reference, or from its sequence dictionary (.dict) if there is no
+index. The metadata is parsed once and cached, both in memory and in a
+compact on-disk form in :data:`CACHE_DIR`, keyed by reference path and
+modification time of the index or dictionary.
+
+"""
+import os
+import hashlib
+from ratatosk.interval import scatter_intervals
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ratatosk", "reference")
+"""Directory for on-disk reference metadata cache"""
+
+# Cache of reference metadata, keyed by reference path. Values are
+# tuples (metadata file, mtime, list of (contig, length) tuples).
+_reference_cache = {}
+
+def read_sequence_dictionary(dictfile):
+    """Read contig names and lengths from a sequence dictionary.
+
+    :param dictfile: sequence dictionary (.dict) file name
+
+    :returns: list of (contig, length) tuples
+    """
+    contigs = []
+    with open(os.path.expanduser(dictfile)) as fh:
+        for line in fh:
+            if not line.startswith("@SQ"):
+                continue
+            fields = dict(x.split(":", 1) for x in line.rstrip("\n").split("\t")[1:] if ":" in x)
+            contigs.append((fields["SN"], int(fields["LN"])))
+    return contigs
+
+def read_fasta_index(faifile):
+    """Read contig names and lengths from a fasta index.
+
+    :param faifile: fasta index (.fai) file name
+
+    :returns: list of (contig, length) tuples
+    """
+    contigs = []
+    with open(os.path.expanduser(faifile)) as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                continue
+            contigs.append((fields[0], int(fields[1])))
+    return contigs
+
+def _metadata_file(ref):
+    """Get the metadata file of a reference, preferring the fasta
+    index over the sequence dictionary.
+
+    :param ref: reference fasta file name
+
+    :returns: metadata file name
+    """
+    ref = os.path.expanduser(ref)
+    for fn in [ref + ".fai", os.path.splitext(ref)[0] + ".dict"]:
+        if os.path.exists(fn):
+            return fn
+    raise Exception("no fasta index or sequence dictionary for reference {}".format(ref))
+
+def _cache_file(ref):
+    return os.path.join(CACHE_DIR, hashlib.md5(os.path.abspath(os.path.expanduser(ref))).hexdigest() + ".contigs")
+
+def _read_cache(ref, mtime):
+    """Read cached contig lengths, if the cache is up to date"""
+    cachefile = _cache_file(ref)
+    if not os.path.exists(cachefile):
+        return None
+    try:
+        with open(cachefile) as fh:
+            if fh.readline().rstrip("\n") != "#{}\t{}".format(os.path.abspath(os.path.expanduser(ref)), mtime):
+                return None
+            return [(c, int(l)) for c, l in (line.rstrip("\n").split("\t") for line in fh)]
+    except (IOError, ValueError):
+        return None
+
+def _write_cache(ref, mtime, contigs):
+    """Write contig lengths to on-disk cache. Failures are ignored."""
+    cachefile = _cache_file(ref)
+    try:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(cachefile + ".tmp", "w") as fh:
+            fh.write("#{}\t{}\n".format(os.path.abspath(os.path.expanduser(ref)), mtime))
+            fh.write("".join("{}\t{}\n".format(c, l) for c, l in contigs))
+        os.rename(cachefile + ".tmp", cachefile)
+    except (IOError, OSError):
+        logger.debug("Failed to write reference cache {}".format(cachefile))
+
+def contig_lengths(ref):
+    """Get contig names and lengths of a reference, in reference order.
+
+    :param ref: reference fasta file name
+
+    :returns: list of (contig, length) tuples
+    """
+    metafile = _metadata_file(ref)
+    mtime = os.stat(metafile).st_mtime
+    if ref in _reference_cache and _reference_cache[ref][:2] == (metafile, mtime):
+        return _reference_cache[ref][2]
+    contigs = _read_cache(ref, mtime)
+    if contigs is None:
+        if metafile.endswith(".fai"):
+            contigs = read_fasta_index(metafile)
+        else:
+            contigs = read_sequence_dictionary(metafile)
+        _write_cache(ref, mtime, contigs)
+    _reference_cache[ref] = (metafile, mtime, contigs)
+    return contigs
+
+def contigs(ref):
+    """Get contig names of a reference, in reference order.
+
+    :param ref: reference fasta file name
+
+    :returns: list of contig names
+    """
+    return [c for c, _ in contig_lengths(ref)]
+
+def contig_offsets(ref):
+    """Get the offsets of contigs in the concatenated reference.
+
+    :param ref: reference fasta file name
+
+    :returns: dictionary mapping contig name to 0-based offset
+    """
+    offsets = {}
+    offset = 0
+    for c, l in contig_lengths(ref):
+        offsets[c] = offset
+        offset += l
+    return offsets
+
+def genome_length(ref):
+    """Get the total length of a reference.
+
+    :param ref: reference fasta file name
+
+    :returns: reference length
+    """
+    return sum(l for _, l in contig_lengths(ref))
+
+def partition(ref, n, region=None, split=True):
+    """Partition a reference, or a region of it, into at most n groups
+    of intervals of roughly equal length. See
+    :func:`ratatosk.interval.scatter_intervals`.
+
+    :param ref: reference fasta file name
+    :param n: number of groups
+    :param region: interval file name or interval string to partition
+    :param split: allow intervals to be split between groups
+
+    :returns: list of interval lists
+    """
+    return scatter_intervals(contig_lengths(ref), n, region=region, split=split)
@@ -14,6 +14,7 @@
 
 import os
 import re
+from ratatosk.evaluation import read_report, table_rows
 
 METRICS_TYPES=['align', 'hs', 'dup', 'insert']
 
@@ -27,6 +28,12 @@ def index_containing_substring(the_list, substring):
 def _raw(x):
     return (x, None)
 
+def _read_gatk_report(f):
+    """Read a VariantEval GATKReport as a long-format table, see
+    :func:`ratatosk.evaluation.table_rows`"""
+    rows = table_rows(read_report(f))
+    return ([[_convert_input(y) for y in x] for x in rows], None)
+
 def _convert_input(x):
     if re.match("^[0-9]+$", x):
         return int(x)
@@ -75,7 +82,8 @@ EXTENSIONS={'.align_metrics':('align', 'alignment', _read_picard_metrics),
             '.hs_metrics':('hs', 'hybrid selection', _read_picard_metrics),
             '.dup_metrics':('dup', 'duplication metrics', _read_picard_metrics),
             '.insert_metrics':('insert', 'insert size', _read_picard_metrics),
-            '.eval_metrics':('eval', 'snp evaluation', _raw)
+            '.eval_metrics':('eval', 'snp evaluation', _read_gatk_report),
+            '.eval_table':('eval', 'snp evaluation', _read_picard_metrics)
             }
 
 class PicardMetrics(object):
@@ -0,0 +1,106 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Functions for sizing tasks to the resources of a compute node.
+
+GATK walkers are parallelized with data threads (-nt), each of which
+holds its own copy of the data in memory, and/or cpu threads (-nct),
+which share memory. The thread counts of a walker are chosen so that
+concurrently running jobs share the cores and memory of a node, and
+limited to the thread count beyond which the walker has historically
+stopped scaling.
+
+"""
+import os
+import multiprocessing
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+def available_cores():
+    """Get the number of cores of the node"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def available_memory_gb():
+    """Get the physical memory of the node in Gb, or None if unknown"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / float(1024 ** 3)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def scaling_limit(runtimes, max_threads, min_efficiency=0.5):
+    """Get the largest thread count at which a task has historically
+    scaled with at least min_efficiency parallel efficiency, compared
+    to the smallest thread count it has run with.
+
+    :param runtimes: list of (runtime, threads) tuples, as in :func:`ratatosk.priority.read_runtime_history`
+    :param max_threads: max number of threads
+    :param min_efficiency: minimum parallel efficiency, i.e. speedup divided by relative thread count
+
+    :returns: thread count
+    """
+    means = {}
+    for runtime, threads in runtimes:
+        means.setdefault(threads, []).append(runtime)
+    means = dict((t, float(sum(r)) / len(r)) for t, r in means.items() if t > 0)
+    if len(means) < 2:
+        return max_threads
+    base = min(means.keys())
+    limit = base
+    for t in sorted(means.keys()):
+        if t > max_threads:
+            break
+        efficiency = (means[base] / means[t]) / (float(t) / base) if means[t] > 0 else 0
+        if efficiency < min_efficiency:
+            break
+        limit = t
+    # Thread counts beyond observed ones are untested; allow them if
+    # the largest observed count still scaled
+    if limit == max(means.keys()):
+        return max_threads
+    return limit
+
+def gatk_threads(data_threads, cpu_threads, memory_gb, data_thread_memory_gb, concurrent_jobs=1, runtimes=None, cores=None, node_memory_gb=None):
+    """Choose data (-nt) and cpu (-nct) thread counts for a GATK
+    walker.
+
+    :param data_threads: walker supports -nt
+    :param cpu_threads: walker supports -nct
+    :param memory_gb: memory reservation of the task
+    :param data_thread_memory_gb: memory needed per data thread
+    :param concurrent_jobs: number of jobs that share the node
+    :param runtimes: historical (runtime, threads) tuples of the walker
+    :param cores: number of cores of the node; detected if None
+    :param node_memory_gb: memory of the node; detected if None
+
+    :returns: tuple (nt, nct), where unsupported options are None
+    """
+    cores = cores or available_cores()
+    budget = max(1, int(cores) // max(1, int(concurrent_jobs)))
+    node_memory_gb = node_memory_gb or available_memory_gb()
+    if node_memory_gb:
+        memory_gb = min(float(memory_gb), node_memory_gb / max(1, int(concurrent_jobs)))
+    if runtimes:
+        budget = max(1, scaling_limit(runtimes, budget))
+    nt = None
+    nct = None
+    if data_threads:
+        nt = max(1, min(budget, int(float(memory_gb) // float(data_thread_memory_gb))))
+    if cpu_threads:
+        nct = max(1, budget // (nt or 1))
+    logger.debug("Using {} data threads and {} cpu threads out of {} cores".format(nt, nct, cores))
+    return (nt, nct)
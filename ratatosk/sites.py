@@ -0,0 +1,152 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Region-restricted copies of known sites resources.
+
+Known sites resources, such as dbsnp, are whole-genome vcf files,
+whereas walkers restricted to a target region only need the sites
+within the region. Copies of resources restricted to a region are
+generated once and cached in :data:`CACHE_DIR`, keyed by the checksum
+of the resource and of the region. If pysam is installed, copies are
+bgzipped and tabix indexed, and indexed resources are read with tabix.
+
+"""
+import os
+import hashlib
+from ratatosk.interval import region_intervals, interval_index, overlaps
+from ratatosk.vcf import open_vcf, strip_sfx
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".ratatosk", "sites")
+"""Directory for region-restricted resource copies"""
+
+# Cache of resource checksums, keyed by (path, size, mtime)
+_checksum_cache = {}
+
+def checksum(fn):
+    """Get the md5 checksum of a file. Checksums are cached in memory
+    and on disk, keyed by file path, size and modification time.
+
+    :param fn: file name
+
+    :returns: hex digest
+    """
+    fn = os.path.abspath(os.path.expanduser(fn))
+    st = os.stat(fn)
+    key = "{}\t{}\t{}".format(fn, st.st_size, st.st_mtime)
+    if key in _checksum_cache:
+        return _checksum_cache[key]
+    cachefile = os.path.join(CACHE_DIR, hashlib.md5(fn).hexdigest() + ".md5")
+    if os.path.exists(cachefile):
+        with open(cachefile) as fh:
+            if fh.readline().rstrip("\n") == "#" + key:
+                _checksum_cache[key] = fh.readline().strip()
+                return _checksum_cache[key]
+    md5 = hashlib.md5()
+    with open(fn, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), ""):
+            md5.update(block)
+    _checksum_cache[key] = md5.hexdigest()
+    try:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(cachefile, "w") as fh:
+            fh.write("#{}\n{}\n".format(key, _checksum_cache[key]))
+    except (IOError, OSError):
+        logger.debug("Failed to write checksum cache {}".format(cachefile))
+    return _checksum_cache[key]
+
+def region_checksum(region):
+    """Get the md5 checksum of a region, given as an interval file or
+    an interval string"""
+    if os.path.exists(os.path.expanduser(region)):
+        return checksum(region)
+    return hashlib.md5(region).hexdigest()
+
+def subset_file(resource, region):
+    """Get the name of the region-restricted copy of a resource.
+
+    :param resource: vcf file name
+    :param region: interval file name or interval string
+
+    :returns: file name in :data:`CACHE_DIR`
+    """
+    sfx = ".vcf.gz" if pysam else ".vcf"
+    return os.path.join(CACHE_DIR, "{}-{}{}".format(checksum(resource)[0:16], region_checksum(region)[0:16], sfx))
+
+def _read_sites(resource, intervals):
+    """Read header and records of resource overlapping intervals"""
+    header = []
+    records = []
+    if pysam and resource.endswith(".gz") and os.path.exists(resource + ".tbi"):
+        with open_vcf(resource) as fh:
+            for line in fh:
+                if not line.startswith("#"):
+                    break
+                header.append(line)
+        tbx = pysam.Tabixfile(resource)
+        for (contig, start, end) in intervals:
+            if contig in tbx.contigs:
+                records += [x + "\n" for x in tbx.fetch(contig, start - 1, end)]
+        return (header, records)
+    index = interval_index(intervals)
+    with open_vcf(resource) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                header.append(line)
+                continue
+            fields = line.split("\t", 4)
+            (pos, end) = (int(fields[1]), int(fields[1]) + len(fields[3]) - 1)
+            if overlaps(index, fields[0], pos, end):
+                records.append(line)
+    return (header, records)
+
+def subset(resource, region, contigs):
+    """Generate the region-restricted copy of a resource, unless it
+    is already cached.
+
+    :param resource: vcf file name
+    :param region: interval file name or interval string
+    :param contigs: list of (contig, length) tuples of the reference
+
+    :returns: file name of the region-restricted copy
+    """
+    outfile = subset_file(resource, region)
+    if os.path.exists(outfile):
+        return outfile
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    logger.info("Restricting {} to {} in {}".format(resource, region, outfile))
+    (header, records) = _read_sites(os.path.expanduser(resource), region_intervals(region, contigs))
+    order = dict((c, i) for i, (c, _) in enumerate(contigs))
+    records = sorted(set(records), key=lambda x: (order.get(x.split("\t", 1)[0], len(order)), int(x.split("\t", 2)[1])))
+    # Write to a private file first, since concurrent jobs may
+    # generate the same copy
+    tmpfile = "{}.{}.tmp.vcf".format(strip_sfx(outfile), os.getpid())
+    with open(tmpfile, "w") as fh:
+        fh.write("".join(header + records))
+    if pysam:
+        pysam.tabix_index(tmpfile, preset="vcf", force=True)
+        os.rename(tmpfile + ".gz.tbi", outfile + ".tbi")
+        os.rename(tmpfile + ".gz", outfile)
+    else:
+        os.rename(tmpfile, outfile)
+    return outfile
@@ -71,6 +71,76 @@ def rreplace(s, old, new, occurrence):
     li = s.rsplit(old, occurrence)
     return new.join(li)
 
+def shard_target(target, sfx, index):
+    """Get the target name of a shard of a scattered task. Shards of
+    {base}{sfx} are named {base}-scatter/{base}.{index}{sfx}.
+
+    :param target: target name of the gathered task
+    :param sfx: target suffix
+    :param index: shard index
+
+    :returns: shard target name
+    """
+    base = rreplace(target, sfx, "", 1)
+    return os.path.join("{}-scatter".format(base), "{}.{:04d}{}".format(os.path.basename(base), int(index), sfx))
+
+def gather_target(target, sfx):
+    """Get the gathered target name of a shard, i.e. the inverse of
+    :func:`shard_target`.
+
+    :param target: shard target name
+    :param sfx: target suffix
+
+    :returns: gathered target name
+    """
+    return rreplace(os.path.dirname(target), "-scatter", "", 1) + sfx
+
+def _shard_parts(target):
+    """Split shard target {base}-scatter/{base}.{index}{rest} into
+    (base, index, rest)"""
+    sharddir = os.path.dirname(target)
+    base = rreplace(sharddir, "-scatter", "", 1)
+    m = re.match(r"{}\.(\d+)(.*)$".format(re.escape(os.path.basename(base))), os.path.basename(target))
+    if not sharddir.endswith("-scatter") or not m:
+        raise Exception("{} is not a shard target".format(target))
+    return (base, int(m.group(1)), m.group(2))
+
+def sibling_shard_target(target, index):
+    """Get the target name of another shard of the same scattered
+    file. Unlike :func:`shard_target`, shard names may carry labels
+    after the index, e.g. read suffixes, as in
+    {base}-scatter/{base}.{index}_R1_001.fastq.gz.
+
+    :param target: shard target name
+    :param index: shard index of the sibling
+
+    :returns: shard target name
+    """
+    (base, _, rest) = _shard_parts(target)
+    return os.path.join(os.path.dirname(target), "{}.{:04d}{}".format(os.path.basename(base), int(index), rest))
+
+def unscattered_target(target):
+    """Get the name of the file of which target is a shard, keeping
+    labels after the index, i.e. {base}{rest} for shard
+    {base}-scatter/{base}.{index}{rest}.
+
+    :param target: shard target name
+
+    :returns: unscattered target name
+    """
+    (base, _, rest) = _shard_parts(target)
+    return base + rest
+
+def relative_symlink(src, dst):
+    """Symlink dst to src, with a link path relative to the directory
+    of dst.
+
+    :param src: source file name
+    :param dst: link name
+    """
+    dstdir = os.path.dirname(dst) or os.curdir
+    os.symlink(os.path.relpath(src, dstdir), dst)
+
 # http://stackoverflow.com/questions/2020014/get-fully-qualified-class-name-of-an-object-in-python
 def fullclassname(o):
     return o.__module__ + "." + o.__name__
@@ -0,0 +1,150 @@
+# Copyright (c) 2013 Per Unneberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""
+Functions for streaming vcf files in-process.
+
+Variant types follow the GATK definitions used by SelectVariants
+--selectTypeToInclude: a record without alternate alleles is
+NO_VARIATION; an alternate allele is SYMBOLIC if it is a symbolic or
+breakend allele, SNP or MNP if it has the length of the reference
+allele (one or several bases), and INDEL otherwise. Records whose
+alternate alleles are of different types are MIXED.
+
+"""
+import os
+import gzip
+import shutil
+from ratatosk.interval import interval_index, overlaps
+from ratatosk.log import get_logger
+
+logger = get_logger()
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+VARIANT_TYPES = ["NO_VARIATION", "SNP", "MNP", "INDEL", "SYMBOLIC", "MIXED"]
+"""GATK variant types"""
+
+def open_vcf(fn, mode="r"):
+    """Open a plain, gzipped or bgzipped vcf file.
+
+    :param fn: file name
+    :param mode: file mode
+
+    :returns: file handle
+    """
+    if fn.endswith(".gz"):
+        return gzip.open(fn, mode)
+    return open(fn, mode)
+
+def strip_sfx(fn):
+    """Strip vcf suffix from file name"""
+    for sfx in [".vcf.gz", ".vcf"]:
+        if fn.endswith(sfx):
+            return fn[:-len(sfx)]
+    return fn
+
+def _is_symbolic(allele):
+    """Symbolic alleles (<DEL>), breakends (G]17:198982]) and single breakends (.A, G.)"""
+    return allele.startswith("<") or "[" in allele or "]" in allele or allele.startswith(".") or allele.endswith(".")
+
+def variant_type(ref, alt):
+    """Get the GATK variant type of a vcf record.
+
+    :param ref: REF column
+    :param alt: ALT column
+
+    :returns: variant type, one of :data:`VARIANT_TYPES`
+    """
+    alleles = [x for x in alt.split(",") if x != "."]
+    if not alleles:
+        return "NO_VARIATION"
+    types = set()
+    for allele in alleles:
+        if _is_symbolic(allele):
+            types.add("SYMBOLIC")
+        elif len(allele) == len(ref):
+            types.add("SNP" if len(ref) == 1 else "MNP")
+        else:
+            types.add("INDEL")
+    if len(types) > 1:
+        return "MIXED"
+    return types.pop()
+
+def move_output(tmpfile, outfile):
+    """Move a temporary plain vcf file to its final destination,
+    compressing it if the output is gzipped.
+
+    :param tmpfile: temporary vcf file name
+    :param outfile: output file name
+    """
+    if not outfile.endswith(".gz"):
+        os.rename(tmpfile, outfile)
+        return
+    if pysam:
+        pysam.tabix_compress(tmpfile, tmpfile + ".gz", force=True)
+    else:
+        with open(tmpfile, "rb") as fh, gzip.open(tmpfile + ".gz", "wb") as out:
+            shutil.copyfileobj(fh, out)
+    os.unlink(tmpfile)
+    os.rename(tmpfile + ".gz", outfile)
+
+def split_variants(vcffile, outputs, intervals=None):
+    """Split the records of a vcf file by variant type, in a single
+    pass of the file. Every output gets the header of the input and
+    the records of the variant types it selects; a record is written
+    to all outputs that select its type.
+
+    :param vcffile: input vcf file, plain or gzipped
+    :param outputs: list of (variant types, output file name) tuples
+    :param intervals: list of (contig, start, end) tuples; if given, only records overlapping the intervals are kept, as with the GATK -L option
+
+    :returns: list of record counts, one per output
+    """
+    index = interval_index(intervals) if intervals is not None else None
+    select = {}
+    for i, (types, _) in enumerate(outputs):
+        for t in types:
+            if not t in VARIANT_TYPES:
+                raise Exception("unknown variant type {}".format(t))
+            select.setdefault(t, []).append(i)
+    tmpfiles = ["{}.{}.tmp.vcf".format(strip_sfx(outfile), os.getpid()) for (_, outfile) in outputs]
+    handles = [open(fn, "w") for fn in tmpfiles]
+    counts = [0] * len(outputs)
+    try:
+        with open_vcf(vcffile) as fh:
+            for line in fh:
+                if line.startswith("#"):
+                    for out in handles:
+                        out.write(line)
+                    continue
+                fields = line.split("\t", 5)
+                if index is not None and not overlaps(index, fields[0], int(fields[1]), int(fields[1]) + len(fields[3]) - 1):
+                    continue
+                for i in select.get(variant_type(fields[3], fields[4]), []):
+                    handles[i].write(line)
+                    counts[i] += 1
+    except:
+        for out, fn in zip(handles, tmpfiles):
+            out.close()
+            os.unlink(fn)
+        raise
+    for out in handles:
+        out.close()
+    for fn, (_, outfile) in zip(tmpfiles, outputs):
+        move_output(fn, outfile)
+    logger.info("Split {} into {}".format(vcffile, ", ".join("{} ({} records)".format(outfile, n) for (_, outfile), n in zip(outputs, counts))))
+    return counts
@@ -27,6 +27,11 @@ from ratatosk.job import JobTask, InputJobTask
 from ratatosk.jobrunner import DefaultShellJobRunner
 from ratatosk.lib.align.bwa import Index, Bampe
 import ratatosk.lib.tools.picard
+import ratatosk.lib.tools.gatk
+import ratatosk.pipeline.haloplex
+import ratatosk.filtration
+import ratatosk.metrics
+import ratatosk.report.picard
 from nose.plugins.attrib import attr
 
 logging.basicConfig(level=logging.DEBUG)
@@ -242,3 +247,85 @@ class TestPipedCommand(unittest.TestCase):
 
     def test_bampe(self):
         luigi.run(['--target', "data/sample1.bam", '--config-file', localconf],main_task_cls=Bampe)
+
+@attr("full")
+@unittest.skipIf((os.getenv("GATK_HOME") is None or os.getenv("GATK_HOME") == ""), "No environment GATK_HOME set; skipping")
+class TestFiltrationParity(unittest.TestCase):
+    """Compare native hard filtering to GATK VariantFiltration"""
+    def setUp(self):
+        self.outfiles = ["data/filtration.filtered.vcf", "data/filtration.native.vcf"]
+
+    def tearDown(self):
+        for fn in self.outfiles:
+            for x in [fn, fn + ".idx"]:
+                if os.path.exists(x):
+                    os.unlink(x)
+
+    def _filters(self, fn):
+        with open(fn) as fh:
+            return [x.split("\t")[0:2] + [x.split("\t")[6]] for x in fh if not x.startswith("#")]
+
+    def _compare(self, task):
+        task.job_runner().run_job(task)
+        ratatosk.filtration.filter_variants(task.input()[0].path, self.outfiles[1], **ratatosk.filtration.filter_options(task.opts()))
+        self.assertEqual(self._filters(self.outfiles[0]), self._filters(self.outfiles[1]))
+
+    def test_snp_expressions(self):
+        self._compare(ratatosk.lib.tools.gatk.VariantSnpFiltrationExp(target=self.outfiles[0], label=".filtered", ref=ref))
+
+    def test_indel_expressions(self):
+        self._compare(ratatosk.lib.tools.gatk.VariantIndelFiltrationExp(target=self.outfiles[0], label=".filtered", ref=ref))
+
+    def test_halo_filtration(self):
+        self._compare(ratatosk.pipeline.haloplex.VariantHaloFiltration(target=self.outfiles[0], ref=ref))
+
+@attr("full")
+@unittest.skipIf((os.getenv("PICARD_HOME") is None or os.getenv("PICARD_HOME") == ""), "No environment PICARD_HOME set; skipping")
+@unittest.skipIf(ratatosk.metrics.pysam is None, "pysam not installed; skipping")
+class TestMetricsParity(unittest.TestCase):
+    """Compare native metrics to picard. Columns that are empty in
+    the native metrics are not compared."""
+    def setUp(self):
+        self.bam = "data/sample1.sort.dup.bam"
+        self.prefix = "data/sample1.sort.dup"
+        self.outfiles = []
+        luigi.build([ratatosk.lib.tools.picard.DuplicationMetrics(target=self.bam)], local_scheduler=True)
+
+    def tearDown(self):
+        for fn in self.outfiles:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def _compare(self, picard_file, native_file):
+        picard = ratatosk.report.picard.PicardMetrics("picard", picard_file)
+        native = ratatosk.report.picard.PicardMetrics("native", native_file)
+        self.assertEqual(picard.metrics()[0], native.metrics()[0])
+        self.assertEqual(len(picard.metrics()), len(native.metrics()))
+        for prow, nrow in zip(picard.metrics()[1:], native.metrics()[1:]):
+            for column, p, n in zip(picard.metrics()[0], prow, nrow):
+                if n == "":
+                    continue
+                if isinstance(n, str):
+                    self.assertEqual(p, n, column)
+                else:
+                    self.assertAlmostEqual(p, n, delta=max(1e-6, abs(p) * 1e-4), msg=column)
+        self.assertEqual(picard.hist(), native.hist())
+
+    def _run(self, task, native_file, **kwargs):
+        self.outfiles += [x.path for x in luigi.task.flatten(task.output())] + [native_file]
+        task.job_runner().run_job(task)
+        ratatosk.metrics.collect_metrics(self.bam, **dict(kwargs, ref=ref))
+        self._compare(luigi.task.flatten(task.output())[0].path, native_file)
+
+    def test_alignment_metrics(self):
+        task = ratatosk.lib.tools.picard.AlignmentMetrics(target=self.prefix + ".align_metrics", ref=ref)
+        self._run(task, self.prefix + ".native.align_metrics", alignment_file=self.prefix + ".native.align_metrics")
+
+    def test_insert_metrics(self):
+        task = ratatosk.lib.tools.picard.InsertMetrics(target=self.prefix + ".insert_metrics")
+        self._run(task, self.prefix + ".native.insert_metrics", insert_file=self.prefix + ".native.insert_metrics")
+
+    def test_hs_metrics(self):
+        task = ratatosk.lib.tools.picard.HsMetrics(target=self.prefix + ".hs_metrics")
+        (baits, targets) = task.regions()
+        self._run(task, self.prefix + ".native.hs_metrics", hs_file=self.prefix + ".native.hs_metrics", baits=baits, targets=targets)
@@ -1,5 +1,7 @@
 import os
+import gzip
 import shutil
+import struct
 import unittest
 import luigi
 import logging
@@ -13,8 +15,23 @@ import ratatosk.lib.tools.gatk as GATK
 import ratatosk.lib.utils.cutadapt as CUTADAPT
 import ratatosk.lib.tools.fastqc as FASTQC
 import ratatosk.lib.files.external
+import ratatosk.pipeline.haloplex as HALOPLEX
+import ratatosk.backend
+from ratatosk.jobrunner import DefaultShellJobRunner
 from ratatosk.config import get_config
-from ratatosk.utils import make_fastq_links, rreplace, determine_read_type
+from ratatosk.utils import make_fastq_links, rreplace, determine_read_type, sibling_shard_target, unscattered_target
+from ratatosk.interval import partition_intervals, scatter_intervals, interval_length
+from ratatosk.reference import read_sequence_dictionary
+import ratatosk.reference
+import ratatosk.interval
+import ratatosk.bam
+import ratatosk.resources
+import ratatosk.sites
+import ratatosk.vcf
+import ratatosk.filtration
+import ratatosk.evaluation
+import ratatosk.metrics
+from ratatosk.report.picard import PicardMetrics
 
 logging.basicConfig(level=logging.DEBUG)
 sample = "P001_101_index3_TGACCA_L001"
@@ -184,6 +201,571 @@ class TestGeneralFunctions(unittest.TestCase):
                                                                    'ratatosk.lib.tools.gatk.UnifiedGenotyper',])
         self.assertEqual(task.source(), ['data/sample.dup.merge.bam', 'data/sample.merge.dup.intervals', 'data/sample.merge.dup.vcf'])
 
+    def test_shard_source(self):
+        """Test that shards of a scattered task generate sources from the gathered target"""
+        target = GATK.shard_target("data/sample.merge.dup.recal.bam", ".bam", 3)
+        self.assertEqual(target, "data/sample.merge.dup.recal-scatter/sample.merge.dup.recal.0003.bam")
+        self.assertEqual(GATK.gather_target(target, ".bam"), "data/sample.merge.dup.recal.bam")
+        task = ratatosk.lib.tools.gatk.PrintReads(target=target, scatter_index=3, scatter_count=4)
+        self.assertEqual(task.source(), ['data/sample.merge.dup.bam', 'data/sample.merge.dup.recal_data.grp'])
+
+    def test_merge_tree(self):
+        """Test that CombineVariants merges leaves in a tree of bounded fan-in"""
+        task = _LeafCombineVariants(target="data/cohort-variants.vcf", merge_fan_in=3)
+        self.assertEqual([x.target for x in task.requires()], ["data/cohort-variants-merge/cohort-variants.L2.0000.vcf",
+                                                               "data/cohort-variants-merge/cohort-variants.L2.0001.vcf"])
+        node = task.requires()[1]
+        self.assertEqual(node.merge_root().target, task.target)
+        self.assertEqual([x.target for x in node.requires()], ["data/cohort-variants-merge/cohort-variants.L1.0003.vcf"])
+        self.assertEqual([x.target for x in node.requires()[0].requires()], ["data/sample09.vcf"])
+        self.assertEqual([x.target for x in task.requires()[0].requires()[0].requires()], ["data/sample00.vcf", "data/sample01.vcf", "data/sample02.vcf"])
+        flat = _LeafCombineVariants(target="data/cohort-variants.vcf")
+        self.assertEqual(len(flat.requires()), 10)
+
+class _LeafCombineVariants(GATK.CombineVariants):
+    def leaf_tasks(self):
+        return [GATK.InputVcfFile(target="data/sample{:02d}.vcf".format(i)) for i in reversed(range(10))]
+
+class TestIntervalFunctions(unittest.TestCase):
+    def test_partition_intervals(self):
+        intervals = [("chr1", 1, 100), ("chr2", 1, 50), ("chr3", 1, 50)]
+        groups = partition_intervals(intervals, 2)
+        self.assertEqual(groups, [[("chr1", 1, 100)], [("chr2", 1, 50), ("chr3", 1, 50)]])
+        groups = partition_intervals(intervals, 4)
+        self.assertEqual(groups, [[("chr1", 1, 50)], [("chr1", 51, 100)], [("chr2", 1, 50)], [("chr3", 1, 50)]])
+        groups = partition_intervals(intervals, 3, split=False)
+        self.assertEqual(groups, [[("chr1", 1, 100)], [("chr2", 1, 50)], [("chr3", 1, 50)]])
+
+    def test_scatter_intervals(self):
+        contigs = read_sequence_dictionary("data/chr11.dict")
+        self.assertEqual(contigs, [("chr11", 13680)])
+        groups = scatter_intervals(contigs, 3)
+        self.assertEqual(groups, [[("chr11", 1, 4560)], [("chr11", 4561, 9120)], [("chr11", 9121, 13680)]])
+        groups = scatter_intervals(contigs, 2, region="chr11:1001-2000")
+        self.assertEqual(groups, [[("chr11", 1001, 1500)], [("chr11", 1501, 2000)]])
+
+    def test_interval_length(self):
+        self.assertEqual(interval_length([("chr1", 1, 100), ("chr1", 51, 150), ("chr1", 60, 70), ("chr2", 1, 10)]), 160)
+
+class TestReferenceFunctions(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = ratatosk.reference.CACHE_DIR
+        ratatosk.reference.CACHE_DIR = os.path.abspath("reference-cache")
+
+    def tearDown(self):
+        if os.path.exists(ratatosk.reference.CACHE_DIR):
+            shutil.rmtree(ratatosk.reference.CACHE_DIR)
+        ratatosk.reference.CACHE_DIR = self.cache_dir
+
+    def test_reference_metadata(self):
+        ref = "data/chr11.fa"
+        self.assertEqual(ratatosk.reference.contigs(ref), ["chr11"])
+        self.assertEqual(ratatosk.reference.contig_offsets(ref), {"chr11" : 0})
+        self.assertEqual(ratatosk.reference.genome_length(ref), 13680)
+        self.assertEqual(ratatosk.reference.partition(ref, 2), [[("chr11", 1, 6840)], [("chr11", 6841, 13680)]])
+        # Reread metadata from on-disk cache
+        ratatosk.reference._reference_cache.clear()
+        self.assertTrue(os.path.exists(ratatosk.reference._cache_file(ref)))
+        self.assertEqual(ratatosk.reference.contig_lengths(ref), [("chr11", 13680)])
+
+class TestSitesFunctions(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = ratatosk.sites.CACHE_DIR
+        ratatosk.sites.CACHE_DIR = os.path.abspath("sites-cache")
+        self.vcf = "sites-functions.vcf"
+        with open(self.vcf, "w") as fh:
+            fh.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for pos, ref in [(50, "A"), (98, "ACGT"), (150, "C"), (250, "G")]:
+                fh.write("chr11\t{}\t.\t{}\tT\t.\tPASS\t.\n".format(pos, ref))
+
+    def tearDown(self):
+        if os.path.exists(ratatosk.sites.CACHE_DIR):
+            shutil.rmtree(ratatosk.sites.CACHE_DIR)
+        ratatosk.sites.CACHE_DIR = self.cache_dir
+        os.unlink(self.vcf)
+
+    def test_subset(self):
+        """Test that known sites are restricted to a region, and that the copy is cached"""
+        outfile = ratatosk.sites.subset(self.vcf, "chr11:100-200", [("chr11", 13680)])
+        self.assertEqual(outfile, ratatosk.sites.subset_file(self.vcf, "chr11:100-200"))
+        self.assertTrue(outfile.startswith(ratatosk.sites.CACHE_DIR))
+        if not ratatosk.sites.pysam:
+            with open(outfile) as fh:
+                self.assertEqual([x.split("\t")[1] for x in fh if not x.startswith("#")], ["98", "150"])
+        self.assertNotEqual(outfile, ratatosk.sites.subset_file(self.vcf, "chr11:100-300"))
+
+    def test_task_sites(self):
+        """Test that walkers restricted to a region use region-restricted known sites"""
+        task = GATK.BaseRecalibrator(target="data/sample.merge.dup.recal_data.grp", knownSites=(self.vcf, "missing.vcf"),
+                                     target_region="chr11:100-200", ref="data/chr11.fa")
+        self.assertEqual(task.known_sites(), [self.vcf, "missing.vcf"])
+        self.assertEqual(task.sites(self.vcf), ratatosk.sites.subset_file(self.vcf, "chr11:100-200"))
+        self.assertEqual(task.sites("missing.vcf"), "missing.vcf")
+        task = GATK.BaseRecalibrator(target="data/sample.merge.dup.recal_data.grp", knownSites=(self.vcf, ), ref="data/chr11.fa")
+        self.assertEqual(task.sites(self.vcf), self.vcf)
+
+def _write_bai(baifile, refs):
+    """Write a minimal bam index, with refs a list of (mapped, linear offsets) tuples"""
+    with open(baifile, "wb") as fh:
+        fh.write("BAI\1" + struct.pack("<i", len(refs)))
+        for mapped, linear in refs:
+            fh.write(struct.pack("<iIi", 1, ratatosk.bam.PSEUDO_BIN, 2))
+            fh.write(struct.pack("<QQQQ", 0, 0, mapped, 0))
+            fh.write(struct.pack("<i", len(linear)))
+            fh.write(struct.pack("<{}Q".format(len(linear)), *[x << 16 for x in linear]))
+        fh.write(struct.pack("<Q", 0))
+
+class TestVcfFunctions(unittest.TestCase):
+    records = [("chr11", 100, "A", "T"), ("chr11", 200, "AC", "GT"), ("chr11", 300, "A", "AT"),
+               ("chr11", 400, "A", "T,AT"), ("chr11", 500, "A", "<DEL>"), ("chr11", 600, "A", ".")]
+
+    def setUp(self):
+        self.vcf = "vcf-functions.vcf"
+        with open(self.vcf, "w") as fh:
+            fh.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for (c, pos, ref, alt) in self.records:
+                fh.write("{}\t{}\t.\t{}\t{}\t.\tPASS\t.\n".format(c, pos, ref, alt))
+        self.outputs = ["vcf-functions-snp.vcf", "vcf-functions-indel.vcf"]
+
+    def tearDown(self):
+        for fn in [self.vcf, self.vcf + ".gz"] + self.outputs:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def _positions(self, fn):
+        with ratatosk.vcf.open_vcf(fn) as fh:
+            return [int(x.split("\t")[1]) for x in fh if not x.startswith("#")]
+
+    def test_variant_type(self):
+        self.assertEqual([ratatosk.vcf.variant_type(ref, alt) for (_, _, ref, alt) in self.records],
+                         ["SNP", "MNP", "INDEL", "MIXED", "SYMBOLIC", "NO_VARIATION"])
+        self.assertEqual(ratatosk.vcf.variant_type("A", "G]chr11:100]"), "SYMBOLIC")
+
+    def test_split_variants(self):
+        """Test that a vcf is split by variant type in one pass, as with selectTypeToInclude"""
+        indel_types = ["INDEL", "MIXED", "MNP", "SYMBOLIC", "NO_VARIATION"]
+        counts = ratatosk.vcf.split_variants(self.vcf, [(["SNP"], self.outputs[0]), (indel_types, self.outputs[1])])
+        self.assertEqual(counts, [1, 5])
+        self.assertEqual(self._positions(self.outputs[0]), [100])
+        self.assertEqual(self._positions(self.outputs[1]), [200, 300, 400, 500, 600])
+        with open(self.outputs[0]) as fh:
+            self.assertEqual(fh.readline(), "##fileformat=VCFv4.1\n")
+        for fn in self.outputs:
+            os.unlink(fn)
+        with open(self.vcf) as fh, gzip.open(self.vcf + ".gz", "wb") as out:
+            out.write(fh.read())
+        ratatosk.vcf.split_variants(self.vcf + ".gz", [(["SNP"], self.outputs[0]), (indel_types, self.outputs[1])], intervals=[("chr11", 150, 350)])
+        self.assertEqual(self._positions(self.outputs[0]), [])
+        self.assertEqual(self._positions(self.outputs[1]), [200, 300])
+
+    def test_native_select_variants(self):
+        """Test that native SelectVariants tasks select the types of selectType"""
+        task = GATK.SelectSnpVariants(target=self.outputs[0], native=True)
+        self.assertEqual(task.variant_types(), ["SNP"])
+        self.assertEqual(GATK.SelectIndelVariants(target=self.outputs[1]).variant_types(), ["INDEL", "MIXED", "MNP", "SYMBOLIC", "NO_VARIATION"])
+        self.assertIsInstance(task.job_runner(), GATK.NativeSelectVariantsJobRunner)
+        self.assertNotIsInstance(GATK.SelectSnpVariants(target=self.outputs[0]).job_runner(), GATK.NativeSelectVariantsJobRunner)
+        task = GATK.SelectSnpVariants(target=self.outputs[0], native=True, options=["--excludeFiltered"])
+        self.assertFalse(task.native_selection())
+        self.assertNotIsInstance(task.job_runner(), GATK.NativeSelectVariantsJobRunner)
+
+@unittest.skipIf(ratatosk.filtration.np is None, "numpy not installed; skipping")
+class TestFiltrationFunctions(unittest.TestCase):
+    vcf = "data/filtration.vcf"
+
+    def setUp(self):
+        self.outfile = "data/filtration.filtered.vcf"
+
+    def tearDown(self):
+        if os.path.exists(self.outfile):
+            os.unlink(self.outfile)
+
+    def _filters(self):
+        with open(self.outfile) as fh:
+            return [x.split("\t")[6] for x in fh if not x.startswith("#")]
+
+    def test_evaluate(self):
+        """Test JEXL semantics of integer division, division by zero, missing values and short-circuiting"""
+        columns = {"MQ0" : ratatosk.filtration._column(["5", "4", "4", None]),
+                   "DP" : ratatosk.filtration._column(["20", "0", "30", "1"])}
+        for exp, values, error in [("MQ0 / DP > 0", [False, False, False, False], [False, True, False, True]),
+                                   ("MQ0 / (1.0 * DP) > 0.1", [True, False, True, False], [False, True, False, True]),
+                                   ("DP < 10 || MQ0 > 4", [True, True, False, True], [False, False, False, False]),
+                                   ("DP > 10 && MQ0 > 4", [True, False, False, False], [False, False, False, False]),
+                                   ("!(DP > 10)", [False, True, False, True], [False, False, False, False])]:
+            (x, _, err) = ratatosk.filtration.evaluate(ratatosk.filtration.parse_expression(exp), columns, 4)
+            self.assertEqual([bool(v) for v, e in izip(x, err) if not e], [v for v, e in izip(values, error) if not e])
+            self.assertEqual(list(err), error)
+        self.assertRaises(Exception, ratatosk.filtration.parse_expression, "QD < ")
+        self.assertRaises(Exception, ratatosk.filtration.parse_expression, "set == 'Intersection'")
+
+    def test_filter_options(self):
+        task = GATK.VariantSnpFiltrationExp(target=self.outfile, expressions=["QD < 2.0", "MQ < 40.0"])
+        options = ratatosk.filtration.filter_options(task.opts())
+        self.assertEqual(options["filters"], [("GATKStandardQD", "QD < 2.0"), ("GATKStandardMQ", "MQ < 40.0")])
+        self.assertIsNone(options["cluster_size"])
+        self.assertIsInstance(GATK.VariantSnpFiltrationExp(target=self.outfile, native=True).job_runner(), GATK.NativeVariantFiltrationJobRunner)
+        options = ratatosk.filtration.filter_options(HALOPLEX.VariantHaloFiltration(target=self.outfile).opts())
+        self.assertEqual(options["filters"][0], ("HARD_TO_VALIDATE", "MQ0 >= 4 && ((MQ0 / (1.0 * DP)) > 0.1)"))
+        self.assertEqual((options["cluster_size"], options["cluster_window"]), (3, 10))
+
+    def test_filter_expressions(self):
+        """Test FILTER values of hard filtering with the default snp expressions"""
+        task = GATK.VariantSnpFiltrationExp(target=self.outfile)
+        for chunk_size in [100, 2]:
+            ratatosk.filtration.filter_variants(self.vcf, self.outfile, chunk_size=chunk_size, **ratatosk.filtration.filter_options(task.opts()))
+            self.assertEqual(self._filters(), ["PASS", "PASS",
+                                               "GATKStandardFS;GATKStandardMQ;GATKStandardQD;GATKStandardReadPosRankSum",
+                                               "GATKStandardFS;GATKStandardQD;GATKStandardReadPosRankSum",
+                                               "PASS", "GATKStandardMQ;GATKStandardQD;LowQual", "PASS", "PASS"])
+
+    def test_filter_clusters(self):
+        """Test FILTER values of hard filtering with the haloplex expressions and cluster settings"""
+        task = HALOPLEX.VariantHaloFiltration(target=self.outfile)
+        for chunk_size in [100, 3, 1]:
+            ratatosk.filtration.filter_variants(self.vcf, self.outfile, chunk_size=chunk_size, **ratatosk.filtration.filter_options(task.opts()))
+            self.assertEqual(self._filters(), ["SnpCluster", "LowCoverage;LowQual;SnpCluster",
+                                               "HARD_TO_VALIDATE;LowQD;SnpCluster;VeryLowQual",
+                                               "HARD_TO_VALIDATE;LowQD", "VeryLowQual",
+                                               "LowCoverage;LowQD;LowQual", "PASS", "PASS"])
+        with open(self.outfile) as fh:
+            self.assertIn('##FILTER=<ID=SnpCluster,Description="SNPs found in clusters">\n', fh.readlines())
+
+@unittest.skipIf(ratatosk.evaluation.np is None, "numpy not installed; skipping")
+class TestEvaluationFunctions(unittest.TestCase):
+    def setUp(self):
+        self.vcf = "evaluation.vcf"
+        self.dbsnp = "evaluation-dbsnp.vcf"
+        self.outfile = "evaluation.eval_metrics"
+        with open(self.vcf, "w") as fh:
+            fh.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n")
+            for (pos, ref, alt, filt, gt) in [(1000, "A", "G", "PASS", "0/1\t0/0"), (1004, "C", "A", ".", "1/1\t0/1"),
+                                              (1009, "G", "GA", "LowQual", "0/1\t./."), (2000, "TA", "T", "PASS", "0/0\t0/0"),
+                                              (3000, "C", "T", "PASS", "0|1\t0|0")]:
+                fh.write("chr11\t{}\t.\t{}\t{}\t50\t{}\t.\tGT\t{}\n".format(pos, ref, alt, filt, gt))
+        with open(self.dbsnp, "w") as fh:
+            fh.write("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for (pos, ref, alt) in [(1000, "A", "G,T"), (1009, "G", "GT"), (1500, "C", "T"), (1600, "C", "G")]:
+                fh.write("chr11\t{}\t.\t{}\t{}\t.\t.\t.\n".format(pos, ref, alt))
+
+    def tearDown(self):
+        for fn in [self.vcf, self.dbsnp, self.outfile]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def _row(self, tables, name, filt, novelty):
+        return [dict(x) for x in tables[name] if dict(x)["Filter"] == filt and dict(x)["Novelty"] == novelty][0]
+
+    def test_evaluate_variants(self):
+        tables = ratatosk.evaluation.evaluate_variants(self.vcf, self.dbsnp, processed_loci=10000, chunk_size=2)
+        self.assertEqual(sorted(tables.keys()), ["CompOverlap", "CountVariants", "TiTvVariantEvaluator"])
+        row = self._row(tables, "CompOverlap", "raw", "all")
+        self.assertEqual((row["nEvalVariants"], row["nVariantsAtComp"], row["nConcordant"]), (4, 2, 1))
+        row = self._row(tables, "CountVariants", "called", "all")
+        self.assertEqual((row["nCalledLoci"], row["nRefLoci"], row["nSNPs"], row["nHets"], row["nHomRef"], row["nHomVar"], row["nSingletons"]), (4, 1, 3, 3, 4, 1, 2))
+        self.assertEqual(self._row(tables, "CountVariants", "filtered", "known")["nInsertions"], 1)
+        row = self._row(tables, "TiTvVariantEvaluator", "called", "novel")
+        self.assertEqual((row["nTi"], row["nTv"], row["nTiInComp"], row["nTvInComp"]), (1, 1, 1, 1))
+        tables = ratatosk.evaluation.evaluate_variants(self.vcf, self.dbsnp, intervals=[("chr11", 900, 1005)], processed_loci=106)
+        self.assertEqual(self._row(tables, "CompOverlap", "raw", "all")["nEvalVariants"], 2)
+        self.assertEqual(self._row(tables, "TiTvVariantEvaluator", "raw", "all")["nTiInComp"], 0)
+
+    def test_report(self):
+        """Test that native reports are read as GATKReports by the report module"""
+        tables = ratatosk.evaluation.evaluate_variants(self.vcf, self.dbsnp, processed_loci=10000)
+        ratatosk.evaluation.write_report(tables, self.outfile)
+        report = ratatosk.evaluation.read_report(self.outfile)
+        self.assertEqual(dict(report["CompOverlap"][0])["compRate"], "33.33")
+        metrics = PicardMetrics("sample", self.outfile).metrics()
+        self.assertEqual(metrics[0], ["Table", "Filter", "Novelty", "Metric", "Value"])
+        self.assertIn(["CountVariants", "raw", "all", "nVariantLoci", 4], metrics)
+        self.assertEqual(len(metrics), 1 + 9 * (6 + 24 + 6))
+
+    def test_native_variant_eval(self):
+        task = GATK.VariantEval(target=self.outfile, native=True)
+        self.assertIsInstance(task.job_runner(), GATK.NativeVariantEvalJobRunner)
+        self.assertEqual(task.table_file(), "evaluation.eval_table")
+
+@unittest.skipIf(ratatosk.metrics.np is None, "numpy not installed; skipping")
+class TestMetricsFunctions(unittest.TestCase):
+    def setUp(self):
+        self.outfile = "metrics-functions.insert_metrics"
+        self.samfile = "metrics-functions.sam"
+        self.np = ratatosk.metrics.np
+
+    def tearDown(self):
+        for fn in [self.outfile, self.samfile]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def test_histogram_median(self):
+        self.assertEqual(ratatosk.metrics.histogram_median(self.np.array([0, 1, 1, 1])), 2.0)
+        self.assertEqual(ratatosk.metrics.histogram_median(self.np.array([0, 0, 2, 2])), 2.5)
+        self.assertEqual(ratatosk.metrics.histogram_median(self.np.zeros(0)), 0)
+
+    def test_insert_size_metrics(self):
+        fr = self.np.zeros(400, dtype=self.np.int64)
+        fr[150:250] = 1
+        fr[200] = 50
+        (rows, hist) = ratatosk.metrics.insert_size_metrics([fr, self.np.zeros(0), self.np.array([0, 1])])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["PAIR_ORIENTATION"], rows[0]["READ_PAIRS"], rows[0]["MIN_INSERT_SIZE"], rows[0]["MAX_INSERT_SIZE"]), ("FR", 149, 150, 249))
+        self.assertEqual((rows[0]["MEDIAN_INSERT_SIZE"], rows[0]["MEDIAN_ABSOLUTE_DEVIATION"]), (200.0, 13.0))
+        self.assertEqual((rows[0]["WIDTH_OF_10_PERCENT"], rows[0]["WIDTH_OF_50_PERCENT"], rows[0]["WIDTH_OF_99_PERCENT"]), (1, 27, 99))
+        self.assertEqual(hist[0], ["insert_size", "fr_count"])
+        self.assertEqual(hist[1][0:2], [[150, 1], [151, 1]])
+        (rows, hist) = ratatosk.metrics.insert_size_metrics([self.np.zeros(0)] * 3)
+        self.assertEqual((rows, hist), ([], None))
+
+    def test_estimate_library_size(self):
+        self.assertEqual(ratatosk.metrics.estimate_library_size(1000, 900), 4660)
+        self.assertIsNone(ratatosk.metrics.estimate_library_size(10, 10))
+
+    def test_interval_array(self):
+        ia = ratatosk.metrics.IntervalArray([("chr1", 10, 20), ("chr1", 15, 30), ("chr1", 31, 40), ("chr1", 100, 110), ("chr2", 5, 6), ("chr3", 1, 10)], ["chr1", "chr2"])
+        self.assertEqual(ia.intervals, [("chr1", 10, 40), ("chr1", 100, 110), ("chr2", 5, 6)])
+        self.assertEqual(ia.territory(), 44)
+        (ranges, ovstart, ovend) = ia.overlaps(self.np.array([0, 0, 1, 0]), self.np.array([5, 35, 1, 50]), self.np.array([12, 105, 10, 60]))
+        self.assertEqual(list(ranges), [0, 1, 1, 2])
+        self.assertEqual(zip(ovstart, ovend), [(0, 2), (25, 30), (31, 36), (42, 43)])
+
+    def test_collector(self):
+        # Pair on bait, its duplicate and an unmapped pair
+        rows = [(99, 0, 101, 150, 60, 150, 0, 201, 50, 50, 0, 1, 50, -1, 0, 0),
+                (147, 0, 201, 250, 60, -150, 0, 101, 50, 50, 0, 0, 50, -1, 0, 0),
+                (1123, 0, 101, 150, 60, 150, 0, 201, 50, 50, 0, 1, 50, -1, 0, 0),
+                (77, -1, 0, 0, 0, 0, -1, 0, 50, 0, 0, 0, 0, -1, 0, 0)]
+        blocks = [(0, 101, 150), (1, 201, 250), (2, 101, 150)]
+        collector = ratatosk.metrics._Collector([("chr11", 1000)], baits=[("chr11", 100, 199)], targets=[("chr11", 120, 179), ("chr11", 300, 309)])
+        collector.add(ratatosk.metrics._chunk(rows, blocks, [(3, 1)]))
+        metrics = dict((x["CATEGORY"], x) for x in collector.alignment_metrics())
+        self.assertEqual(sorted(metrics.keys()), ["FIRST_OF_PAIR", "PAIR", "SECOND_OF_PAIR"])
+        self.assertEqual((metrics["PAIR"]["TOTAL_READS"], metrics["PAIR"]["PF_READS_ALIGNED"], metrics["FIRST_OF_PAIR"]["TOTAL_READS"]), (4, 3, 3))
+        self.assertEqual((metrics["PAIR"]["PCT_PF_READS_ALIGNED"], metrics["PAIR"]["PF_MISMATCH_RATE"]), (0.75, 2 / 150.0))
+        self.assertEqual(metrics["PAIR"]["STRAND_BALANCE"], 2 / 3.0)
+        (rows, hist) = ratatosk.metrics.insert_size_metrics(collector.inserts)
+        self.assertEqual((rows[0]["PAIR_ORIENTATION"], rows[0]["READ_PAIRS"], rows[0]["MEDIAN_INSERT_SIZE"]), ("FR", 1, 150.0))
+        hs = collector.hs_metrics("baits")[0]
+        self.assertEqual((hs["PF_UNIQUE_READS"], hs["PF_UQ_READS_ALIGNED"], hs["PF_UQ_BASES_ALIGNED"]), (3, 2, 100))
+        self.assertEqual((hs["ON_BAIT_BASES"], hs["NEAR_BAIT_BASES"], hs["OFF_BAIT_BASES"], hs["ON_TARGET_BASES"]), (50, 50, 0, 31))
+        self.assertEqual((hs["TARGET_TERRITORY"], hs["ZERO_CVG_TARGETS_PCT"], hs["PCT_TARGET_BASES_2X"]), (70, 0.5, 0.0))
+        self.assertAlmostEqual(hs["MEAN_TARGET_COVERAGE"], 31 / 60.0)
+
+    def test_write_metrics(self):
+        """Test that native metrics are read by the report module"""
+        fr = self.np.zeros(300, dtype=self.np.int64)
+        fr[150:250] = 2
+        (rows, hist) = ratatosk.metrics.insert_size_metrics([fr, self.np.zeros(0), self.np.zeros(0)])
+        ratatosk.metrics.write_metrics(self.outfile, ratatosk.metrics.METRICS_CLASSES["insert"], ratatosk.metrics.INSERT_SIZE_COLUMNS, rows, hist)
+        pm = PicardMetrics("sample", self.outfile)
+        self.assertEqual(pm.metrics()[0], ratatosk.metrics.INSERT_SIZE_COLUMNS)
+        self.assertEqual(pm.metrics()[1][0:8], [199.5, 25, 150, 249, 199.5, 28.938507, 200, "FR"])
+        self.assertEqual(pm.hist()[0:2], [["insert_size", "fr_count"], [150, 2]])
+
+    @unittest.skipIf(ratatosk.metrics.pysam is None, "pysam not installed; skipping")
+    def test_collect_metrics(self):
+        with open(self.samfile, "w") as fh:
+            fh.write("@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr11\tLN:1000\n")
+            fh.write("r1\t99\tchr11\t101\t60\t50M\t=\t201\t150\t{}\t{}\n".format("A" * 50, "I" * 50))
+            fh.write("r1\t147\tchr11\t201\t60\t20M2D30M\t=\t101\t-150\t{}\t{}\n".format("C" * 50, "I" * 50))
+        ratatosk.metrics.collect_metrics(self.samfile, insert_file=self.outfile)
+        pm = PicardMetrics("sample", self.outfile)
+        self.assertEqual(pm.metrics()[1][0:8], [150, 0, 150, 150, 150, 0, 1, "FR"])
+
+class TestBamFunctions(unittest.TestCase):
+    def setUp(self):
+        self.baifile = "bam-functions.bai"
+        # chr1: 4 windows, reads in first window only; chr2: 4
+        # windows with even read density
+        _write_bai(self.baifile, [(300, [100]), (300, [500, 600, 700, 800])])
+        self.contigs = [("chr1", 4 * 16384), ("chr2", 4 * 16384)]
+
+    def tearDown(self):
+        if os.path.exists(self.baifile):
+            os.unlink(self.baifile)
+
+    def test_read_bai(self):
+        (refs, n_no_coor) = ratatosk.bam.read_bai(self.baifile)
+        self.assertEqual([x["mapped"] for x in refs], [300, 300])
+        self.assertEqual(refs[1]["linear"], [x << 16 for x in [500, 600, 700, 800]])
+        self.assertEqual(n_no_coor, 0)
+
+    def test_plan_shards(self):
+        groups = ratatosk.bam.plan_shards(self.baifile, self.contigs, 2)
+        self.assertEqual(groups, [[("chr1", 1, 65536)], [("chr2", 1, 65536)]])
+        groups = ratatosk.bam.plan_shards(self.baifile, self.contigs, 4)
+        self.assertEqual(groups, [[("chr1", 1, 65536)], [("chr2", 1, 32768)], [("chr2", 32769, 65536)]])
+        groups = ratatosk.bam.plan_shards(self.baifile, self.contigs, 2, region="chr2:1-32768")
+        self.assertEqual(groups, [[("chr2", 1, 16384)], [("chr2", 16385, 32768)]])
+
+    def test_plan_shards_region(self):
+        """Test planning shards of an exome-sized region over a genome-sized index"""
+        nwin = 95000
+        _write_bai(self.baifile, [(10 * nwin, range(100, 100 + 10 * nwin, 10))] * 2)
+        contigs = [("chr1", nwin * 16384), ("chr2", nwin * 16384)]
+        intervals = [(c, s, s + 149) for c, _ in contigs for s in range(1001, nwin * 16384 - 200, 15551)]
+        regionfile = "bam-functions.intervals"
+        ratatosk.interval.write_intervals(intervals, regionfile)
+        try:
+            groups = ratatosk.bam.plan_shards(self.baifile, contigs, 8, region=regionfile)
+        finally:
+            os.unlink(regionfile)
+        self.assertEqual(len(intervals), 200178)
+        self.assertEqual(len(groups), 8)
+        self.assertEqual([x for g in groups for x in g], intervals)
+
+    def test_index_stats(self):
+        self.assertEqual(ratatosk.bam.index_stats("bam-functions.bam"), (600, 0))
+        self.assertRaises(Exception, ratatosk.bam.index_stats, "missing.bam")
+
+    @unittest.skipIf(ratatosk.bam.pysam is None, "pysam not installed; skipping")
+    def test_index_bams(self):
+        header = "@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr1\tLN:65536\n"
+        bamfiles = ["bam-index{}.bam".format(i) for i in range(3)]
+        try:
+            for bamfile in bamfiles:
+                outfile = ratatosk.bam.pysam.Samfile(bamfile, "wb", text=header)
+                outfile.close()
+            self.assertEqual(ratatosk.bam.index_bams(bamfiles, threads=3), [x + ".bai" for x in bamfiles])
+            self.assertEqual(ratatosk.bam.index_stats(bamfiles[0]), (0, 0))
+        finally:
+            for bamfile in bamfiles:
+                for fn in [bamfile, bamfile + ".bai"]:
+                    if os.path.exists(fn):
+                        os.unlink(fn)
+
+    def test_sort_order(self):
+        header = "@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:chr1\tLN:65536\n"
+        (samfile, bamfile) = ("bam-header.sam", "bam-header.bam")
+        try:
+            with open(samfile, "w") as fh:
+                fh.write(header + "read1\t0\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\tIIII\n")
+            fh = gzip.open(bamfile, "wb")
+            fh.write("BAM\1" + struct.pack("<i", len(header) + 1) + header + "\0")
+            fh.close()
+            self.assertEqual(ratatosk.bam.sort_order(samfile), "coordinate")
+            self.assertEqual(ratatosk.bam.sort_order(bamfile), "coordinate")
+            self.assertTrue(ratatosk.bam.is_coordinate_sorted(bamfile))
+            self.assertFalse(ratatosk.bam.is_coordinate_sorted(bamfile, check_index=True))
+            _write_bai(bamfile + ".bai", [(0, [])])
+            self.assertTrue(ratatosk.bam.is_coordinate_sorted(bamfile, check_index=True))
+            with open(samfile, "w") as fh:
+                fh.write("@HD\tVN:1.4\tSO:queryname\n")
+            self.assertFalse(ratatosk.bam.is_coordinate_sorted(samfile))
+            with open(samfile, "w") as fh:
+                fh.write("@SQ\tSN:chr1\tLN:65536\n")
+            self.assertEqual(ratatosk.bam.sort_order(samfile), None)
+        finally:
+            for fn in [samfile, bamfile, bamfile + ".bai"]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+class TestResourceFunctions(unittest.TestCase):
+    def test_scaling_limit(self):
+        self.assertEqual(ratatosk.resources.scaling_limit([], 8), 8)
+        self.assertEqual(ratatosk.resources.scaling_limit([(100, 1), (55, 2)], 8), 8)
+        self.assertEqual(ratatosk.resources.scaling_limit([(100, 1), (55, 2), (60, 4)], 8), 2)
+        self.assertEqual(ratatosk.resources.scaling_limit([(100, 1), (55, 2), (60, 4)], 1), 1)
+
+    def test_gatk_threads(self):
+        self.assertEqual(ratatosk.resources.gatk_threads(True, False, 4, 1, concurrent_jobs=2, cores=8, node_memory_gb=64), (4, None))
+        self.assertEqual(ratatosk.resources.gatk_threads(True, False, 2, 1, concurrent_jobs=2, cores=8, node_memory_gb=64), (2, None))
+        self.assertEqual(ratatosk.resources.gatk_threads(False, True, 2, 1, concurrent_jobs=2, cores=8, node_memory_gb=64), (None, 4))
+        self.assertEqual(ratatosk.resources.gatk_threads(True, True, 2, 1, concurrent_jobs=1, cores=8, node_memory_gb=64), (2, 4))
+        self.assertEqual(ratatosk.resources.gatk_threads(False, True, 2, 1, cores=8, node_memory_gb=64, runtimes=[(100, 1), (55, 2), (60, 4)]), (None, 2))
+
+class _Sample(object):
+    def __init__(self, prefix):
+        self._prefix = prefix
+    def prefix(self, group="sample"):
+        return self._prefix
+
+class TestCohortFunctions(unittest.TestCase):
+    def setUp(self):
+        self.outdir = "cohort"
+        self.cohort = os.path.join(self.outdir, "CombinedVariantsAll.vcf")
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        for fn in [self.cohort, os.path.join(self.outdir, "CombinedVariants.vcf")]:
+            with open(fn, "w") as fh:
+                fh.write("##fileformat=VCFv4.1\n")
+        GATK.write_cohort_samples(self.cohort, ["cohort/s1", "cohort/s2"])
+        ratatosk.backend.__global_vars__["targets"] = [_Sample("cohort/s{}".format(i)) for i in [1, 2, 3]]
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+        del ratatosk.backend.__global_vars__["targets"]
+
+    def test_incremental_cohort(self):
+        """Test that only new samples and novel sites are genotyped when adding samples to a cohort"""
+        update = GATK.cohort_update_target(os.path.join(self.outdir, "CombinedVariants.vcf"), ["cohort/s3"])
+        self.assertTrue(update.startswith("cohort/CombinedVariants-update-"))
+        task = HALOPLEX.CombineAllVariants(target=self.cohort, incremental=True, batch_size=2)
+        self.assertFalse(task.complete())
+        self.assertEqual(task.new_samples(), ["cohort/s3"])
+        leaves = task.leaf_tasks()
+        self.assertEqual([x.target for x in leaves], [self.cohort, GATK.genotype_batch_target(os.path.splitext(update)[0], leaves[1].sample_targets),
+                                                      GATK.genotype_batch_target(rreplace(update, ".vcf", "-novel", 1), leaves[2].sample_targets)])
+        self.assertEqual(list(leaves[1].sample_targets), ["cohort/s3.trimmed.sync.sort.merge.realign.recal.clip.filtered-genotype.vcf"])
+        self.assertEqual(leaves[1].alleles, update)
+        self.assertEqual(len(leaves[2].sample_targets), 2)
+        self.assertEqual(leaves[2].alleles, rreplace(update, ".vcf", "-novel.vcf", 1))
+        self.assertEqual(GATK.UpdateMasterVariants(target=update).leaf_tasks()[0].target, "cohort/CombinedVariants.vcf")
+        self.assertEqual(GATK.UpdateMasterVariants(target=update, options=["-genotypeMergeOptions UNSORTED"]).opts()[-1], "-genotypeMergeOptions UNSORTED")
+        GATK.write_cohort_samples(self.cohort, ["cohort/s1", "cohort/s2", "cohort/s3"])
+        self.assertEqual(task.new_samples(), [])
+        leaves = task.leaf_tasks()
+        self.assertEqual([list(x.sample_targets) for x in leaves], [["cohort/s{}.trimmed.sync.sort.merge.realign.recal.clip.filtered-genotype.vcf".format(i) for i in [1, 2]],
+                                                                    ["cohort/s3.trimmed.sync.sort.merge.realign.recal.clip.filtered-genotype.vcf"]])
+        self.assertEqual([x.target for x in leaves], [GATK.genotype_batch_target("cohort/CombinedVariants", x.sample_targets) for x in leaves])
+        self.assertEqual(len(HALOPLEX.CombineAllVariants(target=self.cohort).leaf_tasks()), 3)
+
+    def test_genotype_batch_target(self):
+        """Test that genotype batches are named by their samples"""
+        target = GATK.genotype_batch_target("cohort/CombinedVariants", ["s2.vcf", "s1.vcf"])
+        self.assertTrue(target.startswith("cohort/CombinedVariants-genotype-batch-"))
+        self.assertTrue(target.endswith(".vcf"))
+        self.assertEqual(target, GATK.genotype_batch_target("cohort/CombinedVariants", ["s1.vcf", "s2.vcf"]))
+        self.assertNotEqual(target, GATK.genotype_batch_target("cohort/CombinedVariants", ["s1.vcf", "s2.vcf", "s3.vcf"]))
+
+    def test_incremental_cohort_merge_tree(self):
+        """Test that an incremental update does not reuse merge tree nodes of a full build"""
+        GATK.write_cohort_samples(self.cohort, ["cohort/s1", "cohort/s2", "cohort/s3"])
+        task = HALOPLEX.CombineAllVariants(target=self.cohort, incremental=True, merge_fan_in=2)
+        nodes = task.requires()
+        self.assertEqual([x.target for x in nodes], ["cohort/CombinedVariantsAll-merge/CombinedVariantsAll.L1.0000.vcf",
+                                                     "cohort/CombinedVariantsAll-merge/CombinedVariantsAll.L1.0001.vcf"])
+        os.makedirs(os.path.dirname(nodes[0].target))
+        for x in nodes:
+            with open(x.target, "w") as fh:
+                fh.write("##fileformat=VCFv4.1\n")
+        GATK.write_cohort_samples(self.cohort, ["cohort/s1", "cohort/s2"])
+        task = HALOPLEX.CombineAllVariants(target=self.cohort, incremental=True, merge_fan_in=2)
+        self.assertEqual([x.target for x in task.requires()], [x.target for x in task.leaf_tasks()])
+        self.assertEqual(task.requires()[0].target, self.cohort)
+
+    def test_incremental_cohort_no_samples(self):
+        """Test that a cohort vcf without recorded samples is not rebuilt in place"""
+        os.unlink(self.cohort + ".samples")
+        task = HALOPLEX.CombineAllVariants(target=self.cohort, incremental=True)
+        # dry_run is a global parameter that may be set by other tests
+        task.dry_run = False
+        self.assertTrue(task.complete())
+        self.assertEqual(task.new_samples(), None)
+        self.assertEqual(task.update_target(), None)
+
+    def test_incremental_cohort_args(self):
+        """Test that an incrementally updated cohort vcf is not written in place"""
+        task = HALOPLEX.CombineAllVariants(target=self.cohort, incremental=True, ref="ref.fa")
+        update = GATK.cohort_update_target(self.cohort, ["cohort/s3"])
+        (tmp_files, args) = DefaultShellJobRunner._fix_paths(task)
+        inputs = [args[i + 1] for i, x in enumerate(args) if x == "-V"]
+        output = args[args.index("-o") + 1]
+        self.assertIn(self.cohort, inputs)
+        self.assertTrue(output.startswith(update + "-luigi-tmp-"))
+        self.assertNotIn(output, inputs)
+        self.assertIn((output, update), [(x.path, y.path) for x, y in tmp_files])
+
 class TestUtilsFunctions(unittest.TestCase):
     def test_determine_read_type(self):
         fn = "sample_index1_1.fastq.gz"
@@ -204,3 +786,29 @@ class TestUtilsFunctions(unittest.TestCase):
         fn = "P001_101_index3_TGACCA_L001_R2_001.fastq.gz"
         rtype = determine_read_type(fn, "_R1_001", "_R2_001")
         self.assertEqual(rtype, 2)
+
+    def test_shard_names(self):
+        target = "data/sample1-scatter/sample1.0003_R1_001.fastq.gz"
+        self.assertEqual(sibling_shard_target(target, 0), "data/sample1-scatter/sample1.0000_R1_001.fastq.gz")
+        self.assertEqual(unscattered_target(target), "data/sample1_R1_001.fastq.gz")
+        self.assertRaises(Exception, unscattered_target, "data/sample1_R1_001.fastq.gz")
+
+    def test_split_fastq(self):
+        fastqfile = "split-fastq_R1_001.fastq"
+        chunks = ["split-fastq-scatter/split-fastq.{:04d}_R1_001.fastq.gz".format(i) for i in range(2)]
+        reads = ["@read{}\nACGT\n+\nIIII\n".format(i) for i in range(5)]
+        with open(fastqfile, "w") as fh:
+            fh.write("".join(reads))
+        try:
+            self.assertEqual(FASTQ.split_fastq(fastqfile, chunks), 5)
+            for i, chunk in enumerate(chunks):
+                fh = gzip.open(chunk)
+                self.assertEqual(fh.read(), "".join(reads[i::2]))
+                fh.close()
+            with open(fastqfile, "a") as fh:
+                fh.write("@read5\nACGT\n")
+            self.assertRaises(Exception, FASTQ.split_fastq, fastqfile, chunks)
+            self.assertEqual(sorted(os.listdir("split-fastq-scatter")), [os.path.basename(x) for x in chunks])
+        finally:
+            os.unlink(fastqfile)
+            shutil.rmtree("split-fastq-scatter", ignore_errors=True)
@@ -1,10 +1,13 @@
 import os
 import glob
 import sys
+import time
 import shutil
 import unittest
 import luigi
 import ratatosk.job
+import ratatosk.priority
+from ratatosk.jobrunner import SpeculativeShellJobRunner
 import ratatosk.lib.tools.gatk
 import ratatosk.lib.align.bwa
 from ratatosk.config import get_config
@@ -34,3 +37,104 @@ class TestJobTask(unittest.TestCase):
         task = ratatosk.lib.align.bwa.Aln(target="data/sample1_1.sai", parent_task=('ratatosk.lib.align.bwa.InputFastqFile', ))
         task = ratatosk.lib.tools.gatk.UnifiedGenotyper(target="data/sample1_1.sai")
         
+
+class ShortTask(ratatosk.job.JobTask):
+    expected_runtime = 1
+
+class LongTask(ratatosk.job.JobTask):
+    expected_runtime = 60
+
+class ChainTask(ratatosk.job.JobTask):
+    expected_runtime = 10
+
+    def requires(self):
+        return [LongTask(target=self.target + ".long")]
+
+class RootTask(ratatosk.job.JobWrapperTask):
+    def requires(self):
+        return [ShortTask(target="short"), ChainTask(target="chain")]
+
+class TestPriority(unittest.TestCase):
+    def test_assign_priorities(self):
+        """Test assigning critical path priorities"""
+        root = RootTask(target="root")
+        priorities = ratatosk.priority.assign_priorities(root)
+        self.assertEqual(priorities[root.task_id], 0)
+        self.assertEqual(ShortTask(target="short").priority, 60)
+        self.assertEqual(ChainTask(target="chain").priority, 600)
+        self.assertEqual(LongTask(target="chain.long").priority, 4200)
+
+    def test_deps_order(self):
+        """Test that the dependency with highest priority is scheduled first, i.e. is last in the list of dependencies"""
+        root = RootTask(target="root")
+        self.assertEqual([x.target for x in root.deps()], ["short", "chain"])
+
+class SleepTask(ratatosk.job.JobTask):
+    executable = "sleep"
+    speculative_multiple = 2.0
+
+    def args(self):
+        return ["1", "&&", "echo", "done", ">", self.output()]
+
+class TestSpeculativeJobRunner(unittest.TestCase):
+    def setUp(self):
+        self.outdir = "speculative-split"
+        self.runner = SpeculativeShellJobRunner()
+        self.runner.poll_interval = 0.1
+        os.makedirs(os.path.join(self.outdir, self.runner.runtime_dir))
+        for i in range(3):
+            with open(os.path.join(self.outdir, self.runner.runtime_dir, "shard{}.txt".format(i)), "w") as fh:
+                fh.write("0.1\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_speculative_run(self):
+        """Test that a straggling shard is duplicated and that only the winning output is kept"""
+        task = SleepTask(target=os.path.join(self.outdir, "shard3.txt"))
+        self.assertAlmostEqual(self.runner._sibling_median(task), 0.1)
+        self.runner.run_job(task)
+        self.assertEqual(sorted(os.listdir(self.outdir)), [self.runner.runtime_dir, "shard3.txt"])
+        with open(task.target) as fh:
+            self.assertEqual(fh.read(), "done\n")
+        self.assertEqual(len(os.listdir(os.path.join(self.outdir, self.runner.runtime_dir))), 4)
+
+    def test_interrupted_run(self):
+        """Test that running jobs are killed and their output discarded if the runner is interrupted"""
+        procs = []
+        launch = self.runner._launch
+        def _launch(arglist):
+            retval = launch(arglist)
+            procs.append(retval[0])
+            return retval
+        def _interrupt(job):
+            raise KeyboardInterrupt
+        self.runner._launch = _launch
+        self.runner._sibling_median = _interrupt
+        task = SleepTask(target=os.path.join(self.outdir, "shard3.txt"))
+        self.assertRaises(KeyboardInterrupt, self.runner.run_job, task)
+        self.assertEqual(len(procs), 1)
+        self.assertIsNotNone(procs[0].poll())
+        self.assertEqual(sorted(os.listdir(self.outdir)), [self.runner.runtime_dir])
+
+    def test_short_run(self):
+        """Test that a job shorter than the poll interval is not held up by polling"""
+        self.runner.poll_interval = 10
+        os.makedirs(os.path.join(self.outdir, "short"))
+        task = SleepTask(target=os.path.join(self.outdir, "short", "shard0.txt"))
+        t0 = time.time()
+        self.runner.run_job(task)
+        self.assertLess(time.time() - t0, 5)
+        self.assertTrue(os.path.exists(task.target))
+
+class JavaTask(ratatosk.job.JavaJobTask):
+    max_memory_gb = 10
+
+class TestJavaJobTask(unittest.TestCase):
+    def test_java_opt(self):
+        task = JavaTask(target="java.txt")
+        self.assertEqual(task.java_opt(), ["-Xmx8g", "-XX:ParallelGCThreads=1"])
+        self.assertEqual(task.max_memory(), 10)
+        task = JavaTask(target="java.txt", java_options=["-Xmx16g"], java_tmpdir="tmp")
+        self.assertEqual(task.java_opt(), ["-Xmx16g", "-XX:ParallelGCThreads=1", "-Djava.io.tmpdir=tmp"])
+        self.assertEqual(task.max_memory(), 20)
@@ -16,6 +16,8 @@
 # correctly. No actual spawning of subprocesses is done.
 
 import os
+import gzip
+import struct
 import re
 import unittest
 import luigi
@@ -93,9 +95,52 @@ class TestSamtoolsWrappers(unittest.TestCase):
 
     def test_sortbam(self):
         task = ratatosk.lib.tools.samtools.SortBam(target=sortbam)
-        self.assertEqual(['samtools', 'sort', 'data/sample1.bam', 'data/sample1.sort'],
+        self.assertEqual(['samtools', 'sort', '-m 2457M', 'data/sample1.bam', 'data/sample1.sort'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
+    def test_samtools_threads(self):
+        task = ratatosk.lib.tools.samtools.SamToBam(target=bam, num_threads=4)
+        self.assertEqual(['samtools', 'view', '-bSh', '-@ 4', 'data/sample1.sam', '>', 'data/sample1.bam'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        task = ratatosk.lib.tools.samtools.SortBam(target=sortbam, num_threads=4)
+        self.assertEqual(['samtools', 'sort', '-@ 4', '-m 614M', 'data/sample1.bam', 'data/sample1.sort'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        task = ratatosk.lib.tools.samtools.SortBam(target=sortbam, num_threads=4, options=["-@ 2 -m 1G"])
+        self.assertEqual(['samtools', 'sort', '-@ 2 -m 1G', 'data/sample1.bam', 'data/sample1.sort'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        task = ratatosk.lib.align.bwa.Bampe(target=bam, num_threads=4)
+        self.assertEqual(task.args()[1].threads(), 4)
+
+    def test_index_native(self):
+        task = ratatosk.lib.tools.samtools.Index(target="data/sample1.bai", native=True)
+        self.assertIsInstance(task.job_runner(), ratatosk.lib.tools.samtools.NativeIndexJobRunner)
+
+    def test_index_written_with_bam(self):
+        (inbam, tmpbam, baifile) = ("data/index-inline.bam", "data/index-inline.bam-luigi-tmp-0123456789", "data/index-inline.bai")
+        with open(tmpbam, "w") as fh:
+            fh.write("bam")
+        with open(os.path.splitext(tmpbam)[0] + ".bai", "w") as fh:
+            fh.write("bai")
+        try:
+            # The index of the temporary bam already has the final name
+            ratatosk.lib.tools.samtools.SamtoolsJobRunner()._move_tmp_files([(luigi.LocalTarget(tmpbam), luigi.LocalTarget(inbam))])
+            self.assertTrue(os.path.exists(inbam))
+            self.assertTrue(os.path.exists(baifile))
+            os.rename(baifile, tmpbam + ".bai")
+            os.rename(inbam, tmpbam)
+            ratatosk.lib.tools.samtools.SamtoolsJobRunner()._move_tmp_files([(luigi.LocalTarget(tmpbam), luigi.LocalTarget(inbam))])
+            self.assertTrue(os.path.exists(baifile))
+            self.assertFalse(os.path.exists(tmpbam + ".bai"))
+            # Index task has nothing to do; running samtools would fail
+            task = ratatosk.lib.tools.samtools.Index(target=baifile, executable="samtools-missing")
+            task.job_runner().run_job(task)
+            os.utime(inbam, (os.path.getmtime(baifile) + 10, os.path.getmtime(baifile) + 10))
+            self.assertRaises(Exception, task.job_runner().run_job, task)
+        finally:
+            for fn in [inbam, tmpbam, baifile, tmpbam + ".bai"]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
 
 class TestMiscWrappers(unittest.TestCase):
     def setUp(self):
@@ -163,6 +208,23 @@ class TestBwaWrappers(unittest.TestCase):
             _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0])
         )
 
+    def test_bwa_scatter_gather(self):
+        task = ratatosk.lib.align.bwa.BampeScatterGather(target=bam, scatter_count=2)
+        chunks = task.requires()
+        self.assertEqual([x.target for x in chunks], ["data/sample1-scatter/sample1.0000.bam", "data/sample1-scatter/sample1.0001.bam"])
+        self.assertEqual(['samtools', 'cat', '-o', 'data/sample1.bam', 'data/sample1-scatter/sample1.0000.bam', 'data/sample1-scatter/sample1.0001.bam'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        aln = chunks[1].requires()
+        self.assertEqual([x.target for x in aln], ["data/sample1-scatter/sample1.0001_R1_001.sai", "data/sample1-scatter/sample1.0001_R2_001.sai"])
+        fastq = aln[0].requires()[0]
+        self.assertEqual(fastq.target, "data/sample1-scatter/sample1.0001_R1_001.fastq.gz")
+        split = fastq.requires()
+        self.assertEqual(split.target, "data/sample1-scatter/sample1.0000_R1_001.fastq.gz")
+        self.assertEqual([x.path for x in split.output()], ["data/sample1-scatter/sample1.0000_R1_001.fastq.gz", "data/sample1-scatter/sample1.0001_R1_001.fastq.gz"])
+        self.assertEqual(split.requires()[0].target, "data/sample1_R1_001.fastq.gz")
+        # Chunks carry the read group of the lane
+        self.assertIn("ID:data/sample1\\t", chunks[1].args()[0]._get_read_group())
+
     def test_bwaindex(self):
         task = ratatosk.lib.align.bwa.Index(target=ref + ".bwt")
         self.assertEqual(['bwa', 'index', 'data/chr11.fa'],
@@ -172,40 +234,73 @@ class TestBwaWrappers(unittest.TestCase):
 def merge_bam_generator(task):
     return ["data/sample1.sort.bam", "data/sample2.sort.bam"]
 
+def single_bam_generator(task):
+    return ["data/merge-single.sort.bam"]
+
+class _MergeSamFiles(ratatosk.lib.tools.picard.MergeSamFiles):
+    target_generator_handler = luigi.Parameter(default="test.test_wrapper.merge_bam_generator")
+
 @unittest.skipIf((os.getenv("PICARD_HOME") is None or os.getenv("PICARD_HOME") == ""), "No Environment PICARD_HOME set; skipping")
 class TestPicardWrappers(unittest.TestCase):
     def _path(self, exe):
         return os.path.join(os.environ["PICARD_HOME"], exe)
     def test_picard_sortbam(self):
         task = ratatosk.lib.tools.picard.SortSam(target=sortbam)
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('SortSam.jar'), 'SO=coordinate MAX_RECORDS_IN_RAM=750000', 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.bam', 'OUTPUT=', 'data/sample1.sort.bam'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-Dsamjdk.use_async_io=true', '-jar', self._path('SortSam.jar'), 'SO=coordinate', 'VALIDATION_STRINGENCY=SILENT', 'CREATE_INDEX=true', 'MAX_RECORDS_IN_RAM=500000', 'TMP_DIR={}'.format(task.tmp_dir()), 'COMPRESSION_LEVEL=1', 'INPUT=', 'data/sample1.bam', 'OUTPUT=', 'data/sample1.sort.bam'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
+    def test_picard_sortbam_resource_opts(self):
+        task = ratatosk.lib.tools.picard.SortSam(target=sortbam, java_options=["-Xmx6g"], scratch_dir="/scratch", compression_level=5)
+        self.assertTrue(task.tmp_dir().startswith("/scratch/ratatosk-SortSam-"))
+        self.assertEqual(['MAX_RECORDS_IN_RAM=1500000', 'TMP_DIR={}'.format(task.tmp_dir()), 'COMPRESSION_LEVEL=5'], task.resource_opts())
+        task = ratatosk.lib.tools.picard.SortSam(target=sortbam, options=["SO=coordinate MAX_RECORDS_IN_RAM=100 TMP_DIR=/tmp"])
+        self.assertEqual(['COMPRESSION_LEVEL=1'], task.resource_opts())
+
     def test_picard_create_sequence_dictionary(self):
         task = ratatosk.lib.tools.picard.CreateSequenceDictionary(target="data/chr11.dict")
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('CreateSequenceDictionary.jar'), 'VALIDATION_STRINGENCY=SILENT', 'REFERENCE=', 'data/chr11.fa', 'OUTPUT=', 'data/chr11.dict'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('CreateSequenceDictionary.jar'), 'VALIDATION_STRINGENCY=SILENT', 'REFERENCE=', 'data/chr11.fa', 'OUTPUT=', 'data/chr11.dict'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_picard_alignmentmetrics(self):
         task = ratatosk.lib.tools.picard.AlignmentMetrics(target=sortbam.replace(".bam", ".align_metrics"), options=['REFERENCE_SEQUENCE={}'.format(ref)])
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('CollectAlignmentSummaryMetrics.jar'), 'REFERENCE_SEQUENCE=data/chr11.fa', 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.align_metrics'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('CollectAlignmentSummaryMetrics.jar'), 'REFERENCE_SEQUENCE=data/chr11.fa', 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.align_metrics'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_picard_insertmetrics(self):
         task = ratatosk.lib.tools.picard.InsertMetrics(target=sortbam.replace(".bam", ".insert_metrics"), options=['REFERENCE_SEQUENCE={}'.format(ref)])
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('CollectInsertSizeMetrics.jar'), 'REFERENCE_SEQUENCE=data/chr11.fa', 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.insert_metrics', 'HISTOGRAM_FILE=', 'data/sample1.sort.insert_hist'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('CollectInsertSizeMetrics.jar'), 'REFERENCE_SEQUENCE=data/chr11.fa', 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.insert_metrics', 'HISTOGRAM_FILE=', 'data/sample1.sort.insert_hist'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_picard_dupmetrics(self):
         task = ratatosk.lib.tools.picard.DuplicationMetrics(target=sortbam.replace(".bam", ".dup.bam"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('MarkDuplicates.jar'), 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.dup.bam', 'METRICS_FILE=', 'data/sample1.sort.dup_metrics'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-Dsamjdk.use_async_io=true', '-jar', self._path('MarkDuplicates.jar'), 'VALIDATION_STRINGENCY=SILENT', 'CREATE_INDEX=true', 'MAX_RECORDS_IN_RAM=500000', 'TMP_DIR={}'.format(task.tmp_dir()), 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.dup.bam', 'METRICS_FILE=', 'data/sample1.sort.dup_metrics'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_picard_hsmetrics(self):
         task = ratatosk.lib.tools.picard.HsMetrics(target=sortbam.replace(".bam", ".hs_metrics"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self._path('CalculateHsMetrics.jar'), 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.hs_metrics', 'BAIT_INTERVALS=', 'data/chr11_baits.interval_list', 'TARGET_INTERVALS=', 'data/chr11_targets.interval_list'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('CalculateHsMetrics.jar'), 'VALIDATION_STRINGENCY=SILENT', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.hs_metrics', 'BAIT_INTERVALS=', 'data/chr11_baits.interval_list', 'TARGET_INTERVALS=', 'data/chr11_targets.interval_list'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
+    def test_picard_hsmetrics_bed(self):
+        """Test that bed regions are converted to interval lists"""
+        bed = "data/chr11_hsmetrics.bed"
+        interval_list = "data/chr11_hsmetrics.interval_list"
+        with open(bed, "w") as fh:
+            fh.write("chr11\t99\t200\nchr11\t999\t1100\n")
+        try:
+            task = ratatosk.lib.tools.picard.HsMetrics(target=sortbam.replace(".bam", ".hs_metrics"), bait_regions=bed, target_regions=bed, ref="data/chr11.fa")
+            self.assertEqual(task.regions(), (interval_list, interval_list))
+            with open(interval_list) as fh:
+                lines = fh.readlines()
+            self.assertEqual([x.split("\t")[0] for x in lines[0:2]], ["@HD", "@SQ"])
+            self.assertEqual(lines[2:], ["chr11\t100\t200\t+\tchr11:100-200\n", "chr11\t1000\t1100\t+\tchr11:1000-1100\n"])
+            task = ratatosk.lib.tools.picard.HsMetrics(target=sortbam.replace(".bam", ".hs_metrics"), bait_regions=bed, target_regions=bed)
+            self.assertRaises(Exception, task.regions)
+        finally:
+            for fn in [bed, interval_list]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
     def test_picard_metrics(self):
         task = ratatosk.lib.tools.picard.PicardMetrics(target=sortbam.replace(".bam", ""))
         metrics = [ratatosk.lib.tools.picard.InsertMetrics(target=sortbam.replace(".bam", ".insert_metrics")),
@@ -213,12 +308,83 @@ class TestPicardWrappers(unittest.TestCase):
                    ratatosk.lib.tools.picard.AlignmentMetrics(target=sortbam.replace(".bam", ".align_metrics"))]
         self.assertEqual(task.requires(), metrics)
 
+    def test_picard_multiplemetrics(self):
+        task = ratatosk.lib.tools.picard.MultipleMetrics(target=sortbam.replace(".bam", ".align_metrics"))
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('CollectMultipleMetrics.jar'), 'VALIDATION_STRINGENCY=SILENT', 'PROGRAM=CollectAlignmentSummaryMetrics', 'PROGRAM=CollectInsertSizeMetrics', 'INPUT=', 'data/sample1.sort.bam', 'OUTPUT=', 'data/sample1.sort.multiple_metrics-tmp'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        self.assertEqual([x.path for x in task.output()], ['data/sample1.sort.align_metrics', 'data/sample1.sort.insert_metrics', 'data/sample1.sort.insert_hist'])
+        self.assertEqual(task.program_outputs(), ['data/sample1.sort.multiple_metrics-tmp.alignment_summary_metrics', 'data/sample1.sort.multiple_metrics-tmp.insert_size_metrics', 'data/sample1.sort.multiple_metrics-tmp.insert_size_histogram.pdf'])
+
+    def test_picard_metrics_single_pass(self):
+        task = ratatosk.lib.tools.picard.PicardMetrics(target=sortbam.replace(".bam", ""), multiple_metrics=True)
+        metrics = [ratatosk.lib.tools.picard.MultipleMetrics(target=sortbam.replace(".bam", ".align_metrics")),
+                   ratatosk.lib.tools.picard.HsMetrics(target=sortbam.replace(".bam", ".hs_metrics"))]
+        self.assertEqual(task.requires(), metrics)
+
+    def test_picard_native_metrics(self):
+        task = ratatosk.lib.tools.picard.InsertMetrics(target=sortbam.replace(".bam", ".insert_metrics"), native=True)
+        self.assertIsInstance(task.job_runner(), ratatosk.lib.tools.picard.NativeMetricsJobRunner)
+        self.assertEqual(task.native_outputs(), {"insert_file" : "data/sample1.sort.insert_metrics", "histogram_file" : "data/sample1.sort.insert_hist"})
+        task = ratatosk.lib.tools.picard.MultipleMetrics(target=sortbam.replace(".bam", ".align_metrics"), native=True)
+        self.assertIsInstance(task.job_runner(), ratatosk.lib.tools.picard.NativeMetricsJobRunner)
+        self.assertEqual(sorted(task.native_outputs().values()), ['data/sample1.sort.align_metrics', 'data/sample1.sort.insert_hist', 'data/sample1.sort.insert_metrics'])
+        task = ratatosk.lib.tools.picard.HsMetrics(target=sortbam.replace(".bam", ".hs_metrics"), native=True,
+                                                   bait_regions="data/chr11_baits.interval_list", target_regions="data/chr11_targets.interval_list")
+        self.assertEqual(task.native_outputs(), {"hs_file" : "data/sample1.sort.hs_metrics", "baits" : "data/chr11_baits.interval_list", "targets" : "data/chr11_targets.interval_list"})
+        task = ratatosk.lib.tools.picard.AlignmentMetrics(target=sortbam.replace(".bam", ".align_metrics"))
+        self.assertIsInstance(task.job_runner(), ratatosk.lib.tools.picard.PicardJobRunner)
+
+    def test_picard_dupmetrics_merge_inputs(self):
+        task = ratatosk.lib.tools.picard.DuplicationMetrics(target="data/sample.sort.merge.dup.bam", merge_inputs=True, parent_task=("test.test_wrapper._MergeSamFiles", ))
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-Dsamjdk.use_async_io=true', '-jar', self._path('MarkDuplicates.jar'), 'VALIDATION_STRINGENCY=SILENT', 'CREATE_INDEX=true', 'MAX_RECORDS_IN_RAM=500000', 'TMP_DIR={}'.format(task.tmp_dir()), 'INPUT=', 'data/sample1.sort.bam', 'INPUT=', 'data/sample2.sort.bam', 'OUTPUT=', 'data/sample.sort.merge.dup.bam', 'METRICS_FILE=', 'data/sample.sort.merge.dup_metrics'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        task = ratatosk.lib.tools.picard.DuplicationMetrics(target="data/sample.sort.merge.dup.bam", parent_task=("test.test_wrapper._MergeSamFiles", ))
+        self.assertEqual([x.target for x in task.requires()], ["data/sample.sort.merge.bam"])
+
+    def test_picard_sortbam_skip_sorted(self):
+        (inbam, outbam) = ("data/sort-skip.bam", "data/sort-skip.sort.bam")
+        header = "@HD\tVN:1.4\tSO:coordinate\n"
+        fh = gzip.open(inbam, "wb")
+        fh.write("BAM\1" + struct.pack("<i", len(header)) + header)
+        fh.close()
+        try:
+            task = ratatosk.lib.tools.picard.SortSam(target=outbam)
+            self.assertTrue(task.input_is_sorted())
+            task.job_runner().run_job(task)
+            self.assertEqual(os.readlink(outbam), "sort-skip.bam")
+            task = ratatosk.lib.tools.picard.SortSam(target=outbam, options=["SO=queryname"])
+            self.assertFalse(task.input_is_sorted())
+            task = ratatosk.lib.tools.samtools.SortBam(target=outbam, parent_task=("ratatosk.lib.tools.samtools.InputBamFile", ), check_index=True)
+            self.assertFalse(task.input_is_sorted())
+            task = ratatosk.lib.tools.samtools.SortBam(target=outbam, parent_task=("ratatosk.lib.tools.samtools.InputBamFile", ))
+            self.assertTrue(task.input_is_sorted())
+        finally:
+            for fn in [inbam, outbam]:
+                if os.path.lexists(fn):
+                    os.unlink(fn)
+
+    def test_merge_single_input(self):
+        (inbam, mergebam) = ("data/merge-single.sort.bam", "data/merge-single.sort.merge.bam")
+        for fn in [inbam, inbam.replace(".bam", ".bai")]:
+            with open(fn, "w") as fh:
+                fh.write("bam")
+        try:
+            task = ratatosk.lib.tools.picard.MergeSamFiles(target=mergebam, target_generator_handler='test.test_wrapper.single_bam_generator')
+            task.job_runner().run_job(task)
+            self.assertTrue(os.path.islink(mergebam))
+            self.assertEqual(os.readlink(mergebam), "merge-single.sort.bam")
+            self.assertEqual(os.readlink(mergebam.replace(".bam", ".bai")), "merge-single.sort.bai")
+        finally:
+            for fn in [inbam, mergebam, inbam.replace(".bam", ".bai"), mergebam.replace(".bam", ".bai")]:
+                if os.path.lexists(fn):
+                    os.unlink(fn)
+
     # NOTE: if no target_generator exists will be impossible to check
     # formatting of input. Here create dummy file names
     def test_merge_sam_files(self):
         mergebam = "data/sample.sort.merge.bam"
         task = ratatosk.lib.tools.picard.MergeSamFiles(target=mergebam, target_generator_handler='test.test_wrapper.merge_bam_generator')
-        self.assertEqual(sorted(['java', '-Xmx2g', '-jar', self._path('MergeSamFiles.jar'), 'SO=coordinate TMP_DIR=./tmp', 'VALIDATION_STRINGENCY=SILENT', 'OUTPUT=', 'data/sample.sort.merge.bam', 'INPUT=', 'data/sample1.sort.bam', 'INPUT=', 'data/sample2.sort.bam']),
+        self.assertEqual(sorted(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self._path('MergeSamFiles.jar'), 'SO=coordinate', 'VALIDATION_STRINGENCY=SILENT', 'CREATE_INDEX=true', 'MAX_RECORDS_IN_RAM=500000', 'TMP_DIR={}'.format(task.tmp_dir()), 'COMPRESSION_LEVEL=1', '-Dsamjdk.use_async_io=true', 'OUTPUT=', 'data/sample.sort.merge.bam', 'INPUT=', 'data/sample1.sort.bam', 'INPUT=', 'data/sample2.sort.bam']),
                          sorted(_prune_luigi_tmp(task.job_runner()._make_arglist(task)[0])))
 
 
@@ -232,86 +398,128 @@ class TestGATKWrappers(unittest.TestCase):
 
     def test_realigner_target_creator(self):
         task = ratatosk.lib.tools.gatk.RealignerTargetCreator(target=self.mergebam.replace(".bam", ".intervals"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T RealignerTargetCreator', '-nt 1', '', '-I', 'data/sample.sort.merge.bam', '-o', 'data/sample.sort.merge.intervals', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T RealignerTargetCreator', '-nt 1', '', '-I', 'data/sample.sort.merge.bam', '-o', 'data/sample.sort.merge.intervals', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
                          
     def test_indelrealigner(self):
         task = ratatosk.lib.tools.gatk.IndelRealigner(target=self.mergebam.replace(".bam", ".realign.bam"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T IndelRealigner', '', '-I', 'data/sample.sort.merge.bam', '-o', 'data/sample.sort.merge.realign.bam', '--targetIntervals', 'data/sample.sort.merge.intervals', '-known data/sample.sort.merge.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T IndelRealigner', '', '-I', 'data/sample.sort.merge.bam', '-o', 'data/sample.sort.merge.realign.bam', '--targetIntervals', 'data/sample.sort.merge.intervals', '-known data/sample.sort.merge.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_base_recalibrator(self):
         task = ratatosk.lib.tools.gatk.BaseRecalibrator(target=self.mergebam.replace(".bam", ".realign.recal_data.grp"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T BaseRecalibrator', '-I', 'data/sample.sort.merge.realign.bam', '-o', 'data/sample.sort.merge.realign.recal_data.grp', '-R', 'data/chr11.fa', ' -knownSites knownSites1.vcf  -knownSites knownSites2.vcf'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T BaseRecalibrator', '-I', 'data/sample.sort.merge.realign.bam', '-o', 'data/sample.sort.merge.realign.recal_data.grp', '-R', 'data/chr11.fa', ' -knownSites knownSites1.vcf  -knownSites knownSites2.vcf'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_printreads(self):
         task = ratatosk.lib.tools.gatk.PrintReads(target=self.mergebam.replace(".bam", ".realign.recal.bam"))
         self.assertEqual(
-            ['java', '-Xmx2g', '-jar', self.gatk, '-T PrintReads', '-I', 'data/sample.sort.merge.realign.bam', '-o', 'data/sample.sort.merge.realign.recal.bam', '-BQSR', 'data/sample.sort.merge.realign.recal_data.grp', '-R', 'data/chr11.fa'],
+            ['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T PrintReads', '-I', 'data/sample.sort.merge.realign.bam', '-o', 'data/sample.sort.merge.realign.recal.bam', '-BQSR', 'data/sample.sort.merge.realign.recal_data.grp', '-R', 'data/chr11.fa'],
             _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
 
+    def test_scatter_gather_commands(self):
+        """Test that vcf files and BQSR reports are gathered with classes of the same GATK version"""
+        task = ratatosk.lib.tools.gatk.UnifiedGenotyperScatterGather(target=self.mergebam.replace(".bam", ".vcf"), scatter_count=2)
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-cp', self.gatk, 'org.broadinstitute.gatk.tools.CatVariants', '-R', 'data/chr11.fa', '-assumeSorted'],
+                         task.gather_cmd())
+        task = ratatosk.lib.tools.gatk.BaseRecalibratorScatterGather(target=self.mergebam.replace(".bam", ".realign.recal_data.grp"), scatter_count=2)
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-cp', self.gatk, 'org.broadinstitute.gatk.tools.GatherBqsrReports'],
+                         task.gather_cmd())
+
     def test_clipreads(self):
         task = ratatosk.lib.tools.gatk.ClipReads(target=self.mergebam.replace(".bam", ".realign.recal.clip.bam"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T ClipReads', '--cyclesToTrim 1-5 --clipRepresentation WRITE_NS', '-I', 'data/sample.sort.merge.realign.recal.bam', '-o', 'data/sample.sort.merge.realign.recal.clip.bam', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T ClipReads', '--cyclesToTrim 1-5 --clipRepresentation WRITE_NS', '-I', 'data/sample.sort.merge.realign.recal.bam', '-o', 'data/sample.sort.merge.realign.recal.clip.bam', '-R', 'data/chr11.fa'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+
+    def test_capture_region(self):
+        """Test that walkers are restricted to the capture region, and that reads are only dropped if drop_off_target is set"""
+        params = dict(ratatosk.lib.tools.gatk.GATKJobTask.get_params())
+        capture = "data/chr11_targets.interval_list"
+        params["capture_region"].set_default(capture)
+        try:
+            task = ratatosk.lib.tools.gatk.BaseRecalibrator(target=self.mergebam.replace(".bam", ".realign.recal_data.grp"))
+            self.assertEqual(task.interval_opts(), ["-L", capture])
+            task = ratatosk.lib.tools.gatk.PrintReads(target=self.mergebam.replace(".bam", ".realign.recal.bam"))
+            self.assertEqual(task.interval_opts(), [])
+            params["drop_off_target"].set_default(True)
+            task = ratatosk.lib.tools.gatk.PrintReads(target=self.mergebam.replace(".bam", ".realign.recal.bam"))
+            self.assertEqual(task.interval_opts(), ["-L", capture])
+            task = ratatosk.lib.tools.gatk.UnifiedGenotyper(target=self.mergebam.replace(".bam", ".realign.recal.clip.vcf"), target_region="chr11:1-1000")
+            self.assertEqual(task.interval_opts(), ["-L", "chr11:1-1000"])
+        finally:
+            params["capture_region"].set_default(None)
+            params["drop_off_target"].set_default(False)
+
+    def test_clipreads_bqsr(self):
+        task = ratatosk.lib.tools.gatk.ClipReads(target=self.mergebam.replace(".bam", ".realign.recal.clip.bam"),
+                                                 parent_task=("ratatosk.lib.tools.gatk.IndelRealigner", "ratatosk.lib.tools.gatk.BaseRecalibrator"),
+                                                 diff_label=(".recal", ".recal"))
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T ClipReads', '--cyclesToTrim 1-5 --clipRepresentation WRITE_NS', '-I', 'data/sample.sort.merge.realign.bam', '-o', 'data/sample.sort.merge.realign.recal.clip.bam', '-BQSR', 'data/sample.sort.merge.realign.recal_data.grp', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_unifiedgenotyper(self):
         task = ratatosk.lib.tools.gatk.UnifiedGenotyper(target=self.mergebam.replace(".bam", ".realign.recal.clip.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T UnifiedGenotyper', '-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_VARIANTS_ONLY -glm BOTH', '-nt 1', '--dbsnp',  'data/dbsnp132_chr11.vcf', '-I', 'data/sample.sort.merge.realign.recal.clip.bam', '-o', 'data/sample.sort.merge.realign.recal.clip.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T UnifiedGenotyper', '-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_VARIANTS_ONLY -glm BOTH', '-nt 1', '--dbsnp',  'data/dbsnp132_chr11.vcf', '-I', 'data/sample.sort.merge.realign.recal.clip.bam', '-o', 'data/sample.sort.merge.realign.recal.clip.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_unifiedgenotyper_alleles(self):
         task = ratatosk.lib.tools.gatk.UnifiedGenotyperAlleles(target=self.mergebam.replace(".bam", ".realign.recal.clip-genotype.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T UnifiedGenotyper', '-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_ALL_SITES -glm BOTH', '-nt 1', '--dbsnp', 'data/dbsnp132_chr11.vcf', '--genotyping_mode', 'GENOTYPE_GIVEN_ALLELES', '-I', 'data/sample.sort.merge.realign.recal.clip.bam', '-o', 'data/sample.sort.merge.realign.recal.clip-genotype.vcf', '--alleles', 'data/sample.sort.merge.realign.recal.clip.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T UnifiedGenotyper', '-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_ALL_SITES -glm BOTH', '-nt 1', '--dbsnp', 'data/dbsnp132_chr11.vcf', '--genotyping_mode', 'GENOTYPE_GIVEN_ALLELES', '-I', 'data/sample.sort.merge.realign.recal.clip.bam', '-o', 'data/sample.sort.merge.realign.recal.clip-genotype.vcf', '--alleles', 'data/sample.sort.merge.realign.recal.clip.vcf', '-R', 'data/chr11.fa'],
+                         _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+
+    def test_unifiedgenotyper_alleles_batch(self):
+        task = ratatosk.lib.tools.gatk.UnifiedGenotyperAllelesBatch(target=os.path.join(indir, "CombinedVariants-genotype-batch000.vcf"),
+                                                                    sample_targets=[os.path.join(indir, "sample1.sort.merge.realign.recal.clip-genotype.vcf"),
+                                                                                    os.path.join(indir, "sample2.sort.merge.realign.recal.clip-genotype.vcf")])
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T UnifiedGenotyper', '-stand_call_conf 30.0 -stand_emit_conf 10.0  --downsample_to_coverage 30 --output_mode EMIT_ALL_SITES -glm BOTH', '-nt 1', '--dbsnp', 'data/dbsnp132_chr11.vcf', '--genotyping_mode', 'GENOTYPE_GIVEN_ALLELES', '-I', 'data/sample1.sort.merge.realign.recal.clip.bam', '-I', 'data/sample2.sort.merge.realign.recal.clip.bam', '-o', 'data/CombinedVariants-genotype-batch000.vcf', '--alleles', 'data/sample1.sort.merge.realign.recal.clip.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_variantfiltration(self):
         task = ratatosk.lib.tools.gatk.VariantFiltration(target=self.mergebam.replace(".bam", ".realign.recal.clip.filtered.vcf"),
                                                          options=['--clusterWindowSize 10 --clusterSize 3 --filterExpression "MQ0 >= 4 && ((MQ0 / (1.0 * DP)) > 0.1)" --filterName "HARD_TO_VALIDATE" --filterExpression "DP < 10" --filterName "LowCoverage" --filterExpression "QUAL < 30.0" --filterName "VeryLowQual" --filterExpression "QUAL > 30.0 && QUAL < 50.0" --filterName "LowQual" --filterExpression "QD < 1.5" --filterName "LowQD"', '--variant', 'data/sample.sort.merge.realign.recal.clip.vcf'])
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantFiltration','--clusterWindowSize 10 --clusterSize 3 --filterExpression "MQ0 >= 4 && ((MQ0 / (1.0 * DP)) > 0.1)" --filterName "HARD_TO_VALIDATE" --filterExpression "DP < 10" --filterName "LowCoverage" --filterExpression "QUAL < 30.0" --filterName "VeryLowQual" --filterExpression "QUAL > 30.0 && QUAL < 50.0" --filterName "LowQual" --filterExpression "QD < 1.5" --filterName "LowQD"', '--variant', 'data/sample.sort.merge.realign.recal.clip.vcf', '--variant', 'data/sample.sort.merge.realign.recal.clip.vcf', '--out', 'data/sample.sort.merge.realign.recal.clip.filtered.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantFiltration','--clusterWindowSize 10 --clusterSize 3 --filterExpression "MQ0 >= 4 && ((MQ0 / (1.0 * DP)) > 0.1)" --filterName "HARD_TO_VALIDATE" --filterExpression "DP < 10" --filterName "LowCoverage" --filterExpression "QUAL < 30.0" --filterName "VeryLowQual" --filterExpression "QUAL > 30.0 && QUAL < 50.0" --filterName "LowQual" --filterExpression "QD < 1.5" --filterName "LowQD"', '--variant', 'data/sample.sort.merge.realign.recal.clip.vcf', '--variant', 'data/sample.sort.merge.realign.recal.clip.vcf', '--out', 'data/sample.sort.merge.realign.recal.clip.filtered.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_varianteval(self):
         task = ratatosk.lib.tools.gatk.VariantEval(target=self.mergebam.replace(".bam", ".realign.recal.clip.filtered.eval_metrics"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantEval', '-ST Filter -l INFO --doNotUseAllStandardModules --evalModule CompOverlap --evalModule CountVariants --evalModule GenotypeConcordance --evalModule TiTvVariantEvaluator --evalModule ValidationReport --stratificationModule Filter', '--dbsnp',  'data/dbsnp132_chr11.vcf', '--eval', 'data/sample.sort.merge.realign.recal.clip.filtered.vcf', '-o', 'data/sample.sort.merge.realign.recal.clip.filtered.eval_metrics', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantEval', '-ST Filter -l INFO --doNotUseAllStandardModules --evalModule CompOverlap --evalModule CountVariants --evalModule GenotypeConcordance --evalModule TiTvVariantEvaluator --evalModule ValidationReport --stratificationModule Filter', '--dbsnp',  'data/dbsnp132_chr11.vcf', '--eval', 'data/sample.sort.merge.realign.recal.clip.filtered.vcf', '-o', 'data/sample.sort.merge.realign.recal.clip.filtered.eval_metrics', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_variant_annotator(self):
         task = ratatosk.lib.tools.gatk.VariantAnnotator(target=self.mergebam.replace(".bam", "-gatkann.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantAnnotator', '', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-gatkann.vcf', '-R', 'data/chr11.fa', '-A', 'BaseQualityRankSumTest', '-A', 'DepthOfCoverage', '-A', 'FisherStrand', '-A', 'GCContent', '-A', 'HaplotypeScore', '-A', 'HomopolymerRun', '-A', 'MappingQualityRankSumTest', '-A', 'MappingQualityZero', '-A', 'QualByDepth', '-A', 'ReadPosRankSumTest', '-A', 'RMSMappingQuality'], _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantAnnotator', '', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-gatkann.vcf', '-R', 'data/chr11.fa', '-A', 'BaseQualityRankSumTest', '-A', 'DepthOfCoverage', '-A', 'FisherStrand', '-A', 'GCContent', '-A', 'HaplotypeScore', '-A', 'HomopolymerRun', '-A', 'MappingQualityRankSumTest', '-A', 'MappingQualityZero', '-A', 'QualByDepth', '-A', 'ReadPosRankSumTest', '-A', 'RMSMappingQuality'], _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_GATK_snpeff_variant_annotator(self):
         task = ratatosk.lib.tools.gatk.VariantSnpEffAnnotator(target=self.mergebam.replace(".bam", "-annotated.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantAnnotator', '', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-annotated.vcf', '--snpEffFile', 'data/sample.sort.merge-effects.vcf', '-R', 'data/chr11.fa', '-A', 'SnpEff'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantAnnotator', '', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-annotated.vcf', '--snpEffFile', 'data/sample.sort.merge-effects.vcf', '-R', 'data/chr11.fa', '-A', 'SnpEff'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     # def test_combine_variants(self):
     #     task = ratatosk.lib.tools.gatk.CombineVariants(target=self.mergebam.replace(".bam", "-variants-combined.vcf"), ref='data/chr11.fa',
     #                                                    target_generator_handler="test.test_wrapper.gatk_vcf_generator")
-    #     self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T CombineVariants', '-V', 'vcf1.vcf', '-V', 'vcf2.vcf', '-o', 'data/sample.sort.merge-variants-combined.vcf', '-R', 'data/chr11.fa'],
+    #     self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T CombineVariants', '-V', 'vcf1.vcf', '-V', 'vcf2.vcf', '-o', 'data/sample.sort.merge-variants-combined.vcf', '-R', 'data/chr11.fa'],
     #                      _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
 
     def test_combine_variants(self):
         task = ratatosk.lib.tools.gatk.CombineSplitVariants(target=self.mergebam.replace(".bam", "-variants-combined.vcf"), ref='data/chr11.fa')
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T CombineVariants', '-V', 'data/sample.sort.merge-variants-combined-split/sample.sort.merge-variants-combined-chr11.vcf', '-o', 'data/sample.sort.merge-variants-combined.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T CombineVariants', '-V', 'data/sample.sort.merge-variants-combined-split/sample.sort.merge-variants-combined-chr11.vcf', '-o', 'data/sample.sort.merge-variants-combined.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_select_variants(self):
         task = ratatosk.lib.tools.gatk.SelectVariants(target=self.mergebam.replace(".bam", "-snp-all.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'SNP', '--selectTypeToInclude', 'INDEL', '--selectTypeToInclude', 'MIXED', '--selectTypeToInclude', 'MNP', '--selectTypeToInclude', 'SYMBOLIC', '--selectTypeToInclude', 'NO_VARIATION', '--variant', 'data/sample.sort.merge-snp.vcf', '--out', 'data/sample.sort.merge-snp-all.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'SNP', '--selectTypeToInclude', 'INDEL', '--selectTypeToInclude', 'MIXED', '--selectTypeToInclude', 'MNP', '--selectTypeToInclude', 'SYMBOLIC', '--selectTypeToInclude', 'NO_VARIATION', '--variant', 'data/sample.sort.merge-snp.vcf', '--out', 'data/sample.sort.merge-snp-all.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_select_snp_variants(self):
         task = ratatosk.lib.tools.gatk.SelectSnpVariants(target=self.mergebam.replace(".bam", "-snp.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'SNP', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-snp.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'SNP', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-snp.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_select_indel_variants(self):
         task = ratatosk.lib.tools.gatk.SelectIndelVariants(target=self.mergebam.replace(".bam", "-indel.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'INDEL', '--selectTypeToInclude', 'MIXED', '--selectTypeToInclude', 'MNP', '--selectTypeToInclude', 'SYMBOLIC', '--selectTypeToInclude', 'NO_VARIATION', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-indel.vcf', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T SelectVariants', '--selectTypeToInclude', 'INDEL', '--selectTypeToInclude', 'MIXED', '--selectTypeToInclude', 'MNP', '--selectTypeToInclude', 'SYMBOLIC', '--selectTypeToInclude', 'NO_VARIATION', '--variant', 'data/sample.sort.merge.vcf', '--out', 'data/sample.sort.merge-indel.vcf', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_variant_recalibrator(self):
@@ -320,14 +528,14 @@ class TestGATKWrappers(unittest.TestCase):
         applicable"""
         task = ratatosk.lib.tools.gatk.VariantRecalibrator(target=self.mergebam.replace(".bam", ".tranches"), ref="data/chr11.fa", 
                                                            options=["-an", "QD", "-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0", "data/hapmap_3.3.vcf"])
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'BOTH', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'BOTH', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_variant_snp_recalibrator(self):
         task = ratatosk.lib.tools.gatk.VariantSnpRecalibrator(target=self.mergebam.replace(".bam", ".tranches"), 
                                                               train_hapmap="data/hapmap_3.3.vcf",
                                                               ref="data/chr11.fa", dbsnp="data/dbsnp132_chr11.vcf")
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'HaplotypeScore', '-an', 'MQRankSum', '-an', 'ReadPosRankSum', '-an', 'FS', '-an', 'MQ', '-an', 'DP', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '-resource:dbsnp,VCF,known=true,training=false,truth=false,prior=8.0', 'data/dbsnp132_chr11.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'SNP', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'HaplotypeScore', '-an', 'MQRankSum', '-an', 'ReadPosRankSum', '-an', 'FS', '-an', 'MQ', '-an', 'DP', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '-resource:dbsnp,VCF,known=true,training=false,truth=false,prior=8.0', 'data/dbsnp132_chr11.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'SNP', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_variant_snp_recalibrator_exome(self):
@@ -336,7 +544,7 @@ class TestGATKWrappers(unittest.TestCase):
                                                                    train_hapmap="data/hapmap_3.3.vcf",
                                                                    ref="data/chr11.fa", dbsnp="data/dbsnp132_chr11.vcf")
         arglist = _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0])
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'HaplotypeScore', '-an', 'MQRankSum', '-an', 'ReadPosRankSum', '-an', 'FS', '-an', 'MQ', '--maxGaussians', '4', '--percentBadVariants', '0.05', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '-resource:dbsnp,VCF,known=true,training=false,truth=false,prior=8.0', 'data/dbsnp132_chr11.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'SNP', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'HaplotypeScore', '-an', 'MQRankSum', '-an', 'ReadPosRankSum', '-an', 'FS', '-an', 'MQ', '--maxGaussians', '4', '--percentBadVariants', '0.05', '-resource:hapmap,VCF,known=false,training=true,truth=true,prior=15.0', 'data/hapmap_3.3.vcf', '-resource:dbsnp,VCF,known=true,training=false,truth=false,prior=8.0', 'data/dbsnp132_chr11.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'SNP', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
                          arglist)
         self.assertIn('--maxGaussians', arglist)
 
@@ -344,7 +552,7 @@ class TestGATKWrappers(unittest.TestCase):
         task = ratatosk.lib.tools.gatk.VariantIndelRecalibrator(target=self.mergebam.replace(".bam", ".tranches"), 
                                                                 train_indels="data/Mills_Devine_2hit.indels.vcf",
                                                                 ref="data/chr11.fa")
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'FS', '-an', 'HaplotypeScore', '-an', 'ReadPosRankSum', '-resource:mills,VCF,known=true,training=true,truth=true,prior=12.0', 'data/Mills_Devine_2hit.indels.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'INDEL', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.gatk, '-T VariantRecalibrator', '-an', 'QD', '-an', 'FS', '-an', 'HaplotypeScore', '-an', 'ReadPosRankSum', '-resource:mills,VCF,known=true,training=true,truth=true,prior=12.0', 'data/Mills_Devine_2hit.indels.vcf', '--input', 'data/sample.sort.merge.vcf', '--tranches_file', 'data/sample.sort.merge.tranches', '--mode', 'INDEL', '--recal_file', 'data/sample.sort.merge.recal', '-R', 'data/chr11.fa'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
  
     # TODO: need to test the command on real data 
@@ -369,11 +577,11 @@ class TestSnpEffWrappers(unittest.TestCase):
 
     def test_snpeff(self):
         task = ratatosk.lib.annotation.snpeff.snpEff(target=self.bam.replace(".bam", "-effects.vcf"))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.snpeff, 'eff', '-1', '-i', 'vcf', '-o', 'vcf', '-c', self.config, 'GRCh37.64', 'data/sample.sort.vcf', '>', 'data/sample.sort-effects.vcf'], _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.snpeff, 'eff', '-1', '-i', 'vcf', '-o', 'vcf', '-c', self.config, 'GRCh37.64', 'data/sample.sort.vcf', '>', 'data/sample.sort-effects.vcf'], _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
 
     def test_snpeff_txt(self):
         task = ratatosk.lib.annotation.snpeff.snpEff(target=self.bam.replace(".bam", "-effects.txt"), suffix=('.txt',))
-        self.assertEqual(['java', '-Xmx2g', '-jar', self.snpeff, 'eff', '-1', '-i', 'vcf', '-o', 'txt', '-c', self.config, 'GRCh37.64', 'data/sample.sort.vcf', '>', 'data/sample.sort-effects.txt'],
+        self.assertEqual(['java', '-Xmx2g', '-XX:ParallelGCThreads=1', '-jar', self.snpeff, 'eff', '-1', '-i', 'vcf', '-o', 'txt', '-c', self.config, 'GRCh37.64', 'data/sample.sort.vcf', '>', 'data/sample.sort-effects.txt'],
                          _prune_luigi_tmp(task.job_runner()._make_arglist(task)[0]))
     
 